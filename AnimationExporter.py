@@ -0,0 +1,155 @@
+"""
+Export animation frames to numbered PNG files without a window. Scene animations are stepped with
+animationUpdate once per frame, so exports are deterministic and independent of the frame rate. Pixels go through two
+pixel pack buffers: frame i is read into one while frame i - 1 is mapped from the other, so the readback overlaps with
+rendering. PNG encoding runs in a thread pool. Command line usage:
+
+    python AnimationExporter.py --scene 1 --frames 240 --width 1280 --height 720 --output frames
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+# must come first, it selects the PyOpenGL platform
+from HeadlessRenderer import HeadlessRenderer, BACKEND
+
+import argparse
+import math
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from Animation import Animation
+from GLBuffer import PBO
+
+
+class AnimationExporter:
+    """
+    Statistics of the last export are in stats(): time spent drawing, mapping pixel buffers and waiting for the
+    encoders. When the export is rendering bound the last two stay close to zero.
+    """
+    renderer: HeadlessRenderer = None
+    pbos = None  # list<PBO>(2)
+    workers = 4
+    compressLevel = 1  # zlib level of the PNG files, 1 is several times faster to encode than PIL's default 6
+
+    # statistics of the last export
+    frames = 0
+    drawTime = 0.0
+    readbackTime = 0.0
+    encodeWaitTime = 0.0
+    totalTime = 0.0
+
+    def __init__(self, renderer: HeadlessRenderer, workers=4, compressLevel=1):
+        self.renderer = renderer
+        self.workers = workers
+        self.compressLevel = compressLevel
+        self.pbos = [PBO(renderer.width, renderer.height) for _ in range(2)]
+
+    def encode(self, image: np.ndarray, path):
+        Image.fromarray(np.ascontiguousarray(image[..., 0:3])).save(path, compress_level=self.compressLevel)
+
+    def export(self, frameNum, outputDir, fileNamePattern="frame_{:05d}.png", orbit=0.0):
+        """
+        Render frameNum frames of the renderer's current scene
+
+        :param frameNum: number of frames to export
+        :param outputDir: directory for the PNG files, created if needed
+        :param fileNamePattern: format string of the file names, gets the frame index
+        :param orbit: camera rotation around the look at point per frame, in radians
+        :return: list of the written file paths
+        """
+        os.makedirs(outputDir, exist_ok=True)
+        paths = [os.path.join(outputDir, fileNamePattern.format(i)) for i in range(frameNum)]
+        self.frames = frameNum
+        self.drawTime = self.readbackTime = self.encodeWaitTime = 0.0
+        start = time.perf_counter()
+
+        pending = deque()
+        with ThreadPoolExecutor(self.workers) as pool:
+            def submit(frame):
+                # bounded queue, so a slow disk can't make frames pile up in memory
+                if len(pending) >= 2 * self.workers:
+                    waitStart = time.perf_counter()
+                    pending.popleft().result()
+                    self.encodeWaitTime += time.perf_counter() - waitStart
+                readStart = time.perf_counter()
+                image = self.pbos[frame % 2].fetch()
+                self.readbackTime += time.perf_counter() - readStart
+                pending.append(pool.submit(self.encode, image, paths[frame]))
+
+            for i in range(frameNum):
+                drawStart = time.perf_counter()
+                if isinstance(self.renderer.scene, Animation):
+                    self.renderer.scene.animationUpdate()
+                self.renderer.cameraTheta += orbit
+                self.renderer.draw()
+                self.pbos[i % 2].startRead(self.renderer.fbo)
+                self.drawTime += time.perf_counter() - drawStart
+                # the previous frame had a whole frame of drawing to finish its transfer
+                if i > 0:
+                    submit(i - 1)
+            if frameNum > 0:
+                submit(frameNum - 1)
+
+            waitStart = time.perf_counter()
+            for future in pending:
+                future.result()
+            self.encodeWaitTime += time.perf_counter() - waitStart
+
+        self.totalTime = time.perf_counter() - start
+        return paths
+
+    def stats(self) -> dict:
+        perFrame = 1000 / max(self.frames, 1)
+        return {
+            "frames": self.frames,
+            "fps": self.frames / self.totalTime if self.totalTime else 0.0,
+            "drawMsPerFrame": self.drawTime * perFrame,
+            "readbackMsPerFrame": self.readbackTime * perFrame,
+            "encodeWaitMsPerFrame": self.encodeWaitTime * perFrame,
+        }
+
+    def delete(self):
+        for pbo in self.pbos:
+            pbo.delete()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export animation frames to PNG without a window")
+    parser.add_argument("--backend", choices=("egl", "osmesa"), default=BACKEND,
+                        help="offscreen OpenGL context, default egl")
+    parser.add_argument("--scene", type=int, default=1, choices=range(1, 5), help="1 to 4, SceneOne..SceneFour")
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--distance", type=float, default=6, help="camera distance to the look at point")
+    parser.add_argument("--theta", type=float, default=90, help="camera angle on the horizontal plane, in degrees")
+    parser.add_argument("--phi", type=float, default=30, help="camera elevation, in degrees")
+    parser.add_argument("--orbit", type=float, default=0, help="camera rotation per frame, in degrees")
+    parser.add_argument("--seed", type=int, default=0, help="random seed used to build the scene")
+    parser.add_argument("--workers", type=int, default=4, help="PNG encoding threads")
+    parser.add_argument("--compress-level", type=int, default=1, choices=range(0, 10), help="PNG zlib level")
+    parser.add_argument("--output", default="frames", help="output directory")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output)
+    # scenes load their assets relative to the program directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    renderer = HeadlessRenderer(args.width, args.height, args.backend)
+    random.seed(args.seed)
+    renderer.setScene(args.scene - 1)
+    renderer.setCamera(args.distance, math.radians(args.theta), math.radians(args.phi))
+    exporter = AnimationExporter(renderer, args.workers, args.compress_level)
+    exporter.export(args.frames, output, orbit=math.radians(args.orbit))
+    print("Exported", args.frames, "frames to", output, exporter.stats())
+    exporter.delete()
+    renderer.destroy()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Define the asset pack, every texture of the assets folder baked into one binary file so the program starts without
+decoding any image. The images are stored ready to upload: flipped bottom row first, tightly packed RGB, with their
+whole mip chain. At runtime the pack is memory-mapped and TextureCache hands numpy views of it straight to
+glTexImage2D, neither decoded nor copied. Bake the pack again after changing an asset, entries whose file changed
+since are ignored and the file is decoded as usual. Command line usage:
+
+    python AssetPack.py --assets assets --output assets/assets.pack
+
+Every image is also stored block compressed, a sixth (BC1) or a third (BC5) of the uncompressed size in video
+memory. Color textures use BC1 (S3TC DXT1), normal maps BC5 (RGTC2), which keeps x and y of the normal at full
+precision and lets the shader rebuild z. Contexts without the extension of a format get the uncompressed levels.
+
+Layout: a header (magic, version, index offset and length), the level blobs, each aligned to 16 bytes, and a JSON
+index mapping file names relative to the pack's folder to their size, modification time, levels and compressed
+levels.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import argparse
+import fnmatch
+import json
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+from PIL import Image
+
+
+def decodeImage(path) -> np.ndarray:
+    """
+    Read an image file into a contiguous uint8 (height, width, 3) array, bottom row first like textures are stored.
+    TextureCache runs it on its decoding threads, PIL releases the GIL while decoding
+    """
+    image = np.asarray(Image.open(path).convert("RGB"), dtype=np.uint8)
+    return np.ascontiguousarray(image[::-1])
+
+
+def imageBlocks(image) -> np.ndarray:
+    """
+    Split an image into 4x4 blocks, the last row and column are repeated to fill the edge blocks
+
+    :param image: (height, width, channels) array
+    :return: (blocks, 16, channels) float32 array, blocks row by row and the texels of a block row by row
+    """
+    height, width, channels = image.shape
+    padded = np.pad(image, ((0, -height % 4), (0, -width % 4), (0, 0)), mode="edge")
+    rows, columns = padded.shape[0] // 4, padded.shape[1] // 4
+    blocks = padded.reshape(rows, 4, columns, 4, channels).transpose(0, 2, 1, 3, 4)
+    return blocks.reshape(rows * columns, 16, channels).astype(np.float32)
+
+
+def packRGB565(colors) -> np.ndarray:
+    r, g, b = (np.rint(colors[..., i] * scale / 255).astype(np.uint16) for i, scale in enumerate((31, 63, 31)))
+    return (r << 11) | (g << 5) | b
+
+
+def unpackRGB565(packed) -> np.ndarray:
+    r, g, b = (packed >> 11) & 31, (packed >> 5) & 63, packed & 31
+    return np.stack([(r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2)], axis=-1).astype(np.float32)
+
+
+def encodeBC1(image) -> bytes:
+    """
+    BC1 (S3TC DXT1) blocks of an RGB image: two RGB565 end points on the principal axis of the block's colors and
+    a 2 bit index per texel into the 4 colors between them
+    """
+    texels = imageBlocks(image[..., 0:3])
+    mean = texels.mean(axis=1)
+    centered = texels - mean[:, None, :]
+    covariance = np.einsum("nki,nkj->nij", centered, centered)
+    axis = np.ones_like(mean)
+    for _ in range(8):
+        axis = np.einsum("nij,nj->ni", covariance, axis)
+        axis /= np.maximum(np.linalg.norm(axis, axis=1, keepdims=True), 1e-12)
+    projections = np.einsum("nki,ni->nk", centered, axis)
+    color0 = packRGB565(np.clip(mean + axis * projections.max(axis=1, keepdims=True), 0, 255))
+    color1 = packRGB565(np.clip(mean + axis * projections.min(axis=1, keepdims=True), 0, 255))
+    # color0 > color1 selects the 4 color mode, equal end points give a flat block either way
+    color0, color1 = np.maximum(color0, color1), np.minimum(color0, color1)
+
+    end0, end1 = unpackRGB565(color0), unpackRGB565(color1)
+    palette = np.stack([end0, end1, (2 * end0 + end1) / 3, (end0 + 2 * end1) / 3], axis=1)
+    indices = np.argmin(((texels[:, :, None, :] - palette[:, None, :, :]) ** 2).sum(axis=-1), axis=-1)
+    indices[color0 == color1] = 0
+    bits = (indices.astype(np.uint32) << (2 * np.arange(16, dtype=np.uint32))).sum(axis=1, dtype=np.uint32)
+
+    blocks = np.empty(len(texels), dtype=[("color0", "<u2"), ("color1", "<u2"), ("indices", "<u4")])
+    blocks["color0"], blocks["color1"], blocks["indices"] = color0, color1, bits
+    return blocks.tobytes()
+
+
+def encodeBC4(values) -> np.ndarray:
+    """
+    BC4 (RGTC1) blocks of one channel: the largest and smallest value of the block and a 3 bit index per texel
+    into the 8 values between them
+
+    :param values: (blocks, 16) channel values
+    :return: (blocks, 8) uint8
+    """
+    high = np.rint(values.max(axis=1))
+    low = np.rint(values.min(axis=1))
+    weights = np.array([7, 0, 6, 5, 4, 3, 2, 1], dtype=np.float32) / 7
+    palette = high[:, None] * weights + low[:, None] * (1 - weights)
+    indices = np.argmin(np.abs(values[:, :, None] - palette[:, None, :]), axis=-1)
+    indices[high == low] = 0
+    bits = (indices.astype(np.uint64) << (3 * np.arange(16, dtype=np.uint64))).sum(axis=1, dtype=np.uint64)
+
+    blocks = np.empty((len(values), 8), dtype=np.uint8)
+    blocks[:, 0], blocks[:, 1] = high, low
+    blocks[:, 2:] = (bits[:, None] >> (8 * np.arange(6, dtype=np.uint64))) & 0xFF
+    return blocks
+
+
+def encodeBC5(image) -> bytes:
+    """
+    BC5 (RGTC2) blocks of an image, its red and green channels as two BC4 blocks
+    """
+    texels = imageBlocks(image[..., 0:2])
+    return np.concatenate([encodeBC4(texels[..., 0]), encodeBC4(texels[..., 1])], axis=1).tobytes()
+
+
+class AssetPack:
+    """
+    A memory-mapped asset pack. Level arrays returned by levels() are read-only views of the mapping, the file stays
+    mapped as long as any of them is alive
+    """
+    magic = b"TXPK"
+    version = 1
+    headerFormat = "<4sIQQ"  # magic, version, index offset, index length
+    alignment = 16  # level blobs start at multiples of this
+    imageExtensions = (".png", ".jpg", ".jpeg", ".bmp", ".tga")
+    encoders = {"bc1": encodeBC1, "bc5": encodeBC5}  # block compressed format -> encoder
+    normalMapPattern = "*norm*"  # files baked as normal maps
+
+    path = None
+    directory = None  # file names in the index are relative to it
+    buffer = None  # mmap of the whole file
+    index = None  # dict, file name -> entry, see bake
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.directory = os.path.dirname(self.path)
+        with open(self.path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, indexOffset, indexLength = struct.unpack_from(self.headerFormat, self.buffer, 0)
+        if magic != self.magic or version != self.version:
+            raise ValueError(f"{path} is not a version {self.version} asset pack")
+        self.index = json.loads(self.buffer[indexOffset:indexOffset + indexLength].decode("utf-8"))
+
+    def entry(self, imagePath):
+        """
+        :return: the index entry of an image file, None if it isn't in the pack or changed since it was baked
+        """
+        name = os.path.relpath(os.path.abspath(imagePath), self.directory).replace(os.sep, "/")
+        entry = self.index.get(name)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(imagePath)
+        except OSError:
+            return None
+        if stat.st_size != entry["size"] or stat.st_mtime_ns != entry["mtime"]:
+            return None
+        return entry
+
+    def levels(self, imagePath):
+        """
+        Mip chain of an image file, level 0 first
+
+        :return: list of uint8 (height, width, channels) arrays bottom row first, or None if the pack can't be used
+        """
+        entry = self.entry(imagePath)
+        if entry is None:
+            return None
+        channels = entry["channels"]
+        return [np.frombuffer(self.buffer, np.uint8, width * height * channels, offset).reshape(height, width,
+                                                                                                  channels)
+                for offset, width, height in entry["levels"]]
+
+    def compressedLevels(self, imagePath):
+        """
+        Block compressed mip chain of an image file, level 0 first
+
+        :return: (format, list of (width, height, uint8 array of the blocks)), or None if the pack can't be used
+        """
+        entry = self.entry(imagePath)
+        if entry is None or "compressed" not in entry:
+            return None
+        compressed = entry["compressed"]
+        return compressed["format"], [(width, height, np.frombuffer(self.buffer, np.uint8, size, offset))
+                                      for offset, width, height, size in compressed["levels"]]
+
+    @staticmethod
+    def mipChain(image: np.ndarray) -> list:
+        """
+        Every mip level of an image down to 1x1, box filtered, sizes halved and rounded down like OpenGL does
+        """
+        levels = [image]
+        while image.shape[0] > 1 or image.shape[1] > 1:
+            height, width = max(1, image.shape[0] // 2), max(1, image.shape[1] // 2)
+            image = np.asarray(Image.fromarray(image).resize((width, height), Image.BOX), dtype=np.uint8)
+            levels.append(image)
+        return levels
+
+    @classmethod
+    def bake(cls, assetDir, output, compress=True) -> dict:
+        """
+        Write the pack of every image in assetDir. Images are decoded exactly like TextureCache decodes them
+
+        :param compress: also store the block compressed levels, BC5 for the files matching normalMapPattern and
+            BC1 for the others
+        :return: the index written
+        """
+        output = os.path.abspath(output)
+        directory = os.path.dirname(output)
+        index = {}
+        with open(output, "wb") as f:
+            f.write(struct.pack(cls.headerFormat, cls.magic, cls.version, 0, 0))
+            for fileName in sorted(os.listdir(assetDir)):
+                imagePath = os.path.join(assetDir, fileName)
+                if not fileName.lower().endswith(cls.imageExtensions) or not os.path.isfile(imagePath):
+                    continue
+                image = decodeImage(imagePath)
+                chain = cls.mipChain(image)
+                levels = []
+                for level in chain:
+                    f.write(b"\0" * (-f.tell() % cls.alignment))
+                    levels.append((f.tell(), level.shape[1], level.shape[0]))
+                    f.write(np.ascontiguousarray(level).tobytes())
+                stat = os.stat(imagePath)
+                name = os.path.relpath(os.path.abspath(imagePath), directory).replace(os.sep, "/")
+                index[name] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "width": image.shape[1],
+                               "height": image.shape[0], "channels": image.shape[2], "levels": levels}
+                if compress:
+                    blockFormat = "bc5" if fnmatch.fnmatch(fileName.lower(), cls.normalMapPattern) else "bc1"
+                    compressedLevels = []
+                    for level in chain:
+                        blocks = cls.encoders[blockFormat](level)
+                        f.write(b"\0" * (-f.tell() % cls.alignment))
+                        compressedLevels.append((f.tell(), level.shape[1], level.shape[0], len(blocks)))
+                        f.write(blocks)
+                    index[name]["compressed"] = {"format": blockFormat, "levels": compressedLevels}
+            indexData = json.dumps(index).encode("utf-8")
+            indexOffset = f.tell()
+            f.write(indexData)
+            f.seek(0)
+            f.write(struct.pack(cls.headerFormat, cls.magic, cls.version, indexOffset, len(indexData)))
+        return index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bake the texture assets into a memory-mappable pack")
+    parser.add_argument("--assets", default="assets", help="folder of the image files")
+    parser.add_argument("--output", default=None, help="pack file, default assets.pack in the assets folder")
+    parser.add_argument("--no-compress", action="store_true", help="only store uncompressed levels")
+    args = parser.parse_args(argv)
+    output = args.output or os.path.join(args.assets, "assets.pack")
+
+    start = time.perf_counter()
+    index = AssetPack.bake(args.assets, output, not args.no_compress)
+    print(f"Baked {len(index)} images into {output}, {os.path.getsize(output) / 2 ** 20:.1f} MB, "
+          f"in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""
+Bounding volume hierarchy over axis aligned boxes, stored as flat NumPy arrays. Built top-down with the binned
+surface area heuristic and traversed by packets of rays: every node visit tests the whole set of rays still alive
+in that subtree at once, so the Python overhead is per node, not per ray.
+
+When the boxes move but the set of primitives stays the same, refit updates the node boxes bottom-up in place of a
+new build.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import numpy as np
+
+
+class BVH:
+    """
+    Node 0 is the root. Nodes are stored in depth-first order, so children always come after their parent.
+    Leaves reference a contiguous range of primIndices
+    """
+    nodeMins = None  # (M, 3) node boxes
+    nodeMaxs = None  # (M, 3)
+    children = None  # int (M, 2), left and right child, -1 for leaves
+    firsts = None  # int (M,), first entry of the leaf in primIndices
+    counts = None  # int (M,), number of primitives of the leaf, 0 for inner nodes
+    primIndices = None  # int (N,), primitives in leaf order
+
+    leafSize = 4  # nodes with this many primitives or less are not split
+    binNum = 12  # candidate split planes per axis
+
+    # statistics of the last traverse call
+    nodeVisits = 0
+    leafVisits = 0
+
+    def __init__(self, mins, maxs, leafSize=4):
+        """
+        :param mins: (N, 3) lower corners of the primitive boxes
+        :param maxs: (N, 3) upper corners of the primitive boxes
+        :param leafSize: see leafSize
+        """
+        self.leafSize = leafSize
+        self.build(mins, maxs)
+
+    @staticmethod
+    def surfaceArea(mins, maxs):
+        extents = np.maximum(maxs - mins, 0)
+        return 2 * (extents[..., 0] * extents[..., 1] + extents[..., 1] * extents[..., 2] +
+                    extents[..., 2] * extents[..., 0])
+
+    def split(self, mins, maxs, centers):
+        """
+        Best binned SAH split of one node's primitives
+
+        :return: bool mask of the primitives going left, None if the node should stay a leaf
+        """
+        count = len(centers)
+        low = centers.min(axis=0)
+        extents = centers.max(axis=0) - low
+        leafCost = count * self.surfaceArea(mins.min(axis=0), maxs.max(axis=0))
+        bestCost = np.inf
+        best = None
+        for axis in range(3):
+            if extents[axis] <= 0:
+                continue
+            bins = np.minimum((centers[:, axis] - low[axis]) / extents[axis] * self.binNum,
+                              self.binNum - 1).astype(np.int64)
+            binCounts = np.bincount(bins, minlength=self.binNum)
+            binMins = np.full((self.binNum, 3), np.inf)
+            binMaxs = np.full((self.binNum, 3), -np.inf)
+            np.minimum.at(binMins, bins, mins)
+            np.maximum.at(binMaxs, bins, maxs)
+
+            # cost of splitting after bin i, from prefix and suffix bounds
+            leftCounts = np.cumsum(binCounts)[:-1]
+            rightCounts = count - leftCounts
+            leftAreas = self.surfaceArea(np.minimum.accumulate(binMins)[:-1], np.maximum.accumulate(binMaxs)[:-1])
+            rightAreas = self.surfaceArea(np.minimum.accumulate(binMins[::-1])[::-1][1:],
+                                          np.maximum.accumulate(binMaxs[::-1])[::-1][1:])
+            costs = np.where((leftCounts > 0) & (rightCounts > 0),
+                             leftCounts * leftAreas + rightCounts * rightAreas, np.inf)
+            i = int(np.argmin(costs))
+            if costs[i] < bestCost:
+                bestCost = costs[i]
+                best = bins <= i
+        if best is None:
+            # every center at the same point, split by count so big leaves still get divided
+            if count <= 2 * self.leafSize:
+                return None
+            best = np.arange(count) < count // 2
+        elif bestCost >= leafCost and count <= 2 * self.leafSize:
+            return None
+        return best
+
+    def build(self, mins, maxs):
+        mins = np.asarray(mins, dtype=np.float64).reshape(-1, 3)
+        maxs = np.asarray(maxs, dtype=np.float64).reshape(-1, 3)
+        centers = (mins + maxs) / 2
+        order = np.arange(len(mins))
+        nodeMins, nodeMaxs, children, firsts, counts = [], [], [], [], []
+
+        def newNode(start, end):
+            prims = order[start:end]
+            nodeMins.append(mins[prims].min(axis=0) if len(prims) else np.zeros(3))
+            nodeMaxs.append(maxs[prims].max(axis=0) if len(prims) else np.zeros(3))
+            children.append([-1, -1])
+            firsts.append(start)
+            counts.append(end - start)
+            return len(children) - 1
+
+        stack = [(newNode(0, len(order)), 0, len(order))]
+        while stack:
+            node, start, end = stack.pop()
+            if end - start <= self.leafSize:
+                continue
+            prims = order[start:end]
+            left = self.split(mins[prims], maxs[prims], centers[prims])
+            if left is None:
+                continue
+            middle = start + int(np.count_nonzero(left))
+            order[start:end] = np.concatenate([prims[left], prims[~left]])
+            children[node] = [newNode(start, middle), newNode(middle, end)]
+            counts[node] = 0
+            stack.append((children[node][1], middle, end))
+            stack.append((children[node][0], start, middle))
+
+        self.nodeMins = np.array(nodeMins)
+        self.nodeMaxs = np.array(nodeMaxs)
+        self.children = np.array(children, dtype=np.int64)
+        self.firsts = np.array(firsts, dtype=np.int64)
+        self.counts = np.array(counts, dtype=np.int64)
+        self.primIndices = order
+
+    def refit(self, mins, maxs):
+        """
+        Recompute the node boxes for new primitive boxes, keeping the tree
+        """
+        mins = np.asarray(mins, dtype=np.float64).reshape(-1, 3)
+        maxs = np.asarray(maxs, dtype=np.float64).reshape(-1, 3)
+        leaves = np.nonzero(self.counts > 0)[0]
+        if len(leaves):
+            # leaves cover contiguous, ordered ranges of primIndices
+            starts = self.firsts[leaves]
+            leafOrder = np.argsort(starts)
+            ordered = leaves[leafOrder]
+            self.nodeMins[ordered] = np.minimum.reduceat(mins[self.primIndices], starts[leafOrder])
+            self.nodeMaxs[ordered] = np.maximum.reduceat(maxs[self.primIndices], starts[leafOrder])
+        # children come after their parent, so a reverse sweep sees them first
+        for node in np.nonzero(self.counts == 0)[0][::-1]:
+            left, right = self.children[node]
+            if left < 0:
+                continue
+            self.nodeMins[node] = np.minimum(self.nodeMins[left], self.nodeMins[right])
+            self.nodeMaxs[node] = np.maximum(self.nodeMaxs[left], self.nodeMaxs[right])
+
+    def boxHits(self, node, origins, invDirs, t):
+        """
+        Slab test of rays against one node
+
+        :return: bool mask of the rays entering the box before t, and their entry distances
+        """
+        t1 = (self.nodeMins[node] - origins) * invDirs
+        t2 = (self.nodeMaxs[node] - origins) * invDirs
+        near = np.minimum(t1, t2).max(axis=1)
+        far = np.maximum(t1, t2).min(axis=1)
+        return (far >= np.maximum(near, 0)) & (near < t), near
+
+    def traverse(self, origins, dirs, t, visitLeaf, finished=None):
+        """
+        Visit, front to back, every leaf a packet of rays may hit
+
+        :param dirs: (N, 3) ray directions, not necessarily normalized
+        :param t: (N,) closest hits found so far, visitLeaf lowers it and the traversal culls with it
+        :param visitLeaf: function(rows, primIndices) intersecting rays of the given rows with a leaf's primitives
+        :param finished: bool (N,), rays set here by visitLeaf are dropped, for any hit queries
+        """
+        self.nodeVisits = self.leafVisits = 0
+        if len(origins) == 0 or len(self.primIndices) == 0:
+            return
+        invDirs = 1 / np.where(np.abs(dirs) < 1e-30, 1e-30, dirs)
+        rows = np.arange(len(origins))
+        hit, near = self.boxHits(0, origins, invDirs, t)
+        stack = [(0, rows[hit], near[hit])]
+        while stack:
+            node, rows, near = stack.pop()
+            # hits found since the node was pushed may be closer than its box
+            alive = near < t[rows]
+            if finished is not None:
+                alive &= ~finished[rows]
+            rows = rows[alive]
+            if len(rows) == 0:
+                continue
+            self.nodeVisits += 1
+            if self.counts[node] > 0:
+                self.leafVisits += 1
+                first = self.firsts[node]
+                visitLeaf(rows, self.primIndices[first:first + self.counts[node]])
+                continue
+
+            o = origins[rows]
+            inv = invDirs[rows]
+            visits = []
+            for child in self.children[node]:
+                childHit, near = self.boxHits(child, o, inv, t[rows])
+                if np.any(childHit):
+                    visits.append((float(np.mean(near[childHit])), child, rows[childHit], near[childHit]))
+            # the nearer child is popped first, its hits cull the other one
+            visits.sort(key=lambda visit: -visit[0])
+            stack.extend(visit[1:] for visit in visits)
@@ -0,0 +1,90 @@
+"""
+Micro benchmarks for the CPU side of the program. They don't need a window or an OpenGL context,
+run them with `python Benchmark.py`
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import random
+import time
+
+import ColorType as Ct
+from Component import Component
+from DisplayableCylinder import DisplayableCylinder
+from DisplayableEllipsoid import DisplayableEllipsoid
+from DisplayableSphere import DisplayableSphere
+from DisplayableTorus import DisplayableTorus
+from Point import Point
+from TransformGraph import TransformGraph
+
+
+def timeIt(func, repeat=3):
+    """
+    Run func several times and return the best wall time in seconds
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmarkMeshGeneration(tessellations=(36, 64, 128, 256, 512, 1024)):
+    """
+    Time Displayable.generate for every parametric primitive. Objects are created without __init__ so no
+    GL buffers are touched, only the vertex and index arrays are built.
+    """
+    generators = {
+        "sphere": (DisplayableSphere, lambda n: (1.0, n, n, Ct.WHITE)),
+        "ellipsoid": (DisplayableEllipsoid, lambda n: (0.5, 0.5, 0.9, n, n, Ct.WHITE)),
+        "torus": (DisplayableTorus, lambda n: (0.25, 0.5, n, n, Ct.WHITE)),
+        # cylinder only has one tessellation parameter, give it n * n sides to keep the vertex counts comparable
+        "cylinder": (DisplayableCylinder, lambda n: (0.3, 0.7, 1.0, n * n, Ct.WHITE)),
+    }
+    print(f"{'primitive':<12}{'tessellation':>14}{'vertices':>12}{'time (ms)':>12}")
+    for name, (cls, args) in generators.items():
+        for n in tessellations:
+            obj = cls.__new__(cls)
+            elapsed = timeIt(lambda: obj.generate(*args(n)))
+            print(f"{name:<12}{f'{n}x{n}':>14}{obj.vertices.shape[0]:>12}{elapsed * 1000:>12.2f}")
+
+
+def randomTree(nodes, branching=4):
+    random.seed(0)
+    components = [Component(Point((0, 0, 0)))]
+    for i in range(1, nodes):
+        c = Component(Point((random.random(), random.random(), random.random())))
+        c.setDefaultAngle(random.uniform(-90, 90), c.vAxis)
+        components[(i - 1) // branching].addChild(c)
+        components.append(c)
+    return components
+
+
+def benchmarkTransformUpdate(sizes=(100, 1000, 10000), repeat=3):
+    """
+    Time the transformation update of a frame where every component rotated, with the per-component update and
+    with TransformGraph. Calling the setters is not included
+    """
+    print(f"{'components':>10}{'Component (ms)':>16}{'TransformGraph (ms)':>21}")
+    for n in sizes:
+        components = randomTree(n)
+        root = components[0]
+
+        def updateAfterRotation():
+            best = float("inf")
+            for _ in range(repeat):
+                for c in components:
+                    c.setCurrentAngle(c.uAngle + 1, c.uAxis)
+                best = min(best, timeIt(root.update, repeat=1))
+            return best
+
+        perComponent = updateAfterRotation()
+        TransformGraph(root)
+        graph = updateAfterRotation()
+        print(f"{n:>10}{perComponent * 1000:>16.2f}{graph * 1000:>21.2f}")
+
+
+if __name__ == "__main__":
+    benchmarkMeshGeneration()
+    benchmarkTransformUpdate()
@@ -10,17 +10,19 @@ import math
 import os
 
 import numpy as np
-from PIL import Image
 
 import GLBuffer
-from GLProgram import GLProgram
+from GLProgram import GLProgram, variantKey
 from Material import Material
 from Point import Point
 from ColorType import ColorType
 from Displayable import Displayable
+from Frustum import Frustum
 from Quaternion import Quaternion
 from GLUtility import GLUtility
 from GLBuffer import Texture
+from GLState import GLState
+from TextureCache import TextureCache
 
 try:
     import OpenGL
@@ -50,9 +52,21 @@ except ImportError:
 
 class Component:
     children = None  # list
+    parent = None  # Component, set by addChild
 
     # the homogeneous transformation matrix for the current joint
     transformationMat = None
+    # (3, 3) column-major inverse transpose of transformationMat's linear part, computed with it, for the normals
+    normalMat = None
+
+    # transformation caching, see update
+    localMat = None  # everything in transformationMat except the parent's transformation
+    parentTransformationMat = None  # the parent matrix transformationMat was computed from
+    localDirty = True  # local transformation parameters changed since localMat was computed
+    subtreeDirty = True  # this component or one of its descendants must be recomputed by the next update
+    matrixUpdates = 0  # statistics, number of transformation matrices computed by all components
+    transformGraph = None  # TransformGraph storing this component's matrices, if its tree is attached to one
+    graphIndex = -1  # row of this component in transformGraph
 
     # a instance of class which inherit from Displayable
     # if this class is used as skeleton, then keep this empty
@@ -84,9 +98,10 @@ class Component:
     texture = None
     textureOn = False
     normalMap = None
-    normalMapOn = False
+    _normalMapOn = False
     material = None
-    renderingRouting = None
+    _renderingRouting = None
+    shaderKey = 0  # shader variant of renderingRouting and normalMapOn, kept up to date by their setters
 
     glUtility = None
 
@@ -128,8 +143,17 @@ class Component:
         self.preRotationMat = np.identity(4)
         self.postRotationMat = np.identity(4)
         self.material = Material()
-        self.texture = Texture()
-        self.normalMap = Texture()
+        # both stay None until setTexture / setNormalMap
+        self.texture = None
+        self.normalMap = None
+
+    def __del__(self):
+        try:
+            TextureCache.release(self.texture)
+            TextureCache.release(self.normalMap)
+        except (AttributeError, TypeError):
+            # interpreter shutdown, the module globals may already be gone
+            pass
 
     def addChild(self, child):
         """
@@ -145,6 +169,10 @@ class Component:
         # prevent the duplicate child to be added to the self.children
         if child not in self.children:
             self.children.append(child)
+            child.parent = self
+            self.markSubtreeDirty()
+            if self.transformGraph is not None:
+                self.transformGraph.markStructureDirty()
 
     def clear(self):
         """
@@ -154,6 +182,8 @@ class Component:
             c.clear()
             self.children.remove(c)
             del c
+        if self.transformGraph is not None:
+            self.transformGraph.markStructureDirty()
 
     def initialize(self):
         """
@@ -173,55 +203,116 @@ class Component:
 
     def draw(self, shaderProg: GLProgram):
         if isinstance(self.displayObj, Displayable):
-            shaderProg.setMat4("modelMat", self.transformationMat)
-            shaderProg.setVec4("diffuse", self.material.diffuse)
-            shaderProg.setVec4("specular", self.material.specular)
-            shaderProg.setVec4("ambient", self.material.ambient)
-            shaderProg.setFloat("highlight", self.material.highLight)
-            shaderProg.setFragmentShaderRouting(self.renderingRouting)
-            if self.textureOn:
-                shaderProg.use()
-                self.texture.bind(shaderProg.getUniformLocation("textureImage"))
-            else:
-                shaderProg.use()
-                self.texture.unbind(shaderProg.getUniformLocation("textureImage"))
-            if self.normalMapOn:
-                shaderProg.use()
-                shaderProg.setBool("useNormalMap", True)
-                self.normalMap.bind(shaderProg.getUniformLocation("normalMap"))
-            else:
-                shaderProg.use()
-                shaderProg.setBool("useNormalMap", False)
-                self.normalMap.unbind(shaderProg.getUniformLocation("normalMap"))
+            shaderProg.setModelMat(self.transformationMat, self.normalMat)
+            self.setMaterialUniforms(shaderProg)
+            self.bindDrawState(shaderProg)
             self.displayObj.draw()
 
         for c in self.children:
             c.draw(shaderProg)
 
-    def update(self, parentTransformationMat=None):
+    def setMaterialUniforms(self, shaderProg: GLProgram):
+        shaderProg.setVec4("diffuse", self.material.diffuse)
+        shaderProg.setVec4("specular", self.material.specular)
+        shaderProg.setVec4("ambient", self.material.ambient)
+        shaderProg.setFloat("highlight", self.material.highLight)
+
+    def bindDrawState(self, shaderProg: GLProgram):
         """
-        Apply translation, rotation and scaling to this component and all its children
-        all matrix are stored in column-major order
-        Must be called after any changes made to the instance
+        Set up rendering routing, texture and normal map of this component before its mesh is drawn
+        """
+        shaderProg.useVariant(self.shaderKey)
+        shaderProg.use()
+        # texture units are handed out per draw, the two textures of a draw never share one
+        GLState.beginTextureBatch()
+        if self.textureOn and self.texture is not None:
+            self.texture.bind(shaderProg.getUniformLocation("textureImage"))
+        else:
+            Texture.unbind(shaderProg.getUniformLocation("textureImage"))
+        if self.normalMapOn and self.normalMap is not None:
+            self.normalMap.bind(shaderProg.getUniformLocation("normalMap"))
+            shaderProg.setBool("normalMapRG", self.normalMap.compressedFormat == gl.GL_COMPRESSED_RG_RGTC2)
+        else:
+            Texture.unbind(shaderProg.getUniformLocation("normalMap"))
 
-        :return: None
+    def invalidate(self):
         """
-        if parentTransformationMat is None:
-            parentTransformationMat = np.identity(4)
+        Mark the local transformation of this component out of date. Every setter changing position, angles, axes
+        or scaling calls this, the matrices are recomputed lazily by the next update
 
+        :return: None
+        """
+        self.localDirty = True
+        self.markSubtreeDirty()
+        if self.transformGraph is not None:
+            self.transformGraph.markDirty(self.graphIndex)
+
+    def markSubtreeDirty(self):
+        # a dirty component always has dirty ancestors, so the walk can stop at the first one already marked
+        c = self
+        while c is not None and not c.subtreeDirty:
+            c.subtreeDirty = True
+            c = c.parent
+
+    def localTransformation(self):
+        """
+        Translation, rotation and scaling of this component relative to its parent, in column-major order
+        """
         translationMat = self.glUtility.translate(*self.currentPos.getCoords())
         rotationMatU = self.glUtility.rotate(self.uAngle, self.uAxis)
         rotationMatV = self.glUtility.rotate(self.vAngle, self.vAxis)
         rotationMatW = self.glUtility.rotate(self.wAngle, self.wAxis)
         scalingMat = self.glUtility.scale(*(min(self.currentScaling) * np.ones(3)))
 
-        # remember that all above matrix are store in column-major, which is the transpose of row-major
-        # be careful about the applying order
-        self.transformationMat = scalingMat @ self.preRotationMat @ rotationMatW @ rotationMatV @ rotationMatU @ \
-                                 self.postRotationMat @ translationMat @ parentTransformationMat
+        return scalingMat @ self.preRotationMat @ rotationMatW @ rotationMatV @ rotationMatU @ \
+            self.postRotationMat @ translationMat
+
+    def update(self, parentTransformationMat=None):
+        """
+        Apply translation, rotation and scaling to this component and all its children
+        all matrix are stored in column-major order
+        Local and world matrices are cached, only components changed through setters since the last update, or
+        whose parent matrix changed, are recomputed. Subtrees with nothing to do are skipped entirely
+
+        :return: None
+        """
+        if self.transformGraph is not None:
+            # only the root of the graph decides the parent transformation of the whole tree
+            self.transformGraph.update(parentTransformationMat if self is self.transformGraph.root else None)
+            return
+
+        if parentTransformationMat is None:
+            parentTransformationMat = np.identity(4)
+
+        parentChanged = parentTransformationMat is not self.parentTransformationMat and \
+            not (self.parentTransformationMat is not None and
+                 np.array_equal(parentTransformationMat, self.parentTransformationMat))
+        if not (parentChanged or self.subtreeDirty):
+            return
+
+        if self.localDirty or parentChanged or self.transformationMat is None:
+            if self.localDirty or self.localMat is None:
+                self.localMat = self.localTransformation()
+                self.localDirty = False
+            # remember that all above matrix are store in column-major, which is the transpose of row-major
+            # be careful about the applying order
+            self.transformationMat = self.localMat @ parentTransformationMat
+            self.normalMat = self.glUtility.normalMatrix(self.transformationMat)
+            self.parentTransformationMat = parentTransformationMat
+            Component.matrixUpdates += 1
 
         for c in self.children:
             c.update(self.transformationMat)
+        self.subtreeDirty = False
+
+    def worldBounds(self):
+        """
+        World-space bounds of displayObj with the current transformation
+
+        :return: bounding sphere center, bounding sphere radius and AABB half extents
+        """
+        centers, radii, halfExtents = Frustum.worldBounds([self])
+        return centers[0], radii[0], halfExtents[0]
 
     def rotate(self, angle, axis):
         """
@@ -260,6 +351,7 @@ class Component:
             self.setU([1, 0, 0])
             self.setV([0, 1, 0])
             self.setW([0, 0, 1])
+        self.invalidate()
 
     def setRotateExtent(self, axis, minDeg=None, maxDeg=None):
         """
@@ -309,14 +401,16 @@ class Component:
         return result
 
     def setTexture(self, shaderProg: GLProgram, imgFilePath, textureOn=True):
-        # apply texturek
+        # apply texture, shared with every component using the same file and loaded in the background,
+        # see TextureCache
         if not os.path.isfile(imgFilePath):
             raise TypeError("Image File doesn't exist")
 
         shaderProg.use()
-        texture_image = Image.open(imgFilePath).convert("RGB")
-        texture_image = np.array(texture_image, dtype=np.uint8)
-        self.texture.setTextureImage(texture_image)
+        # acquire before release, so setting the same file again is a cache hit
+        texture = TextureCache.acquire(imgFilePath)
+        TextureCache.release(self.texture)
+        self.texture = texture
         self.textureOn = textureOn
 
     def setNormalMap(self, shaderProg: GLProgram, imgFilePath, normalMapOn=True):
@@ -325,9 +419,9 @@ class Component:
             raise TypeError("Image File doesn't exist")
 
         shaderProg.use()
-        normalMap = Image.open(imgFilePath).convert("RGB")
-        normalMap = np.array(normalMap, dtype=np.uint8)
-        self.normalMap.setTextureImage(normalMap)
+        normalMap = TextureCache.acquire(imgFilePath, placeholder=TextureCache.placeholderNormal)
+        TextureCache.release(self.normalMap)
+        self.normalMap = normalMap
         self.normalMapOn = normalMapOn
 
     def setMaterial(self, material: Material):
@@ -338,6 +432,24 @@ class Component:
     def setRenderingRouting(self, v):
         self.renderingRouting = v
 
+    @property
+    def renderingRouting(self):
+        return self._renderingRouting
+
+    @renderingRouting.setter
+    def renderingRouting(self, routing):
+        self._renderingRouting = routing
+        self.shaderKey = variantKey(routing, self._normalMapOn)
+
+    @property
+    def normalMapOn(self) -> bool:
+        return self._normalMapOn
+
+    @normalMapOn.setter
+    def normalMapOn(self, value: bool):
+        self._normalMapOn = value
+        self.shaderKey = variantKey(self._renderingRouting, value)
+
     def setCurrentAngle(self, angle, axis):
         if axis not in self.axisBucket:
             raise TypeError("unknown axis for rotation")
@@ -349,7 +461,7 @@ class Component:
             self.vAngle = self.clamp(angle, self.vRange[0], self.vRange[1])
         else:
             self.wAngle = self.clamp(angle, self.wRange[0], self.wRange[1])
-        self.update()
+        self.invalidate()
 
     def setDefaultAngle(self, angle, axis):
         """
@@ -370,6 +482,7 @@ class Component:
         else:
             self.default_wAngle = angle
             self.wAngle = angle
+        self.invalidate()
 
     def setDefaultPosition(self, pos):
         """
@@ -382,6 +495,7 @@ class Component:
             raise TypeError("pos should have type Point")
         self.defaultPos = pos.copy()
         self.currentPos = copy.deepcopy(self.defaultPos)
+        self.invalidate()
 
     def setDefaultScale(self, scale):
         """
@@ -397,7 +511,7 @@ class Component:
             raise ValueError("Component only accept uniform scaling")
         self.defaultScaling = copy.deepcopy(scale)
         self.currentScaling = copy.deepcopy(self.defaultScaling)
-        self.update()
+        self.invalidate()
 
     def setCurrentPosition(self, pos):
         """
@@ -409,7 +523,7 @@ class Component:
         if not isinstance(pos, Point):
             raise TypeError("pos should have type Point")
         self.currentPos = pos.copy()
-        self.update()
+        self.invalidate()
 
     def setCurrentScale(self, scale):
         """
@@ -424,7 +538,7 @@ class Component:
         if min(scale) != max(scale):
             raise ValueError("Component only accept uniform scaling")
         self.currentScaling = copy.deepcopy(scale)
-        self.update()
+        self.invalidate()
 
     def changeRotationAxis(self, u, v, w):
         """
@@ -456,6 +570,7 @@ class Component:
         self.uAngle = 0
         self.vAngle = 0
         self.wAngle = 0
+        self.invalidate()
 
     def setPreRotation(self, rotation_matrix=None):
         """
@@ -467,6 +582,7 @@ class Component:
         """
         if isinstance(rotation_matrix, np.ndarray):
             self.preRotationMat = rotation_matrix
+            self.invalidate()
 
     def u(self):
         return self.uAxis.copy()
@@ -482,15 +598,18 @@ class Component:
             raise TypeError("axis should have the same size as the current one")
         for i in range(len(u)):
             self.uAxis[i] = u[i]
+        self.invalidate()
 
     def setV(self, v):
         if len(v) != len(self.vAxis):
             raise TypeError("axis should have the same size as the current one")
         for i in range(len(v)):
             self.vAxis[i] = v[i]
+        self.invalidate()
 
     def setW(self, w):
         if len(w) != len(self.wAxis):
             raise TypeError("axis should have the same size as the current one")
         for i in range(len(w)):
             self.wAxis[i] = w[i]
+        self.invalidate()
@@ -5,17 +5,164 @@ First version in 09/26/2018
 :author: micou(Zezhou Sun)
 :version: 2021.1.1
 """
+import numpy as np
+
+from GeometryCache import GeometryCache, SharedMesh
 
 
 class Displayable:
     """
     Interface for displayable object
     """
+    shaderProg = None
+
+    vertices = None  # array to store vertices information
+    indices = None  # stores triangle indices to vertices
+
+    mesh: SharedMesh = None  # GPU buffers, shared with every Displayable that generated the same arrays
+
+    # bounding volumes in object space, see computeBounds
+    aabbMin = None  # numpy.ndarray(3)
+    aabbMax = None  # numpy.ndarray(3)
+    boundingCenter = None  # numpy.ndarray(3), center of the AABB
+    boundingRadius = None  # float, radius of the sphere around boundingCenter enclosing every vertex
+
+    # coarser tessellations are taken as the intended shape, like the triangular torus of SceneFour's ball rack
+    minSmoothSegments = 12
+
     def __init__(self):
         pass
 
+    def __del__(self):
+        try:
+            if self.mesh is not None:
+                GeometryCache.release(self.mesh)
+        except (AttributeError, TypeError):
+            # interpreter shutdown, the module globals may already be gone
+            pass
+
+    def __getstate__(self):
+        # the GPU side only exists in the process owning the OpenGL context
+        state = self.__dict__.copy()
+        state.pop("shaderProg", None)
+        state.pop("mesh", None)
+        return state
+
     def draw(self):
         raise NotImplementedError
 
     def initialize(self):
         raise NotImplementedError
+
+    def hasAnalyticSurface(self) -> bool:
+        """
+        True when intersectRays and surfaceAt describe this object better than its triangles
+        """
+        return False
+
+    def intersectRays(self, origins, dirs, tMin, tMax):
+        """
+        Exact hits of rays with the analytic surface this object tessellates, in object space. Displayables
+        without an analytic form leave this out and ray tracers use their triangles
+
+        :param origins: (N, 3) ray origins
+        :param dirs: (N, 3) ray directions, not necessarily normalized
+        :param tMin: hits at or before this ray parameter are ignored
+        :param tMax: (N,) hits at or beyond this ray parameter are ignored
+        :return: t (N,), inf for misses, and int (N,) index of the surface part hit, see surfaceAt
+        """
+        raise NotImplementedError
+
+    def surfaceAt(self, points, parts):
+        """
+        Attributes of object space points on the analytic surface, the same as the generated vertices would give
+
+        :param parts: (N,) surface parts, as returned by intersectRays
+        :return: (N, 3) normals, not normalized, and (N, 2) texture coordinates
+        """
+        raise NotImplementedError
+
+    def surfaceRadius(self) -> float:
+        """
+        Radius of the sphere around the object space origin enclosing the analytic surface
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def quadraticRoots(a, b, c):
+        """
+        Real roots of a * t^2 + b * t + c = 0 for arrays of coefficients, in the numerically stable form
+
+        :return: (N, 2) roots, nan where there is none
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            q = -0.5 * (b + np.copysign(np.sqrt(b * b - 4 * a * c), b))
+            return np.stack([q / a, c / q], axis=1)
+
+    @staticmethod
+    def nearestRoots(roots, tMin, tMax):
+        """
+        Pick the closest candidate hit of every ray
+
+        :param roots: (N, K) candidate ray parameters, nan where there is none
+        :return: t (N,), inf where no candidate is inside (tMin, tMax), and the column of the chosen candidate
+        """
+        with np.errstate(invalid="ignore"):
+            roots = np.where((roots > tMin) & (roots < tMax[:, None]), roots, np.inf)
+        column = np.argmin(roots, axis=1)
+        return roots[np.arange(len(roots)), column], column
+
+    def acquireMesh(self):
+        """
+        Bind this object to the shared GPU mesh of its current vertices and indices, uploading it if needed.
+        Call this from initialize; if generate was called again in between, the old mesh is released.
+        """
+        if self.mesh is not None:
+            if self.mesh.vertices is self.vertices and self.mesh.indices is self.indices:
+                self.mesh.initialize(self.shaderProg)
+                return
+            GeometryCache.release(self.mesh)
+        self.mesh = GeometryCache.acquire(self)
+        # drop our own copy of the arrays, the cached ones are identical
+        self.vertices = self.mesh.vertices
+        self.indices = self.mesh.indices
+        self.mesh.initialize(self.shaderProg)
+
+    def computeBounds(self):
+        """
+        Compute the AABB and bounding sphere of the vertex positions. Call this at the end of generate
+        """
+        positions = np.asarray(self.vertices, dtype=np.float64)[:, 0:3]
+        if positions.shape[0] == 0:
+            self.aabbMin = self.aabbMax = self.boundingCenter = np.zeros(3)
+            self.boundingRadius = 0.0
+            return
+        self.aabbMin = positions.min(axis=0)
+        self.aabbMax = positions.max(axis=0)
+        self.boundingCenter = (self.aabbMin + self.aabbMax) / 2
+        self.boundingRadius = float(np.sqrt(np.max(np.sum((positions - self.boundingCenter) ** 2, axis=1))))
+
+    @staticmethod
+    def gridIndices(rows: int, columns: int) -> np.ndarray:
+        """
+        Triangle indices for a (rows x columns) parametric vertex grid stored in C order.
+        Every grid cell (i, j) emits two CCW triangles, wrapping around on the last row and column:
+        (i, j), (i + 1, j), (i, j + 1) and (i + 1, j + 1), (i + 1, j), (i, j + 1)
+
+        :param rows: number of vertex rows in the grid
+        :param columns: number of vertex columns in the grid
+        :return: flattened uint32 index array with rows * columns * 6 elements
+        """
+        i = np.arange(rows, dtype=np.uint32)[:, None]
+        j = np.arange(columns, dtype=np.uint32)[None, :]
+        ip1 = (i + 1) % rows
+        jp1 = (j + 1) % columns
+
+        i_by_j = i * columns + j
+        ip1_by_j = ip1 * columns + j
+        i_by_jp1 = i * columns + jp1
+        ip1_by_jp1 = ip1 * columns + jp1
+
+        indices = np.stack([i_by_j, ip1_by_j, i_by_jp1,
+                            ip1_by_jp1, ip1_by_j, i_by_jp1], axis=-1)
+        return indices.flatten("C")
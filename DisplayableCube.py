@@ -7,7 +7,6 @@ First version in 10/20/2021
 """
 
 from Displayable import Displayable
-from GLBuffer import VAO, VBO, EBO
 import numpy as np
 import ColorType as Ct
 
@@ -38,9 +37,6 @@ except ImportError:
 
 
 class DisplayableCube(Displayable):
-    vao = None
-    vbo = None
-    ebo = None
     shaderProg = None
 
     vertices = None  # array to store vertices information
@@ -51,6 +47,7 @@ class DisplayableCube(Displayable):
     width = None
     height = None
     color = None
+    faceOfSide = np.array([[2, 3], [5, 4], [0, 1]])  # face hit on each axis, from the negative and positive side
 
     def __init__(self, shaderProg,
                  length: float = 1,
@@ -64,10 +61,6 @@ class DisplayableCube(Displayable):
         self.shaderProg = shaderProg
         self.shaderProg.use()
 
-        self.vao = VAO()
-        self.vbo = VBO()  # vbo can only be initiated with glProgram activated
-        self.ebo = EBO()
-
         self.generate(length, width, height, color,
                       texture_stretch, texture_x_unit, texture_y_unit)
 
@@ -176,27 +169,56 @@ class DisplayableCube(Displayable):
         ])
 
         self.indices = np.array(indices_def)
+        self.computeBounds()
+
+    def hasAnalyticSurface(self) -> bool:
+        return True
+
+    def intersectRays(self, origins, dirs, tMin, tMax):
+        """
+        Slab test. Surface parts are the faces, in the order of vertices: back, front, left, right, top, bottom
+        """
+        half = np.array([self.length, self.width, self.height], dtype=np.float64) / 2
+        dirs = np.where(np.abs(dirs) < 1e-300, 1e-300, dirs)
+        t1 = (-half - origins) / dirs
+        t2 = (half - origins) / dirs
+        near = np.minimum(t1, t2)
+        far = np.maximum(t1, t2)
+        nearAxis = np.argmax(near, axis=1)
+        farAxis = np.argmin(far, axis=1)
+        rows = np.arange(len(origins))
+        entry = near[rows, nearAxis]
+        exit = far[rows, farAxis]
+
+        roots = np.where((entry <= exit)[:, None], np.stack([entry, exit], axis=1), np.nan)
+        t, column = self.nearestRoots(roots, tMin, tMax)
+        # rays enter through the side facing them and leave through the other one
+        entering = column == 0
+        axis = np.where(entering, nearAxis, farAxis)
+        positive = (dirs[rows, axis] > 0) != entering
+        return t, self.faceOfSide[axis, positive.astype(np.int64)]
+
+    def surfaceAt(self, points, parts):
+        # every face is a rectangle with affine texture coordinates, corner 0 to 1 and corner 0 to 3 are its edges
+        faces = np.asarray(self.vertices, dtype=np.float64).reshape(6, 4, 11)[parts]
+        corner = faces[:, 0, 0:3]
+        edge1 = faces[:, 1, 0:3] - corner
+        edge3 = faces[:, 3, 0:3] - corner
+        s = np.sum((points - corner) * edge1, axis=1) / np.maximum(np.sum(edge1 * edge1, axis=1), 1e-300)
+        t = np.sum((points - corner) * edge3, axis=1) / np.maximum(np.sum(edge3 * edge3, axis=1), 1e-300)
+        uv = (faces[:, 0, 9:11] + s[:, None] * (faces[:, 1, 9:11] - faces[:, 0, 9:11]) +
+              t[:, None] * (faces[:, 3, 9:11] - faces[:, 0, 9:11]))
+        return faces[:, 0, 3:6], uv
+
+    def surfaceRadius(self) -> float:
+        return float(np.linalg.norm([self.length, self.width, self.height]) / 2)
 
     def draw(self):
-        self.vao.bind()
-        self.ebo.draw()
-        self.vao.unbind()
+        self.mesh.draw()
 
     def initialize(self):
         """
-        Remember to bind VAO before this initialization. If VAO is not bind, program might throw an error
-        in systems that don't enable a default VAO after GLProgram compilation
+        Upload this object's mesh. GL buffers come from GeometryCache, so identical meshes are only uploaded once
+        and share one VAO/VBO/EBO
         """
-        self.vao.bind()
-        self.vbo.setBuffer(self.vertices, 11)
-        self.ebo.setBuffer(self.indices)
-
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexPos"),
-                                  stride=11, offset=0, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexNormal"),
-                                  stride=11, offset=3, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexColor"),
-                                  stride=11, offset=6, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexTexture"),
-                                  stride=11, offset=9, attribSize=2)
-        self.vao.unbind()
+        self.acquireMesh()
@@ -4,7 +4,6 @@ Define displayable Cylinder here.
 from typing import Optional
 
 from Displayable import Displayable
-from GLBuffer import VAO, VBO, EBO
 import numpy as np
 import ColorType as Ct
 import math
@@ -36,9 +35,6 @@ except ImportError:
 
 
 class DisplayableCylinder(Displayable):
-    vao = None
-    vbo = None
-    ebo = None
     shaderProg = None
 
     vertices = None  # array to store vertices information
@@ -61,10 +57,6 @@ class DisplayableCylinder(Displayable):
         self.shaderProg = shaderProg
         self.shaderProg.use()
 
-        self.vao = VAO()
-        self.vbo = VBO()  # vbo can only be initiated with glProgram activated
-        self.ebo = EBO()
-
         self.generate(radius_lower,
                       radius_upper,
                       height,
@@ -112,91 +104,121 @@ class DisplayableCylinder(Displayable):
         # two for the curved surface of the side
         grp_size = 4
 
+        pi = np.pi
+        theta = np.linspace(-pi, pi, nsides_1)
+        cos_val = np.cos(theta)
+        sin_val = np.sin(theta)
+
+        # The sine and cosine of the angle between the lower and upper radii of the cylinder
+        # (used to calculate the normal vectors for the side surfaces)
+        cone_sin = (radius_lower - radius_upper) / height
+        cone_cos = np.sqrt(1 - cone_sin * cone_sin)
+
+        # Build all vertex groups at once, group i holds, in order:
+        #   0: lower cap rim, 1: lower side rim, 2: upper side rim, 3: upper cap rim
+        vGroups = np.zeros((nsides_1, grp_size, 11), dtype=np.float32)
+        vGroups[:, 0:2, 0] = (radius_lower * cos_val)[:, None]
+        vGroups[:, 0:2, 1] = (radius_lower * sin_val)[:, None]
+        vGroups[:, 0:2, 2] = -hh
+        vGroups[:, 2:4, 0] = (radius_upper * cos_val)[:, None]
+        vGroups[:, 2:4, 1] = (radius_upper * sin_val)[:, None]
+        vGroups[:, 2:4, 2] = hh
+
+        # the cap rims face straight down and up, the texture is a disk mapped onto the unit square
+        vGroups[:, 0, 5] = -1
+        vGroups[:, 3, 5] = 1
+        vGroups[:, 0::3, 9] = (cos_val * 0.5 + 0.5)[:, None]
+        vGroups[:, 0::3, 10] = (sin_val * 0.5 + 0.5)[:, None]
+
+        # UPDATE: side surface, we have to redefine the vertices above since they have different normals
+        vGroups[:, 1:3, 3] = (cos_val * cone_cos)[:, None]
+        vGroups[:, 1:3, 4] = (sin_val * cone_cos)[:, None]
+        vGroups[:, 1:3, 5] = cone_sin
+        vGroups[:, 1:3, 9] = (np.arange(nsides_1) / nsides)[:, None]
+        vGroups[:, 2, 10] = 1
+
+        vGroups[..., 6:9] = [*color]
+
         # The first two vertices are used to store the
         # centers of the upper and lower circles.
-        self.vertices = np.zeros((nsides_1 * grp_size + 2, 11), dtype=np.float32)
-
-        # lower circle center and upper circle center
-        self.vertices[0] = [0, 0, -hh, 0, 0, -1, *color, 0.5, 0.5]
-        self.vertices[1] = [0, 0, hh, 0, 0, 1, *color, 0.5, 0.5]
+        self.vertices = np.concatenate([
+            np.array([[0, 0, -hh, 0, 0, -1, *color, 0.5, 0.5],
+                      [0, 0, hh, 0, 0, 1, *color, 0.5, 0.5]], dtype=np.float32),
+            vGroups.reshape((-1, 11))])
 
         # The universal offset for the later vertices other than above two
         # centers
         vOffset = 2
+        grp = (vOffset + grp_size * np.arange(nsides_1, dtype=np.uint32))[:, None]
+        nxt = np.roll(grp, -1, axis=0)
+        lower_center = np.zeros_like(grp)
+        upper_center = np.ones_like(grp)
+
+        # lower cap, side quad as two triangles, upper cap
+        self.indices = np.hstack([
+            lower_center, grp, nxt,
+            grp + 1, grp + 2, nxt + 2,
+            grp + 1, nxt + 2, nxt + 1,
+            upper_center, grp + 3, nxt + 3]).astype(np.uint32)
 
-        self.indices = np.zeros((nsides_1, 12), dtype=np.uint32)
-
-        pi = np.pi
-
-        # The sine and cosine of the angle between the lower and upper radii of the cylinder
-        # (used to calculate the normal vectors for the side surfaces)
-        cone_sin = (radius_lower - radius_upper) / height
+        self.indices = self.indices.flatten("C")
+        self.computeBounds()
+
+    def hasAnalyticSurface(self) -> bool:
+        return self.nsides >= self.minSmoothSegments
+
+    def intersectRays(self, origins, dirs, tMin, tMax):
+        """
+        Surface parts: 0 for the side, 1 for the lower cap, 2 for the upper cap
+        """
+        hh = self.height / 2
+        # the radius grows linearly along z: r(z) = k0 + k1 * z
+        k1 = (self.radius_upper - self.radius_lower) / self.height
+        k0 = self.radius_lower + k1 * hh
+        ox, oy, oz = origins.T
+        dx, dy, dz = dirs.T
+        ro = k0 + k1 * oz
+
+        roots = np.empty((len(origins), 4))
+        # side: x^2 + y^2 = r(z)^2, between the caps
+        roots[:, 0:2] = self.quadraticRoots(dx * dx + dy * dy - k1 * k1 * dz * dz,
+                                            2 * (ox * dx + oy * dy - k1 * dz * ro),
+                                            ox * ox + oy * oy - ro * ro)
+        with np.errstate(invalid="ignore"):
+            z = oz[:, None] + roots[:, 0:2] * dz[:, None]
+            roots[:, 0:2] = np.where(np.abs(z) <= hh, roots[:, 0:2], np.nan)
+        # caps: the planes z = -hh and z = hh, inside their radius
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for column, capZ, radius in ((2, -hh, self.radius_lower), (3, hh, self.radius_upper)):
+                t = (capZ - oz) / dz
+                x = ox + t * dx
+                y = oy + t * dy
+                roots[:, column] = np.where(x * x + y * y <= radius * radius, t, np.nan)
+
+        t, column = self.nearestRoots(roots, tMin, tMax)
+        return t, np.maximum(column - 1, 0)
+
+    def surfaceAt(self, points, parts):
+        hh = self.height / 2
+        theta = np.arctan2(points[:, 1], points[:, 0])
+        cone_sin = (self.radius_lower - self.radius_upper) / self.height
         cone_cos = np.sqrt(1 - cone_sin * cone_sin)
-        for i, theta in enumerate(np.linspace(-pi, pi, nsides_1)):
-            cos_val = np.cos(theta)
-            sin_val = np.sin(theta)
-
-            # Calculate the coordinates of the points on the lower circle of the cylinder
-            x_lower = radius_lower * cos_val
-            y_lower = radius_lower * sin_val
-            z_lower = -hh
-
-            # Assign the coordinates of the point on the lower circle,
-            # the normal vector for the lower surface, and the texture coordinates
-            # to the appropriate vertex in the vertex group
-            self.vertices[vOffset + grp_size * i] = [
-                x_lower, y_lower, z_lower, 0, 0, -1, *color,
-                cos_val * 0.5 + 0.5, sin_val * 0.5 + 0.5]
-
-            ip1 = (i + 1) % nsides_1
-            self.indices[i, 0:3] = [0, vOffset + grp_size * i, vOffset + grp_size * ip1]
-
-            # Calculate the coordinates of the points on the upper circle of the cylinder
-            x_upper = radius_upper * cos_val
-            y_upper = radius_upper * sin_val
-            z_upper = hh
-
-            # UPDATE: side surface, we have to redefine the vertices above since they have different normals
-            # Assign the coordinates of the points on the upper and lower circles,
-            # the normal vector for the side surface, and the texture coordinates
-            # to the appropriate vertices in the vertex group
-            self.vertices[vOffset + grp_size * i + 1] = [
-                x_lower, y_lower, z_lower,
-                cos_val * cone_cos, sin_val * cone_cos, cone_sin, *color,
-                i / nsides, 0]
-            self.vertices[vOffset + grp_size * i + 2] = [
-                x_upper, y_upper, z_upper,
-                cos_val * cone_cos, sin_val * cone_cos, cone_sin, *color,
-                i / nsides, 1]
-            self.indices[i, 3:9] = [
-                vOffset + grp_size * i + 1, vOffset + grp_size * i + 2, vOffset + grp_size * ip1 + 2,
-                vOffset + grp_size * i + 1, vOffset + grp_size * ip1 + 2, vOffset + grp_size * ip1 + 1]
-
-            # Assign the indices of the vertices that make up the
-            # triangles on the upper surface of the cylinder
-            self.vertices[vOffset + grp_size * i + 3] = [
-                x_upper, y_upper, z_upper, 0, 0, 1, *color,
-                cos_val * 0.5 + 0.5, sin_val * 0.5 + 0.5]
-            self.indices[i, 9:12] = [1, vOffset + grp_size * i + 3, vOffset + grp_size * ip1 + 3]
+        normals = np.stack([np.cos(theta) * cone_cos, np.sin(theta) * cone_cos,
+                            np.full(len(points), cone_sin)], axis=1)
+        uv = np.stack([(theta + np.pi) / (2 * np.pi), (points[:, 2] + hh) / self.height], axis=1)
 
-        self.indices = self.indices.flatten("C")
+        # the caps map the disk onto the unit square
+        for part, sign, radius in ((1, -1, self.radius_lower), (2, 1, self.radius_upper)):
+            cap = parts == part
+            normals[cap] = (0, 0, sign)
+            uv[cap] = points[cap, 0:2] / radius * 0.5 + 0.5
+        return normals, uv
+
+    def surfaceRadius(self) -> float:
+        return float(np.hypot(max(self.radius_lower, self.radius_upper), self.height / 2))
 
     def draw(self):
-        self.vao.bind()
-        self.ebo.draw()
-        self.vao.unbind()
+        self.mesh.draw()
 
     def initialize(self):
-        self.vao.bind()
-        self.vbo.setBuffer(self.vertices, 11)
-        self.ebo.setBuffer(self.indices)
-
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexPos"),
-                                  stride=11, offset=0, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexNormal"),
-                                  stride=11, offset=3, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexColor"),
-                                  stride=11, offset=6, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexTexture"),
-                                  stride=11, offset=9, attribSize=2)
-        self.vao.unbind()
+        self.acquireMesh()
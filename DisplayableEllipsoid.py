@@ -3,7 +3,6 @@ Define displayable Ellipsoid here.
 """
 
 from Displayable import Displayable
-from GLBuffer import VAO, VBO, EBO
 import numpy as np
 import ColorType
 import math
@@ -35,9 +34,6 @@ except ImportError:
 
 
 class DisplayableEllipsoid(Displayable):
-    vao = None
-    vbo = None
-    ebo = None
     shaderProg = None
 
     vertices = None  # array to store vertices information
@@ -61,10 +57,6 @@ class DisplayableEllipsoid(Displayable):
         self.shaderProg = shaderProg
         self.shaderProg.use()
 
-        self.vao = VAO()
-        self.vbo = VBO()  # vbo can only be initiated with glProgram activated
-        self.ebo = EBO()
-
         self.generate(radius_x, radius_y, radius_z, slices, stacks, color)
 
     def generate(self,
@@ -100,54 +92,55 @@ class DisplayableEllipsoid(Displayable):
         slices_1 = slices + 1
         stacks_1 = stacks + 1
 
-        self.vertices = np.zeros((slices_1 * stacks_1, 11))
-        self.indices = np.zeros((slices_1 * stacks_1, 6), dtype=np.uint32)
-
-        # Loop through the ellipsoid's slices and stacks to generate vertices and indices
-        for i, phi in enumerate(np.linspace(-pi / 2, pi / 2, slices_1)):
-            for j, theta in enumerate(np.linspace(-pi, pi, stacks_1)):
-                # Compute the ellipsoid's coordinates and normal vector
-                vx = np.cos(phi) * np.cos(theta)
-                vy = np.cos(phi) * np.sin(theta)
-                vz = np.sin(phi)
-                x = radius_x * vx
-                y = radius_y * vy
-                z = radius_z * vz
-                nx = vx / radius_x
-                ny = vy / radius_y
-                nz = vz / radius_z
-
-                # Pre-compute the ellipsoid's texture indices for later
-                i_by_j = i * stacks_1 + j
-                ip1_by_j = (i + 1) % slices_1 * stacks_1 + j
-                i_by_jp1 = i * stacks_1 + (j + 1) % stacks_1
-                ip1_by_jp1 = (i + 1) % slices_1 * stacks_1 + (j + 1) % stacks_1
-
-                # Store the vertex and index information for this slice and stack
-                self.vertices[i_by_j] = [x, y, z, nx, ny, nz, *color, j / stacks, i / slices]
-                self.indices[i_by_j] = [
-                    i_by_j, ip1_by_j, i_by_jp1,
-                    ip1_by_jp1, ip1_by_j, i_by_jp1]
-
-        # Flatten the index array to make it compatible with GLSL EBO definition.
-        self.indices = self.indices.flatten("C")
+        # Compute the ellipsoid's unit directions over the whole grid, row i is phi, column j is theta
+        phi, theta = np.meshgrid(np.linspace(-pi / 2, pi / 2, slices_1),
+                                 np.linspace(-pi, pi, stacks_1), indexing="ij")
+        vx = np.cos(phi) * np.cos(theta)
+        vy = np.cos(phi) * np.sin(theta)
+        vz = np.sin(phi)
+
+        # Store the vertex information for every slice and stack, in C array order
+        self.vertices = np.zeros((slices_1, stacks_1, 11))
+        self.vertices[..., 0] = radius_x * vx
+        self.vertices[..., 1] = radius_y * vy
+        self.vertices[..., 2] = radius_z * vz
+        self.vertices[..., 3] = vx / radius_x
+        self.vertices[..., 4] = vy / radius_y
+        self.vertices[..., 5] = vz / radius_z
+        self.vertices[..., 6:9] = [*color]
+        self.vertices[..., 9] = np.arange(stacks_1)[None, :] / stacks
+        self.vertices[..., 10] = np.arange(slices_1)[:, None] / slices
+        self.vertices = self.vertices.reshape((-1, 11))
+
+        # Flattened index array, compatible with GLSL EBO definition.
+        self.indices = self.gridIndices(slices_1, stacks_1)
+        self.computeBounds()
+
+    def hasAnalyticSurface(self) -> bool:
+        return min(self.slices, self.stacks) >= self.minSmoothSegments
+
+    def intersectRays(self, origins, dirs, tMin, tMax):
+        # scaling by the radii turns the ellipsoid into the unit sphere and keeps the ray parameter
+        radii = np.array([self.radius_x, self.radius_y, self.radius_z], dtype=np.float64)
+        o = origins / radii
+        d = dirs / radii
+        roots = self.quadraticRoots(np.sum(d * d, axis=1), 2 * np.sum(o * d, axis=1), np.sum(o * o, axis=1) - 1)
+        t, _ = self.nearestRoots(roots, tMin, tMax)
+        return t, np.zeros(len(t), dtype=np.int64)
+
+    def surfaceAt(self, points, parts):
+        radii = np.array([self.radius_x, self.radius_y, self.radius_z], dtype=np.float64)
+        v = points / radii
+        v /= np.linalg.norm(v, axis=1)[:, None]
+        uv = np.stack([(np.arctan2(v[:, 1], v[:, 0]) + np.pi) / (2 * np.pi),
+                       (np.arcsin(np.clip(v[:, 2], -1, 1)) + np.pi / 2) / np.pi], axis=1)
+        return v / radii, uv
+
+    def surfaceRadius(self) -> float:
+        return max(self.radius_x, self.radius_y, self.radius_z)
 
     def draw(self):
-        self.vao.bind()
-        self.ebo.draw()
-        self.vao.unbind()
+        self.mesh.draw()
 
     def initialize(self):
-        self.vao.bind()
-        self.vbo.setBuffer(self.vertices, 11)
-        self.ebo.setBuffer(self.indices)
-
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexPos"),
-                                  stride=11, offset=0, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexNormal"),
-                                  stride=11, offset=3, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexColor"),
-                                  stride=11, offset=6, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexTexture"),
-                                  stride=11, offset=9, attribSize=2)
-        self.vao.unbind()
+        self.acquireMesh()
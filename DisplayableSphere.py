@@ -8,7 +8,6 @@ First version in 10/20/2021
 from typing import Optional
 
 from Displayable import Displayable
-from GLBuffer import VAO, VBO, EBO
 import numpy as np
 import ColorType as Ct
 import math
@@ -40,9 +39,6 @@ except ImportError:
 
 
 class DisplayableSphere(Displayable):
-    vao = None
-    vbo = None
-    ebo = None
     shaderProg = None
 
     vertices = None  # array to store vertices information
@@ -63,10 +59,6 @@ class DisplayableSphere(Displayable):
         self.shaderProg = shaderProg
         self.shaderProg.use()
 
-        self.vao = VAO()
-        self.vbo = VBO()  # vbo can only be initiated with glProgram activated
-        self.ebo = EBO()
-
         self.generate(radius, slices, stacks, color)
 
     def generate(self,
@@ -87,60 +79,63 @@ class DisplayableSphere(Displayable):
         self.color = color
         pi = math.pi
 
-        # Calculate the number of vertices and indices based on the number of slices and stacks
+        # Calculate the number of vertices based on the number of slices and stacks
         slices_1 = slices + 1
         stacks_1 = stacks + 1
-        self.vertices = np.zeros((slices_1 * stacks_1, 11))
-        self.indices = np.zeros((slices_1 * stacks_1, 6), dtype=np.uint32)
-
-        # Loop over the slices and stacks, calculating the x, y, and z coordinates
-        # of each vertex and the corresponding normal vector
-        for i, phi in enumerate(np.linspace(-pi / 2, pi / 2, slices_1)):
-            for j, theta in enumerate(np.linspace(-pi, pi, stacks_1)):
-                x = radius * math.cos(phi) * math.cos(theta)
-                y = radius * math.cos(phi) * math.sin(theta)
-                z = radius * math.sin(phi)
-
-                nx = math.cos(phi) * math.cos(theta)
-                ny = math.cos(phi) * math.sin(theta)
-                nz = math.sin(phi)
-
-                # Encoding vertex order using C array order
-                i_by_j = i * stacks_1 + j
-                self.vertices[i_by_j] = [x, y, z, nx, ny, nz, *color, j / stacks, i / slices]
-
-                # I've combined the two loops here so that the number of loops can be reduced.
-                ip1_by_j = (i + 1) % slices_1 * stacks_1 + j
-                i_by_jp1 = i * stacks_1 + (j + 1) % stacks_1
-                ip1_by_jp1 = (i + 1) % slices_1 * stacks_1 + (j + 1) % stacks_1
-
-                # Set the indices in the correct order for CCW winding
-                self.indices[i_by_j] = [
-                    i_by_j, ip1_by_j, i_by_jp1,
-                    ip1_by_jp1, ip1_by_j, i_by_jp1]
 
-        self.indices = self.indices.flatten("C")
+        # Evaluate the whole (slices_1, stacks_1) parameter grid at once, row i is phi, column j is theta
+        phi, theta = np.meshgrid(np.linspace(-pi / 2, pi / 2, slices_1),
+                                 np.linspace(-pi, pi, stacks_1), indexing="ij")
+        cos_phi = np.cos(phi)
+
+        nx = cos_phi * np.cos(theta)
+        ny = cos_phi * np.sin(theta)
+        nz = np.sin(phi)
+
+        # Encoding vertex order using C array order
+        self.vertices = np.zeros((slices_1, stacks_1, 11))
+        self.vertices[..., 0] = radius * nx
+        self.vertices[..., 1] = radius * ny
+        self.vertices[..., 2] = radius * nz
+        self.vertices[..., 3] = nx
+        self.vertices[..., 4] = ny
+        self.vertices[..., 5] = nz
+        self.vertices[..., 6:9] = [*color]
+        self.vertices[..., 9] = np.arange(stacks_1)[None, :] / stacks
+        self.vertices[..., 10] = np.arange(slices_1)[:, None] / slices
+        self.vertices = self.vertices.reshape((-1, 11))
+
+        # Set the indices in the correct order for CCW winding
+        self.indices = self.gridIndices(slices_1, stacks_1)
+        self.computeBounds()
+
+    def hasAnalyticSurface(self) -> bool:
+        return min(self.slices, self.stacks) >= self.minSmoothSegments
+
+    def intersectRays(self, origins, dirs, tMin, tMax):
+        # |o + t * d|^2 = radius^2
+        roots = self.quadraticRoots(np.sum(dirs * dirs, axis=1),
+                                    2 * np.sum(origins * dirs, axis=1),
+                                    np.sum(origins * origins, axis=1) - self.radius * self.radius)
+        t, _ = self.nearestRoots(roots, tMin, tMax)
+        return t, np.zeros(len(t), dtype=np.int64)
+
+    def surfaceAt(self, points, parts):
+        n = points / np.linalg.norm(points, axis=1)[:, None]
+        # invert the parameter grid of generate, theta runs along the stacks and phi along the slices
+        uv = np.stack([(np.arctan2(n[:, 1], n[:, 0]) + math.pi) / (2 * math.pi),
+                       (np.arcsin(np.clip(n[:, 2], -1, 1)) + math.pi / 2) / math.pi], axis=1)
+        return n, uv
+
+    def surfaceRadius(self) -> float:
+        return self.radius
 
     def draw(self):
-        self.vao.bind()
-        self.ebo.draw()
-        self.vao.unbind()
+        self.mesh.draw()
 
     def initialize(self):
         """
-        Remember to bind VAO before this initialization. If VAO is not bind, program might throw an error
-        in systems that don't enable a default VAO after GLProgram compilation
+        Upload this object's mesh. GL buffers come from GeometryCache, so identical meshes are only uploaded once
+        and share one VAO/VBO/EBO
         """
-        self.vao.bind()
-        self.vbo.setBuffer(self.vertices, 11)
-        self.ebo.setBuffer(self.indices)
-
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexPos"),
-                                  stride=11, offset=0, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexNormal"),
-                                  stride=11, offset=3, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexColor"),
-                                  stride=11, offset=6, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexTexture"),
-                                  stride=11, offset=9, attribSize=2)
-        self.vao.unbind()
+        self.acquireMesh()
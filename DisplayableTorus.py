@@ -7,7 +7,6 @@ First version in 11/01/2021
 """
 
 from Displayable import Displayable
-from GLBuffer import VAO, VBO, EBO
 from Point import Point
 import numpy as np
 import ColorType
@@ -49,9 +48,6 @@ except ImportError:
 #   There should be no seams in the resulting texture-mapped model.
 
 class DisplayableTorus(Displayable):
-    vao = None
-    vbo = None
-    ebo = None
     shaderProg = None
 
     # stores current torus's information, read-only
@@ -69,10 +65,6 @@ class DisplayableTorus(Displayable):
         self.shaderProg = shaderProg
         self.shaderProg.use()
 
-        self.vao = VAO()
-        self.vbo = VBO()  # vbo can only be initiate with glProgram activated
-        self.ebo = EBO()
-
         self.generate(innerRadius, outerRadius, nsides, rings, color)
 
     def generate(self, innerRadius=0.25, outerRadius=0.5, nsides=36, rings=36, color=ColorType.SOFTBLUE):
@@ -117,74 +109,107 @@ class DisplayableTorus(Displayable):
             # set its vertices and indices to empty arrays.
             self.vertices = np.zeros((0, 11))
             self.indices = np.zeros(0)
+            self.computeBounds()
             return
 
         # We need to pad one extra row for both the number of sides and rings,
         # to assign the correct texture coordinates to them.
         nsides_1 = nsides + 1
         rings_1 = rings + 1
-        self.vertices = np.zeros((nsides_1 * rings_1, 11))
-        self.indices = np.zeros((nsides_1 * rings_1, 6), dtype=np.uint32)
 
         pi = np.pi
-        for i, u in enumerate(np.linspace(-pi, pi, nsides_1)):
-            for j, v in enumerate(np.linspace(-pi, pi, rings_1)):
-                # pre_compute
-                cos_u = np.cos(u)
-                sin_u = np.sin(u)
-                cos_v = np.cos(v)
-                sin_v = np.sin(v)
-                # a + b * np.cos(v)
-                comm_patt = a + b * cos_v
-
-                # compute the vertex position
-                x = comm_patt * cos_u
-                y = comm_patt * sin_u
-                z = b * sin_v
-                i_by_j = i * rings_1 + j
-
-                # compute the vertex normal
-                nx = np.sign(b) * cos_u * cos_v * np.sign(comm_patt)
-                ny = np.sign(b) * sin_u * cos_v * np.sign(comm_patt)
-                nz = np.sign(b) * sin_v * np.sign(comm_patt)
-
-                # compute the vertex color
-                self.vertices[i_by_j] = [x, y, z, nx, ny, nz, *color, i / nsides, j / rings]
-
-                # # compute the vertex texture coordinates
-                # self.vertices[vert_index, 9:11] = [u / (2 * pi), v / (2 * pi)]
-
-                i_by_jp1 = i * rings_1 + (j + 1) % rings_1
-                ip1_by_j = (i + 1) % nsides_1 * rings_1 + j
-                ip1_by_jp1 = (i + 1) % nsides_1 * rings_1 + (j + 1) % rings_1
-
-                # readjust the order to match CCW.
-                self.indices[i_by_j, 0:6] = [
-                    i_by_j, ip1_by_j, i_by_jp1,
-                    ip1_by_jp1, ip1_by_j, i_by_jp1]
-
-        self.indices = self.indices.flatten("C")
+        # pre_compute cos(u), sin(u), cos(v), sin(v) over the whole grid, row i is u, column j is v
+        u, v = np.meshgrid(np.linspace(-pi, pi, nsides_1),
+                           np.linspace(-pi, pi, rings_1), indexing="ij")
+        cos_u = np.cos(u)
+        sin_u = np.sin(u)
+        cos_v = np.cos(v)
+        sin_v = np.sin(v)
+        # a + b * np.cos(v)
+        comm_patt = a + b * cos_v
+        n_sign = np.sign(b) * np.sign(comm_patt)
+
+        self.vertices = np.zeros((nsides_1, rings_1, 11))
+        # compute the vertex position
+        self.vertices[..., 0] = comm_patt * cos_u
+        self.vertices[..., 1] = comm_patt * sin_u
+        self.vertices[..., 2] = b * sin_v
+        # compute the vertex normal
+        self.vertices[..., 3] = n_sign * cos_u * cos_v
+        self.vertices[..., 4] = n_sign * sin_u * cos_v
+        self.vertices[..., 5] = n_sign * sin_v
+        # compute the vertex color and texture coordinates
+        self.vertices[..., 6:9] = [*color]
+        self.vertices[..., 9] = np.arange(nsides_1)[:, None] / nsides
+        self.vertices[..., 10] = np.arange(rings_1)[None, :] / rings
+        self.vertices = self.vertices.reshape((-1, 11))
+
+        # readjust the order to match CCW.
+        self.indices = self.gridIndices(nsides_1, rings_1)
+        self.computeBounds()
+
+    def hasAnalyticSurface(self) -> bool:
+        return min(self.nsides, self.rings) >= self.minSmoothSegments
+
+    def intersectRays(self, origins, dirs, tMin, tMax):
+        """
+        Real roots of the torus quartic (|p|^2 + a^2 - b^2)^2 = 4 a^2 (x^2 + y^2), as eigenvalues of the
+        companion matrices of all rays at once, polished with Newton steps
+        """
+        n = len(origins)
+        a = (self.outerRadius + self.innerRadius) / 2
+        b = (self.outerRadius - self.innerRadius) / 2
+        if b == 0 or n == 0:
+            return np.full(n, np.inf), np.zeros(n, dtype=np.int64)
+
+        scale = np.linalg.norm(dirs, axis=1)
+        d = dirs / scale[:, None]
+        # solve from the point of the ray closest to the center, keeps the coefficients well conditioned
+        t0 = -np.sum(origins * d, axis=1)
+        o = origins + t0[:, None] * d
+        od = np.sum(o * d, axis=1)
+        k = np.sum(o * o, axis=1) + a * a - b * b
+        coefficients = np.stack([
+            4 * od,
+            4 * od * od + 2 * k - 4 * a * a * (d[:, 0] ** 2 + d[:, 1] ** 2),
+            4 * od * k - 8 * a * a * (o[:, 0] * d[:, 0] + o[:, 1] * d[:, 1]),
+            k * k - 4 * a * a * (o[:, 0] ** 2 + o[:, 1] ** 2)], axis=1)
+
+        companion = np.zeros((n, 4, 4))
+        companion[:, 0, :] = -coefficients
+        companion[:, 1, 0] = companion[:, 2, 1] = companion[:, 3, 2] = 1
+        eigenvalues = np.linalg.eigvals(companion)
+        s = np.where(np.abs(eigenvalues.imag) <= 1e-6 * self.outerRadius, eigenvalues.real, np.nan)
+
+        c3, c2, c1, c0 = (coefficients[:, i:i + 1] for i in range(4))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for _ in range(2):
+                f = (((s + c3) * s + c2) * s + c1) * s + c0
+                df = ((4 * s + 3 * c3) * s + 2 * c2) * s + c1
+                s = np.where(df != 0, s - f / df, s)
+
+        t, _ = self.nearestRoots((t0[:, None] + s) / scale[:, None], tMin, tMax)
+        return t, np.zeros(n, dtype=np.int64)
+
+    def surfaceAt(self, points, parts):
+        a = (self.outerRadius + self.innerRadius) / 2
+        b = (self.outerRadius - self.innerRadius) / 2
+        u = np.arctan2(points[:, 1], points[:, 0])
+        v = np.arctan2(points[:, 2], np.hypot(points[:, 0], points[:, 1]) - a)
+        # from the center of the tube to the point, as the generated normals
+        normals = np.stack([np.cos(u) * np.cos(v), np.sin(u) * np.cos(v), np.sin(v)], axis=1) * np.sign(b)
+        uv = np.stack([(u + np.pi) / (2 * np.pi), (v + np.pi) / (2 * np.pi)], axis=1)
+        return normals, uv
+
+    def surfaceRadius(self) -> float:
+        return self.outerRadius
 
     def draw(self):
-        self.vao.bind()
-        self.ebo.draw()
-        self.vao.unbind()
+        self.mesh.draw()
 
     def initialize(self):
         """
-        Remember to bind VAO before this initialization. If VAO is not bind, program might throw an error
-        in systems which don't enable a default VAO after GLProgram compilation
+        Upload this object's mesh. GL buffers come from GeometryCache, so identical meshes are only uploaded once
+        and share one VAO/VBO/EBO
         """
-        self.vao.bind()
-        self.vbo.setBuffer(self.vertices, 11)
-        self.ebo.setBuffer(self.indices)
-
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexPos"),
-                                  stride=11, offset=0, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexNormal"),
-                                  stride=11, offset=3, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexColor"),
-                                  stride=11, offset=6, attribSize=3)
-        self.vbo.setAttribPointer(self.shaderProg.getAttribLocation("vertexTexture"),
-                                  stride=11, offset=9, attribSize=2)
-        self.vao.unbind()
+        self.acquireMesh()
@@ -0,0 +1,83 @@
+"""
+View-frustum culling. The six clipping planes are extracted from the projection and view matrices built by
+GLUtility.perspective and GLUtility.view, and the world-space bounds of a whole list of components are tested
+against them in one batch: first the bounding sphere, then the AABB for what survived.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import numpy as np
+
+from Displayable import Displayable
+
+
+class Frustum:
+    planes = None  # (6, 4), plane normal pointing inside and offset, normalized: left, right, bottom, top, near, far
+
+    # statistics of the last cull call
+    tested = 0
+    culled = 0
+
+    def __init__(self, projectionMat, viewMat):
+        """
+        :param projectionMat: column-major projection matrix, as returned by GLUtility.perspective
+        :param viewMat: column-major view matrix, as returned by GLUtility.view
+        """
+        # column-major matrices are stored transposed, undo that to get the row-major clip matrix
+        clipMat = np.asarray(projectionMat).T @ np.asarray(viewMat).T
+        planes = np.array([clipMat[3] + clipMat[0], clipMat[3] - clipMat[0],
+                           clipMat[3] + clipMat[1], clipMat[3] - clipMat[1],
+                           clipMat[3] + clipMat[2], clipMat[3] - clipMat[2]])
+        self.planes = planes / np.linalg.norm(planes[:, 0:3], axis=1)[:, None]
+
+    @staticmethod
+    def worldBounds(components):
+        """
+        World-space bounds of the Displayables of components, in one batch
+
+        :return: (N, 3) centers, (N,) bounding sphere radii and (N, 3) AABB half extents
+        """
+        localCenters = np.array([c.displayObj.boundingCenter for c in components], dtype=np.float64)
+        radii = np.array([c.displayObj.boundingRadius for c in components], dtype=np.float64)
+        halfExtents = np.array([c.displayObj.aabbMax - c.displayObj.aabbMin for c in components],
+                               dtype=np.float64) / 2
+        mats = np.array([c.transformationMat for c in components], dtype=np.float64)
+
+        # column-major matrices transform row vectors: world = local @ transformationMat
+        linear = mats[:, 0:3, 0:3]
+        centers = np.einsum("ni,nij->nj", localCenters, linear) + mats[:, 3, 0:3]
+        # Component only accepts uniform scaling, so every row of the linear part has the scaling as its length
+        scales = np.linalg.norm(linear, axis=2).max(axis=1)
+        halfExtents = np.einsum("ni,nij->nj", halfExtents, np.abs(linear))
+        return centers, radii * scales, halfExtents
+
+    def visible(self, centers, radii, halfExtents) -> np.ndarray:
+        """
+        :return: bool (N,), False for bounds completely outside of one of the planes
+        """
+        normals = self.planes[:, 0:3]
+        distances = centers @ normals.T + self.planes[:, 3]
+        result = np.all(distances >= -radii[:, None], axis=1)
+        # the AABB is often tighter than the sphere, its projected radius along every plane normal
+        result &= np.all(distances >= -(halfExtents @ np.abs(normals).T), axis=1)
+        return result
+
+    def cull(self, components: list) -> list:
+        """
+        Drop the components whose Displayable is outside of the frustum. Displayables without bounds are kept
+        """
+        hasBounds = [isinstance(c.displayObj, Displayable) and c.displayObj.boundingRadius is not None
+                     for c in components]
+        bounded = [c for c, b in zip(components, hasBounds) if b]
+        self.tested = len(bounded)
+        self.culled = 0
+        if not bounded:
+            return list(components)
+        mask = self.visible(*self.worldBounds(bounded))
+        self.culled = int(len(bounded) - np.count_nonzero(mask))
+        # keep the order of components
+        keep = iter(mask)
+        return [c for c, b in zip(components, hasBounds) if not b or next(keep)]
+
+    def stats(self) -> dict:
+        return {"tested": self.tested, "culled": self.culled, "drawn": self.tested - self.culled}
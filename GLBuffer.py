@@ -1,5 +1,5 @@
 """
-Define some classes and help methods to set up VAO, VBO, EBO
+Define some classes and help methods to set up VAO, VBO, EBO, FBO, PBO
 First version in 10/20/2021
 
 :author: micou(Zezhou Sun)
@@ -33,6 +33,8 @@ except ImportError:
 import numpy as np
 import ctypes
 
+from GLState import GLState
+
 
 class VBO:
     """
@@ -51,12 +53,13 @@ class VBO:
     def bind(self):
         gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
 
-    def setBuffer(self, bufferDataArray: np.ndarray, vertexAttribSize: int):
+    def setBuffer(self, bufferDataArray: np.ndarray, vertexAttribSize: int, usage=gl.GL_STATIC_DRAW):
         """
         :param vertexAttribSize: the size of the vertex attribute
         :type vertexAttribSize: int
         :param bufferDataArray: the vertices data. It will be flatten in row-major order if its dimension isn't one
         :type bufferDataArray: numpy.ndarray
+        :param usage: buffer usage hint, use GL_DYNAMIC_DRAW for data rewritten every frame
         """
         # type conversion
         if bufferDataArray.dtype != np.dtype("float32"):
@@ -69,7 +72,7 @@ class VBO:
         byteLength = 4 * bufferSize  # 4 is the size of float32
 
         self.bind()
-        gl.glBufferData(gl.GL_ARRAY_BUFFER, byteLength, bufferData, gl.GL_STATIC_DRAW)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, byteLength, bufferData, usage)
 
     def setAttribPointer(self, attribLoc, stride=0, offset=0, attribSize=0):
         attribSize = self.vertexAttribSize if attribSize == 0 else attribSize
@@ -88,6 +91,16 @@ class VBO:
         gl.glVertexAttribPointer(attribLoc, attribSize, gl.GL_FLOAT, gl.GL_FALSE, stride, offset)
         gl.glEnableVertexAttribArray(attribLoc)
 
+    def setInstancedAttribPointer(self, attribLoc, stride=0, offset=0, attribSize=0, divisor=1):
+        """
+        Same as setAttribPointer, but the attribute advances once every divisor instances instead of every vertex
+        """
+        if attribLoc < 0:
+            print("Warning: Cannot set instanced attrib pointer at ", attribLoc)
+            return
+        self.setAttribPointer(attribLoc, stride, offset, attribSize)
+        gl.glVertexAttribDivisor(attribLoc, divisor)
+
     def draw(self):
         gl.glDrawArrays(gl.GL_TRIANGLES, 0, self.vertexNum)
 
@@ -124,6 +137,9 @@ class EBO:
     def draw(self):
         gl.glDrawElements(gl.GL_TRIANGLES, self.indexNum, gl.GL_UNSIGNED_INT, None)
 
+    def drawInstanced(self, instanceNum):
+        gl.glDrawElementsInstanced(gl.GL_TRIANGLES, self.indexNum, gl.GL_UNSIGNED_INT, None, instanceNum)
+
 
 class VAO:
     """
@@ -138,45 +154,240 @@ class VAO:
     #     gl.glDeleteVertexArrays(1, self.vao)
 
     def bind(self):
-        gl.glBindVertexArray(self.vao)
+        GLState.bindVertexArray(self.vao)
 
     def unbind(self):
-        gl.glBindVertexArray(0)
+        GLState.bindVertexArray(0)
+
 
+class FBO:
+    """
+    Offscreen render target, a framebuffer with a RGBA8 color renderbuffer and a 24 bits depth renderbuffer
+    """
+    fbo = None
+    colorRbo = None
+    depthRbo = None
+    width = 0
+    height = 0
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.fbo = gl.glGenFramebuffers(1)
+        self.colorRbo, self.depthRbo = gl.glGenRenderbuffers(2)
+        self.bind()
 
-# A global variable in this scope to store next texture id, there should be no duplicate textureUnitID
-NextTextureID = 1
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self.colorRbo)
+        gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, gl.GL_RGBA8, width, height)
+        gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_RENDERBUFFER, self.colorRbo)
+        gl.glBindRenderbuffer(gl.GL_RENDERBUFFER, self.depthRbo)
+        gl.glRenderbufferStorage(gl.GL_RENDERBUFFER, gl.GL_DEPTH_COMPONENT24, width, height)
+        gl.glFramebufferRenderbuffer(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, gl.GL_RENDERBUFFER, self.depthRbo)
 
-class Texture:
+        status = gl.glCheckFramebufferStatus(gl.GL_FRAMEBUFFER)
+        if status != gl.GL_FRAMEBUFFER_COMPLETE:
+            raise Exception(f"Framebuffer incomplete, status {status:#x}")
+
+    def bind(self):
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.fbo)
+
+    def unbind(self):
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+
+    def readPixels(self) -> np.ndarray:
+        """
+        Read the color buffer back
+
+        :return: (height, width, 4) uint8 array, first row at the top like in an image file
+        """
+        self.bind()
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        data = gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE)
+        return np.frombuffer(data, dtype=np.uint8).reshape((self.height, self.width, 4))[::-1]
+
+    def delete(self):
+        gl.glDeleteFramebuffers(1, [self.fbo])
+        gl.glDeleteRenderbuffers(2, [self.colorRbo, self.depthRbo])
+
+
+class PBO:
     """
-    Packed help functions to deal with texture mapping in OpenGL, can be used to store multiple textures
+    Pixel pack buffer for asynchronous readback. startRead queues a glReadPixels into the buffer and returns at once,
+    fetch maps it later, so the copy overlaps with whatever was drawn in between
     """
-    textureName = 0
-    textureUnitID = 0
+    pbo = None
+    width = 0
+    height = 0
+    byteLength = 0
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.byteLength = 4 * width * height  # RGBA8
+        self.pbo = gl.glGenBuffers(1)
+        self.bind()
+        gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, self.byteLength, None, gl.GL_STREAM_READ)
+        self.unbind()
 
-    def __init__(self):
-        global NextTextureID
+    def bind(self):
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pbo)
+
+    def unbind(self):
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+    def startRead(self, fbo: FBO):
+        fbo.bind()
+        self.bind()
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        # with a pack buffer bound the last argument is an offset into it
+        gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        self.unbind()
 
-        # assign a texture image unit for this sampler
-        self.textureUnitID = NextTextureID
-        NextTextureID = NextTextureID % 16 + 1
+    def fetch(self) -> np.ndarray:
+        """
+        Wait for the read started by startRead and copy it out
+
+        :return: (height, width, 4) uint8 array, first row at the top like in an image file
+        """
+        result = np.empty((self.height, self.width, 4), dtype=np.uint8)
+        self.bind()
+        address = gl.glMapBuffer(gl.GL_PIXEL_PACK_BUFFER, gl.GL_READ_ONLY)
+        ctypes.memmove(result.ctypes.data, address, self.byteLength)
+        gl.glUnmapBuffer(gl.GL_PIXEL_PACK_BUFFER)
+        self.unbind()
+        return result[::-1]
 
-    def setTextureImage(self, image):
+    def delete(self):
+        gl.glDeleteBuffers(1, [self.pbo])
+
+
+class Texture:
+    """
+    Packed help functions to deal with texture mapping in OpenGL, can be used to store multiple textures.
+    Texture units are given out when a texture is bound, see GLState.bindTextureToAnyUnit
+    """
+    textureName = 0
+    source = None  # file the image was loaded from, if any. Textures with the same source hold the same image
+    image = None  # uint8 (height, width, 3) copy of the uploaded image, bottom row first like the texture
+    readFbo = None  # framebuffer reading from this texture, see blit
+    mipmaps = True  # whether the mipmap levels were generated
+    compressedFormat = None  # internal format of a block compressed texture, see setCompressedLevels
+    compressedBytes = 0  # size of the uploaded blocks of a compressed texture
+    compressedLevels = None  # the uploaded (width, height, blocks) levels of a compressed texture, see TextureArray
+    cacheKey = None  # key in TextureCache if the texture is shared through it
+    refCount = 0  # Components using a cached texture, see TextureCache
+
+    def setTextureImage(self, image, source=None, mipmaps=True, bottomRowFirst=False):
+        """
+        :param bottomRowFirst: image is already a uint8 (height, width, 3) array with the bottom row first, as
+            AssetPack.decodeImage makes them, it is kept as it is
+        """
         self.textureName = gl.glGenTextures(1)
+        self.source = source
+        self.mipmaps = mipmaps
 
-        # flip image upside down.
-        # trim to RGB channels, even if a channel provided
-        image = image[::-1, :, 0:3]
-        image = image.astype(np.dtype("uint8"))
+        if not bottomRowFirst:
+            # flip image upside down.
+            # trim to RGB channels, even if a channel provided
+            image = image[::-1, :, 0:3]
+            image = image.astype(np.dtype("uint8"))
+        self.image = image
 
         height, width, channel = image.shape
         imageData = image.flatten("C")
 
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.textureName)
+        GLState.bindTextureToAnyUnit(self.textureName, pinned=False)
         gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, width, height, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, imageData)
-        gl.glGenerateMipmap(gl.GL_TEXTURE_2D)
+        if mipmaps:
+            gl.glGenerateMipmap(gl.GL_TEXTURE_2D)
+        self.setTextureParameters()
+
+    def setTextureLevels(self, levels, source=None, mipmaps=True):
+        """
+        Upload a prepared mip chain instead of generating it, see AssetPack. The arrays are passed to OpenGL as they
+        are, without any copy
+
+        :param levels: uint8 (height, width, 3) arrays, bottom row first and tightly packed, level 0 first and down
+            to 1x1. Only level 0 is used without mipmaps
+        """
+        self.textureName = gl.glGenTextures(1)
+        self.source = source
+        self.mipmaps = mipmaps
+        self.image = levels[0]
+
+        # rows of any width are tightly packed
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        GLState.bindTextureToAnyUnit(self.textureName, pinned=False)
+        for level, image in enumerate(levels if mipmaps else levels[0:1]):
+            height, width, _ = image.shape
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, level, gl.GL_RGB, width, height, 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE,
+                            image)
+        self.setTextureParameters()
+
+    def setCompressedLevels(self, levels, internalFormat, image, source=None, mipmaps=True):
+        """
+        Upload a block compressed mip chain, see AssetPack. The blocks are passed to OpenGL as they are
+
+        :param levels: list of (width, height, uint8 array of the blocks), level 0 first and down to 1x1. Only
+            level 0 is used without mipmaps
+        :param internalFormat: compressed internal format of the blocks, like GL_COMPRESSED_RG_RGTC2
+        :param image: the uncompressed level 0 for the CPU side, see the image attribute
+        """
+        self.textureName = gl.glGenTextures(1)
+        self.source = source
+        self.mipmaps = mipmaps
+        self.image = image
+        self.compressedFormat = internalFormat
+        self.compressedBytes = 0
+        self.compressedLevels = levels if mipmaps else levels[0:1]
+
+        GLState.bindTextureToAnyUnit(self.textureName, pinned=False)
+        for level, (width, height, blocks) in enumerate(self.compressedLevels):
+            # PyOpenGL takes the image size from the array
+            gl.glCompressedTexImage2D(gl.GL_TEXTURE_2D, level, internalFormat, width, height, 0, blocks)
+            self.compressedBytes += blocks.nbytes
         self.setTextureParameters()
 
+    def updateTextureImage(self, image):
+        """
+        Replace the pixels of the texture, in place if the size didn't change. For images changing every frame,
+        like the previews of ProgressiveRenderer
+        """
+        # rows of any width are tightly packed
+        gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
+        if self.image is None or self.image.shape[0:2] != image.shape[0:2]:
+            if self.textureName:
+                gl.glDeleteTextures(1, [self.textureName])
+            if self.readFbo is not None:
+                gl.glDeleteFramebuffers(1, [self.readFbo])
+                self.readFbo = None
+            self.setTextureImage(image)
+            return
+        self.image = image[::-1, :, 0:3].astype(np.dtype("uint8"))
+        height, width, _ = self.image.shape
+        GLState.bindTextureToAnyUnit(self.textureName, pinned=False)
+        gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, width, height, gl.GL_RGB, gl.GL_UNSIGNED_BYTE,
+                           self.image.flatten("C"))
+
+    def blit(self, width, height, fbo=0):
+        """
+        Copy the texture over a framebuffer, stretched to width x height. Shows images made on the CPU without
+        going through the shader
+
+        :param fbo: framebuffer to draw into, the window by default
+        """
+        if self.readFbo is None:
+            self.readFbo = gl.glGenFramebuffers(1)
+            gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.readFbo)
+            gl.glFramebufferTexture2D(gl.GL_READ_FRAMEBUFFER, gl.GL_COLOR_ATTACHMENT0, gl.GL_TEXTURE_2D,
+                                      self.textureName, 0)
+        gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.readFbo)
+        gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, fbo)
+        textureHeight, textureWidth = self.image.shape[0:2]
+        gl.glBlitFramebuffer(0, 0, textureWidth, textureHeight, 0, 0, width, height, gl.GL_COLOR_BUFFER_BIT,
+                             gl.GL_LINEAR)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, fbo)
+
     def setTextureParameters(self):
         # for 2D texture, need wrap along s and t
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_REPEAT)
@@ -185,12 +396,12 @@ class Texture:
         gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
 
     def bind(self, glslVariableLoc):
-        gl.glActiveTexture(gl.GL_TEXTURE0 + self.textureUnitID)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.textureName)
-        gl.glUniform1i(glslVariableLoc, self.textureUnitID)
-
-    def unbind(self, glslVariableLoc):
-        gl.glActiveTexture(gl.GL_TEXTURE0)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
-        gl.glUniform1i(glslVariableLoc, 0)
+        unit = GLState.bindTextureToAnyUnit(self.textureName)
+        GLState.uniform("glUniform1i", glslVariableLoc, unit, gl.glUniform1i, unit)
+
+    @staticmethod
+    def unbind(glslVariableLoc):
+        # point the sampler to a unit with no texture
+        unit = GLState.bindTextureToAnyUnit(0)
+        GLState.uniform("glUniform1i", glslVariableLoc, unit, gl.glUniform1i, unit)
 
@@ -1,4 +1,7 @@
+from GLState import GLState
 from Light import Light
+from Material import Material
+from GLUtility import GLUtility
 
 try:
     import OpenGL
@@ -41,8 +44,99 @@ def perspectiveMatrix(angleOfView, near, far):
     result[3, 3] = 0
 
 
-class GLProgram:
+# std140 layout of one element of the Light array in the light uniform block. Every vec3 shares its 16 bytes slot
+# with a bool or a float, bools are 4 bytes integers. Must match the Light struct in genFragShaderSource
+lightBlockDtype = np.dtype([
+    ("color", np.float32, 4),
+    ("position", np.float32, 3),
+    ("on", np.int32),
+    ("infiniteDirection", np.float32, 3),
+    ("infiniteOn", np.int32),
+    ("spotDirection", np.float32, 3),
+    ("spotOn", np.int32),
+    ("spotRadialFactor", np.float32, 3),
+    ("spotAngleLimit", np.float32),
+    ("spotExpAttenuation", np.float32),
+    # written by ShadowMaps, not by packLight
+    ("shadowOn", np.int32),
+    ("shadowLayer", np.int32),  # first layer of the light in the shadow map array
+    ("shadowCube", np.int32),  # six cube faces from shadowLayer on, for point lights
+])
+
+
+def packLight(entry, light: Light):
+    """
+    Fill one lightBlockDtype record with light, the way the fragment shader reads it
+    """
+    entry["on"] = light.enabled
+    entry["position"] = light.position
+    entry["color"] = light.color
+    entry["infiniteOn"] = light.infiniteOn
+    # infinite lights shine along their position vector
+    entry["infiniteDirection"] = light.position
+    entry["spotOn"] = light.spotOn
+    entry["spotDirection"] = light.spotDirection
+    entry["spotRadialFactor"] = light.spotRadialFactor
+    entry["spotAngleLimit"] = light.spotAngleLimit
+    entry["spotExpAttenuation"] = light.spotExpAttenuation
+
+
+def renderingFlags(routing) -> int:
+    """
+    Bit flags of a rendering routing name, see GLProgram.setFragmentShaderRouting
+    """
+    renderingFlag = 0
+    if isinstance(routing, str):
+        routing = routing.lower()
+        if ("lighting" in routing) or ("illumination" in routing):
+            renderingFlag = renderingFlag | 0x1
+        if "vertex" in routing:
+            renderingFlag = renderingFlag | (0x1 << 1)
+        if "pure" in routing:
+            renderingFlag = renderingFlag | (0x1 << 2)
+        if "normal" in routing:
+            renderingFlag = renderingFlag | (0x1 << 3)
+        if "bump" in routing:
+            renderingFlag = renderingFlag | (0x1 << 4)
+        if "artist" in routing:
+            renderingFlag = renderingFlag | (0x1 << 5)
+        if "custom" in routing:
+            renderingFlag = renderingFlag | (0x1 << 6)
+        if "texture" in routing:
+            renderingFlag = renderingFlag | (0x1 << 8)
+    return renderingFlag
+
+
+# bit of a variant key for normal mapping, above the bits of renderingFlags
+normalMapFlag = 0x1 << 9
+
+
+def variantKey(routing, normalMapOn=False) -> int:
+    """
+    Key of the shader variant drawing a rendering routing, with or without a normal map. See GLProgram.useVariant
+    """
+    return renderingFlags(routing) | (normalMapFlag if normalMapOn else 0)
+
+
+class ShaderVariant:
+    """
+    One linked permutation of a GLProgram's shaders. Uniform values are kept by the GLProgram, a variant receives the
+    ones set since it was last used when it becomes current
+    """
+    key = 0
     program = None
+    uniformLocations = None  # dict, uniform name in program -> location
+    syncedSerial = 0  # GLProgram.uniformSerial of the last uniform value this variant received
+
+
+class GLProgram:
+    """
+    The fragment shader is generated per variant key, that is per combination of rendering routing and normal
+    mapping, and each variant is compiled and linked the first time it is used. Components select theirs with
+    useVariant(component.shaderKey). Every variant shares the vertex shader, the light uniform buffer and the vertex
+    attribute locations, so VAOs work with all of them
+    """
+    program = None  # GL name of the default variant, identifies this GLProgram
 
     vertexShaderSource = None
     fragmentShaderSource = None
@@ -54,8 +148,54 @@ class GLProgram:
     ready = False  # a control flag which reflect if this GLprogram is ready
     debug = 0
 
-    def __init__(self) -> None:
+    uniformLocations = None  # dict, uniform name in the current variant -> location
+    uniformLocationQueries = 0  # debug counter of glGetUniformLocation calls, it should not grow after compile
+
+    lightData = None  # numpy array of lightBlockDtype, CPU copy of the light uniform block
+    lightUbo = None  # uniform buffer object backing the light uniform block
+    lightsDirty = False  # lightData changed since the last upload
+    lightBlockBinding = 0  # uniform buffer binding point of the light block
+    shadowTextureUnit = 0  # texture unit of the shadow map array, the last unit of the driver, see ShadowMaps
+    textureArrayUnit = 0  # texture unit of the texture array of instanced batches, see TextureArrays
+
+    # camera matrices last set with setMat4, setModelMat combines them with the model matrix on the CPU
+    viewMat = None
+    projectionMat = None
+    viewProjectionMat = None  # viewMat @ projectionMat, None until the next setModelMat computes it
+
+    # vertex attributes are bound to these locations before linking, so every variant, and the depth-only program,
+    # can draw with the same VAOs. Matrices take one location per column
+    attribLocations = {
+        "vertexPos": 0,
+        "vertexNormal": 1,
+        "vertexColor": 2,
+        "vertexTexture": 3,
+        "instanceModel": 4,
+        "instanceNormal": 8,
+        "instanceMaterialIndex": 11,
+        "instanceTextureLayer": 12,
+    }
+
+    depthOnly = False  # see __init__
+    defaultKey = 0x1  # variant of the "illumination" routing, compiled by compile
+    permutationsOn = True  # False for the depth-only program and for custom fragment shaders, one variant for all
+    variants = None  # dict, variant key -> ShaderVariant
+    variant: ShaderVariant = None  # the variant uniforms are set on
+    uniformValues = None  # dict, uniform name -> (serial, GL call name, value, setter, args), in serial order
+    uniformSerial = 0  # number of uniform changes so far
+
+    def __init__(self, maxLightsNum: int = 20, maxShadowLights: int = 4, depthOnly: bool = False) -> None:
+        """
+        :param maxLightsNum: size of the light array, it is compiled into the shader
+        :type maxLightsNum: int
+        :param maxShadowLights: lights with a shadow map, the size of the shadowMats array is compiled from it
+        :param depthOnly: compile the depth-only variant used to render shadow maps instead of the full shader
+        """
         self.program = gl.glCreateProgram()
+        self.variants = {}
+        self.uniformValues = {}
+        self.depthOnly = depthOnly
+        self.permutationsOn = not depthOnly
 
         self.ready = False
 
@@ -65,21 +205,38 @@ class GLProgram:
             "vertexNormal": "aNormal",
             "vertexColor": "aColor",
             "vertexTexture": "aTexture",
+            "instanceModel": "aInstanceModel",
+            "instanceNormal": "aInstanceNormal",
+            "instanceMaterialIndex": "aInstanceMaterial",
+            "instanceTextureLayer": "aInstanceTextureLayer",
 
             "textureImage": "txt_text",
             "normalMap": "txt_norm",
-            "useNormalMap": "txt_normOn",
+            "normalMapRG": "normalMapRG",
+            "textureArray": "txt_array",
+            "textureArrayOn": "textureArrayOn",
 
             "projectionMat": "projection",
             "viewMat": "view",
             "modelMat": "model",
+            "normalMat": "normalMatrix",
+            "modelViewProjectionMat": "modelViewProjection",
 
             "viewPosition": "viewPosition",
             "material": "material",
+            "materials": "materials",
             "light": "light",
+            "lightBlock": "LightBlock",
+            "instancingOn": "instancingOn",
+
+            "shadowMaps": "shadowMaps",
+            "shadowMats": "shadowMats",
+            "shadowsOn": "shadowsOn",
 
-            "maxLightsNum": "20",
+            "maxLightsNum": str(int(maxLightsNum)),
             "maxMaterialNum": "20",
+            # point lights take one layer per cube face
+            "maxShadowLayers": str(6 * max(1, int(maxShadowLights))),
 
             "ambientOn": "l_ambientOn",
             "diffuseOn": "l_diffuseOn",
@@ -89,28 +246,46 @@ class GLProgram:
         self.attribs["specular"] = self.attribs["material"] + ".specular"
         self.attribs["ambient"] = self.attribs["material"] + ".ambient"
         self.attribs["highlight"] = self.attribs["material"] + ".highlight"
-        for i in range(int(self.attribs["maxLightsNum"])):
-            self.attribs[f"light[{i}].on"] = f"{self.attribs['light']}[{i}].on"
-            self.attribs[f"light[{i}].position"] = f"{self.attribs['light']}[{i}].position"
-            self.attribs[f"light[{i}].color"] = f"{self.attribs['light']}[{i}].color"
-            self.attribs[f"light[{i}].infiniteOn"] = f"{self.attribs['light']}[{i}].infiniteOn"
-            self.attribs[f"light[{i}].infiniteDirection"] = f"{self.attribs['light']}[{i}].infiniteDirection"
-            self.attribs[f"light[{i}].radialOn"] = f"{self.attribs['light']}[{i}].radialOn"
-            self.attribs[f"light[{i}].spotOn"] = f"{self.attribs['light']}[{i}].spotOn"
-            self.attribs[f"light[{i}].spotDirection"] = f"{self.attribs['light']}[{i}].spotDirection"
-            self.attribs[f"light[{i}].spotRadialFactor"] = f"{self.attribs['light']}[{i}].spotRadialFactor"
-            self.attribs[f"light[{i}].spotAngleLimit"] = f"{self.attribs['light']}[{i}].spotAngleLimit"
-            self.attribs[f"light[{i}].spotExpAttenuation"] = f"{self.attribs['light']}[{i}].spotExpAttenuation"
-
-        self.vertexShaderSource = self.genVertexShaderSource()
-        self.fragmentShaderSource = self.genFragShaderSource()
+        for i in range(int(self.attribs["maxMaterialNum"])):
+            self.attribs[f"materials[{i}].diffuse"] = f"{self.attribs['materials']}[{i}].diffuse"
+            self.attribs[f"materials[{i}].specular"] = f"{self.attribs['materials']}[{i}].specular"
+            self.attribs[f"materials[{i}].ambient"] = f"{self.attribs['materials']}[{i}].ambient"
+            self.attribs[f"materials[{i}].highlight"] = f"{self.attribs['materials']}[{i}].highlight"
+        for i in range(int(self.attribs["maxShadowLayers"])):
+            self.attribs[f"shadowMats[{i}]"] = f"{self.attribs['shadowMats']}[{i}]"
+
+        self.lightData = np.zeros(int(self.attribs["maxLightsNum"]), dtype=lightBlockDtype)
+        self.lightsDirty = True
+
+        if depthOnly:
+            self.vertexShaderSource = self.genDepthVertexShaderSource()
+            self.fragmentShaderSource = self.genDepthFragShaderSource()
+        else:
+            self.vertexShaderSource = self.genVertexShaderSource()
+            self.fragmentShaderSource = self.genFragShaderSource()
 
     def __del__(self) -> None:
         try:
-            gl.glDeleteProgram(self.program)
+            self.delete()
         except Exception as e:
             pass
 
+    def delete(self):
+        """
+        Delete the programs of every variant and the vertex shader. Call it while the context owning them is current,
+        a GLProgram collected later would delete the objects another context reuses the names of
+        """
+        if self.program:
+            gl.glDeleteProgram(self.program)
+        for variant in self.variants.values():
+            if variant.program != self.program:
+                gl.glDeleteProgram(variant.program)
+        if self.vs:
+            gl.glDeleteShader(self.vs)
+        self.program = 0
+        self.variants = {}
+        self.vs = None
+
     @staticmethod
     def load_shader(src: str, shader_type: int) -> int:
         shader = gl.glCreateShader(shader_type)
@@ -124,50 +299,125 @@ class GLProgram:
         return shader
 
     def genVertexShaderSource(self):
+        """
+        There are two variants in this vertex shader, selected by the instancingOn uniform:
+        the default one reads the model matrix from the model uniform, the instanced one reads it, together with
+        an index into the materials array and a layer of the texture array, from per-instance attributes.
+        See InstancedRenderer
+
+        Normal matrices come from the CPU with the model matrices, see Component.normalMat, and the default variant
+        also gets projection * view * model premultiplied, see setModelMat
+        """
         vss = f'''
         #version 330 core
         in vec3 {self.attribs["vertexPos"]};
         in vec3 {self.attribs["vertexNormal"]};
         in vec3 {self.attribs["vertexColor"]};
         in vec2 {self.attribs["vertexTexture"]};
+        in mat4 {self.attribs["instanceModel"]};
+        in mat3 {self.attribs["instanceNormal"]};
+        in float {self.attribs["instanceMaterialIndex"]};
+        in float {self.attribs["instanceTextureLayer"]};
         
         out vec3 vPos;
         out vec3 vColor;
         smooth out vec3 vNormal;
         out vec2 vTexture;
-        out int materialIndex;
+        flat out int vMaterialIndex;
+        flat out float vTextureLayer;
         
         uniform mat4 {self.attribs["projectionMat"]};
         uniform mat4 {self.attribs["viewMat"]};
         uniform mat4 {self.attribs["modelMat"]};
+        uniform mat3 {self.attribs["normalMat"]};
+        uniform mat4 {self.attribs["modelViewProjectionMat"]};
+        uniform bool {self.attribs["instancingOn"]};
         
         void main()
         {{
-            gl_Position = {self.attribs["projectionMat"]} * {self.attribs["viewMat"]} * {self.attribs["modelMat"]} * vec4({self.attribs["vertexPos"]}, 1.0);
-            vPos = vec3(model * vec4({self.attribs["vertexPos"]}, 1.0));
+            vec4 position = vec4({self.attribs["vertexPos"]}, 1.0);
+            if ({self.attribs["instancingOn"]}) {{
+                vec4 worldPos = {self.attribs["instanceModel"]} * position;
+                gl_Position = {self.attribs["projectionMat"]} * ({self.attribs["viewMat"]} * worldPos);
+                vPos = worldPos.xyz;
+                vNormal = normalize({self.attribs["instanceNormal"]} * {self.attribs["vertexNormal"]});
+                vMaterialIndex = int({self.attribs["instanceMaterialIndex"]} + 0.5);
+                vTextureLayer = {self.attribs["instanceTextureLayer"]};
+            }}
+            else {{
+                gl_Position = {self.attribs["modelViewProjectionMat"]} * position;
+                vPos = vec3({self.attribs["modelMat"]} * position);
+                vNormal = normalize({self.attribs["normalMat"]} * {self.attribs["vertexNormal"]});
+                vMaterialIndex = 0;
+                vTextureLayer = 0.0;
+            }}
             vColor = {self.attribs["vertexColor"]};
-            vNormal = normalize(transpose(inverse({self.attribs["modelMat"]})) * vec4({self.attribs["vertexNormal"]}, 0.0) ).xyz;
             vTexture = {self.attribs["vertexTexture"]};
         }}
         '''
         return vss
 
-    def genFragShaderSource(self):
+    def genDepthVertexShaderSource(self):
+        """
+        Depth-only variant of the vertex shader, positions only
+        """
+        vss = f'''
+        #version 330 core
+        in vec3 {self.attribs["vertexPos"]};
+        
+        uniform mat4 {self.attribs["modelViewProjectionMat"]};
+        
+        void main()
+        {{
+            gl_Position = {self.attribs["modelViewProjectionMat"]} * vec4({self.attribs["vertexPos"]}, 1.0);
+        }}
+        '''
+        return vss
+
+    def genDepthFragShaderSource(self):
+        # only the depth buffer is written
+        return """
+#version 330 core
+void main()
+{
+}
+        """
+
+    def genFragShaderSource(self, key=None):
+        """
+        Fragment shader of one variant. Only the code of the routings in key is generated, a fragment never
+        branches on the routing at runtime. Several routings average their colors, like they always did
+
+        :param key: variant key, see variantKey. None for the default "illumination" routing
+        """
+        if key is None:
+            key = self.defaultKey
         # macros
         _light = self.attribs["light"]
-        _material = self.attribs["material"]
+        _lightBlock = self.attribs["lightBlock"]
+        _materialUniform = self.attribs["material"]
+        _materials = self.attribs["materials"]
+        _instancingOn = self.attribs["instancingOn"]
+        # every lighting computation below reads the material through this local variable
+        _material = "fragMaterial"
         _viewPosition = self.attribs["viewPosition"]
         _txtrImg = self.attribs["textureImage"]
         _aOn = self.attribs["ambientOn"]
         _dOn = self.attribs["diffuseOn"]
         _sOn = self.attribs["specularOn"]
         _txtrNorm = self.attribs["normalMap"]
-        _useNorm = self.attribs["useNormalMap"]
+        _normalMapRG = self.attribs["normalMapRG"]
+        _txtrArray = self.attribs["textureArray"]
+        _txtrArrayOn = self.attribs["textureArrayOn"]
+        _shadowMaps = self.attribs["shadowMaps"]
+        _shadowMats = self.attribs["shadowMats"]
+        _shadowsOn = self.attribs["shadowsOn"]
 
         fss = f"""
 #version 330 core
 #define MAX_LIGHT_NUM {self.attribs["maxLightsNum"]}
 #define MAX_MATERIAL_NUM {self.attribs["maxMaterialNum"]}
+#define MAX_SHADOW_LAYERS {self.attribs["maxShadowLayers"]}
 struct Material{{
     vec4 ambient;
     vec4 diffuse;
@@ -175,222 +425,271 @@ struct Material{{
     float highlight;
 }};
 
+// members are ordered for a tight std140 layout, see lightBlockDtype
 struct Light{{
-    bool on;
-    vec3 position;
     vec4 color;
+    vec3 position;
+    bool on;
     
-    bool infiniteOn;
     vec3 infiniteDirection;
+    bool infiniteOn;
     
-    bool spotOn;
     vec3 spotDirection;
+    bool spotOn;
     vec3 spotRadialFactor;
     float spotAngleLimit;
     float spotExpAttenuation;
+    
+    bool shadowOn;
+    int shadowLayer;
+    bool shadowCube;
 }};
 
 in vec3 vPos;
 in vec3 vColor;
 smooth in vec3 vNormal;
 in vec2 vTexture;
+flat in int vMaterialIndex;
+flat in float vTextureLayer;
 
-uniform int renderingFlag;
 uniform sampler2D {_txtrImg};
 uniform sampler2D {_txtrNorm};
-uniform bool {_useNorm};
+// the normal map only stores x and y (BC5), z is rebuilt from them
+uniform bool {_normalMapRG};
+// instanced batches of components with different textures read them from the layers of a texture array
+uniform sampler2DArray {_txtrArray};
+uniform bool {_txtrArrayOn};
 
 uniform vec3 {_viewPosition};
-uniform Material {_material};
-uniform Light {_light}[MAX_LIGHT_NUM];
+uniform Material {_materialUniform};
+uniform Material {_materials}[MAX_MATERIAL_NUM];
+uniform bool {_instancingOn};
+layout(std140) uniform {_lightBlock}{{
+    Light {_light}[MAX_LIGHT_NUM];
+}};
 // switch for ambient, diffuse and specular on/off
 uniform bool {_aOn};
 uniform bool {_dOn};
 uniform bool {_sOn};
 
+// shadow maps of every shadow casting light, see ShadowMaps
+uniform sampler2DArrayShadow {_shadowMaps};
+uniform mat4 {_shadowMats}[MAX_SHADOW_LAYERS];
+uniform bool {_shadowsOn};
+
 out vec4 FragColor;
-void main()
-{{
-    // These three lines are meaningless, they only works as attributes placeholder! 
-    // Otherwise glsl will optimize out our attributes
-    vec4 placeHolder = vec4(vPos + vColor + vNormal + vec3(vTexture, 1), 0);
-    FragColor = -1 * abs(placeHolder);
-    FragColor = clamp(FragColor, 0, 1);
-    
-    vec4 results[8];
-    for(int i=0; i<8; i+=1)
-        results[i]=vec4(0.0);
-    int ri=0;
-    vec3 compNormal = vNormal;
-    
+
+// fraction of the light reaching vPos, 3x3 PCF on top of the hardware's 2x2 depth comparison
+float shadowFactor(Light l){{
+    int layer = l.shadowLayer;
+    if (l.shadowCube) {{
+        // the face of the cube map around the light that vPos is seen in
+        vec3 d = vPos - l.position;
+        vec3 a = abs(d);
+        if (a.x >= a.y && a.x >= a.z)
+            layer += d.x > 0.0 ? 0 : 1;
+        else if (a.y >= a.z)
+            layer += d.y > 0.0 ? 2 : 3;
+        else
+            layer += d.z > 0.0 ? 4 : 5;
+    }}
+    vec4 lightClip = {_shadowMats}[layer] * vec4(vPos, 1.0);
+    vec3 mapPos = lightClip.xyz / lightClip.w * 0.5 + 0.5;
+    if (mapPos.z >= 1.0)
+        return 1.0;
+    vec2 texel = 1.0 / vec2(textureSize({_shadowMaps}, 0).xy);
+    float lit = 0.0;
+    for (int x = -1; x <= 1; x += 1)
+        for (int y = -1; y <= 1; y += 1)
+            lit += texture({_shadowMaps}, vec4(mapPos.xy + vec2(x, y) * texel, layer, mapPos.z));
+    return lit / 9.0;
+}}
+
+vec4 sampleTexture(){{
+    if ({_txtrArrayOn})
+        return texture({_txtrArray}, vec3(vTexture, vTextureLayer));
+    return texture({_txtrImg}, vTexture);
+}}
+"""
+
+        # the code of every routing bit of key, results are averaged like the routings always were
+        body = ""
+        results = []
+        if key & normalMapFlag:
+            body += f"""
     ////////// 7: Normal Mapping
     // Requirements:
     //   1. Perform the same steps as Texture Mapping above, except that instead of using the image for vertex 
     //   color, the image is used to modify the normals.
     //   2. Use the input normal map (“./assets/normalmap.jpg”) on both the sphere and the torus.
-    if ({_useNorm}) {{
-        vec3 normalMap = texture({_txtrNorm}, vTexture).rgb;
-        normalMap = normalize(normalMap * 2.0 - 1.0);
-        vec3 tangent = normalize(vec3(1.0, 0.0, 0.0));
-        vec3 bitangent = normalize(cross(normalMap, tangent));
-        mat3 TBN = mat3(tangent, bitangent, normalMap);
-        compNormal = normalize(TBN * vNormal);
-    }}
+    vec3 normalMap = texture({_txtrNorm}, vTexture).rgb * 2.0 - 1.0;
+    if ({_normalMapRG})
+        normalMap.z = sqrt(max(0.0, 1.0 - dot(normalMap.xy, normalMap.xy)));
+    normalMap = normalize(normalMap);
+    vec3 tangent = normalize(vec3(1.0, 0.0, 0.0));
+    vec3 bitangent = normalize(cross(normalMap, tangent));
+    mat3 TBN = mat3(tangent, bitangent, normalMap);
+    compNormal = normalize(TBN * vNormal);
+"""
+        if key & 0x1:
+            # "texture" together with lighting lights the texture instead of the vertex color
+            v4Color = "sampleTexture()" if key & (0x1 << 8) else "vec4(vColor, 1.0)"
+            body += f"""
+    // Illumination rendering, routing name is "lighting" or "illumination"
+    // instanced draws pick their material from the materials array
+    Material {_material} = {_materialUniform};
+    if ({_instancingOn})
+        {_material} = {_materials}[vMaterialIndex];
+    vec4 v4Color = {v4Color};
+    vec4 iSum = vec4(0.0);
 
-    bool useLighting = (renderingFlag >> 0 & 0x1) == 1;
-    bool useTexture = (renderingFlag >> 8 & 0x1) == 1;
-    // Reserved for illumination rendering, routing name is "lighting" or "illumination"
-    if (useLighting) {{
-        vec4 v4Color;
-        if (!useTexture) {{
-            v4Color = vec4(vColor, 1.0);
-        }} else {{
-            v4Color = texture({_txtrImg}, vTexture);
-        }}
-        vec4 iSum = vec4(0.0);
-
-        // Part 3: Illuminate your meshes
-        // Part 4: Set up lights
-        // Requirements:
-        //   * Use the Light struct which is defined above and the provided Light class to implement 
-        //   illumination equations for 3 different light sources: Point light, Infinite light, 
-        //   Spotlight with radial and angular attenuation
-        //   * In the Sketch.py file Interrupt_keyboard method, bind keyboard interfaces that allows 
-        //   the user to toggle on/off specular, diffuse, and ambient with keys S, D, A.
+    // Part 3: Illuminate your meshes
+    // Part 4: Set up lights
+    // Requirements:
+    //   * Use the Light struct which is defined above and the provided Light class to implement 
+    //   illumination equations for 3 different light sources: Point light, Infinite light, 
+    //   Spotlight with radial and angular attenuation
+    //   * In the Sketch.py file Interrupt_keyboard method, bind keyboard interfaces that allows 
+    //   the user to toggle on/off specular, diffuse, and ambient with keys S, D, A.
+    
+    // first compute the ambient color
+    vec4 litColor;
+    if ({_aOn}){{
+        litColor = {_material}.ambient * v4Color;
+    }} else {{
+        litColor = v4Color;
+    }}
+    
+    // for each light, we compute diffuse and specular
+    for (int i = 0; i < MAX_LIGHT_NUM; i += 1){{
+        if (!{_light}[i].on)
+            continue;
+    
+        //////////////// then compute the diffuse ////////////////
+        // L is the direction from the light to the vertex
+        vec3 L;
         
-        // first compute the ambient color
-        if ({_aOn}){{
-            results[ri] = {_material}.ambient * v4Color;
+        if (!{_light}[i].infiniteOn){{
+            L = normalize({_light}[i].position - vPos);
         }} else {{
-            results[ri] = v4Color;
+            L = normalize({_light}[i].infiniteDirection);
         }}
         
-        // for each light, we compute diffuse and specular
-        for (int i = 0; i < MAX_LIGHT_NUM; i += 1){{
-            if (!{_light}[i].on)
-                continue;
+        if (!{_dOn} && !{_sOn})
+            continue;
         
-            //////////////// then compute the diffuse ////////////////
-            // L is the direction from the light to the vertex
-            vec3 L;
-            
-            if (!{_light}[i].infiniteOn){{
-                L = normalize({_light}[i].position - vPos);
-            }} else {{
-                L = normalize({_light}[i].infiniteDirection);
-            }}
-            
-            if (!{_dOn} && !{_sOn})
-                continue;
-            
-            vec4 i_diffuse = vec4(0.0);
-            vec3 N = normalize(compNormal);
-            float N_dot_L = dot(N, L);
-            if ({_dOn} && N_dot_L > 0.0)
-                i_diffuse = ({_material}.diffuse * N_dot_L) * {_light}[i].color;
-        
-            //////////////// then compute the specular ////////////////
-            // V is the direction from the vertex to the camera
-            vec3 V = normalize({_viewPosition} - vPos);
-            // R is the reflection of L about N, 2 * N_dot_L * N - L;
-            vec3 R = reflect(-L, N);
+        vec4 i_diffuse = vec4(0.0);
+        vec3 N = normalize(compNormal);
+        float N_dot_L = dot(N, L);
+        if ({_dOn} && N_dot_L > 0.0)
+            i_diffuse = ({_material}.diffuse * N_dot_L) * {_light}[i].color;
     
-            float R_dot_V = max(dot(R, V), 0.0);
-            vec4 i_specular = vec4(0.0);
-            if ({_sOn} && N_dot_L > 0.0 && R_dot_V > 0.0) {{
-                float specFact = pow(R_dot_V, {_material}.highlight);
-                i_specular = {_material}.specular * specFact * {_light}[i].color;
-            }}
-            
-            float f_radial = 1.0;
-            if ({_light}[i].spotOn && !{_light}[i].infiniteOn){{
-                float dist = length({_light}[i].position - vPos);
-                float a = {_light}[i].spotRadialFactor[0];
-                float b = {_light}[i].spotRadialFactor[1];
-                float c = {_light}[i].spotRadialFactor[2];
-                f_radial = 1.0 / (a + b * dist + c * dist * dist);
-            }}
-            float f_angular = 1.0;
-            if ({_light}[i].spotOn){{
-                // unlikely L, vObj3 should always be vector from position to render point.
-                vec3 vObj = normalize({_light}[i].position - vPos);
-                float cos_angle = dot(vObj, normalize({_light}[i].spotDirection));
-                if (cos_angle > {_light}[i].spotAngleLimit) {{
-                    f_angular = pow(cos_angle, {_light}[i].spotExpAttenuation);
-                }} else {{
-                    f_angular = 0.0;
-                }}
+        //////////////// then compute the specular ////////////////
+        // V is the direction from the vertex to the camera
+        vec3 V = normalize({_viewPosition} - vPos);
+        // R is the reflection of L about N, 2 * N_dot_L * N - L;
+        vec3 R = reflect(-L, N);
+
+        float R_dot_V = max(dot(R, V), 0.0);
+        vec4 i_specular = vec4(0.0);
+        if ({_sOn} && N_dot_L > 0.0 && R_dot_V > 0.0) {{
+            float specFact = pow(R_dot_V, {_material}.highlight);
+            i_specular = {_material}.specular * specFact * {_light}[i].color;
+        }}
+        
+        float f_radial = 1.0;
+        if ({_light}[i].spotOn && !{_light}[i].infiniteOn){{
+            float dist = length({_light}[i].position - vPos);
+            float a = {_light}[i].spotRadialFactor[0];
+            float b = {_light}[i].spotRadialFactor[1];
+            float c = {_light}[i].spotRadialFactor[2];
+            f_radial = 1.0 / (a + b * dist + c * dist * dist);
+        }}
+        float f_angular = 1.0;
+        if ({_light}[i].spotOn){{
+            // unlikely L, vObj3 should always be vector from position to render point.
+            vec3 vObj = normalize({_light}[i].position - vPos);
+            float cos_angle = dot(vObj, normalize({_light}[i].spotDirection));
+            if (cos_angle > {_light}[i].spotAngleLimit) {{
+                f_angular = pow(cos_angle, {_light}[i].spotExpAttenuation);
+            }} else {{
+                f_angular = 0.0;
             }}
-            
-            iSum += f_radial * f_angular * (i_diffuse + i_specular);
         }}
-        // avoid the result is out of bounds
-        iSum = min(iSum, vec4(1.0));
-
-        results[ri] += iSum * v4Color;
-        results[ri] = min(results[ri], vec4(1.0));
-        ri+=1;
-    }}
-    
-    // Reserved for rendering with vertex color, routing name is "vertex"
-    if ((renderingFlag >> 1 & 0x1) == 1){{
-        results[ri] = vec4(vColor, 1.0);
-        ri+=1;
-    }}
-    
-    // Reserved for rendering with fixed color, routing name is "pure"
-    if ((renderingFlag >> 2 & 0x1) == 1){{
-        results[ri] = vec4(0, 0, 0, 1.0);
-        ri+=1;
-    }}
-    
-    // Reserved for normal rendering, routing name is "normal"
-    if ((renderingFlag >> 3 & 0x1) == 1){{
-    
-        ////////// Set Normal Rendering
-        // Requirements:
-        //   As a visual debugging mode, you’ll implement a rendering mode that visualizes the vertex normals 
-        //   with color information. In Fragment Shader, use the vertex normal as the vertex color 
-        //   (i.e. the rgb values come from the xyz components of the normal). The value for each dimension in 
-        //   vertex normal will be in the range -1 to 1. You will need to offset and rescale them to the 
-        //   range 0 to 1.
-        vec3 offset_normal = compNormal * 0.5 + 0.5;
-        results[ri] = vec4(offset_normal, 1.0);
-        ri+=1;
-    }}
-    
-    // Reserved for artist rendering, routing name is "artist"
-    if ((renderingFlag >> 5 & 0x1) == 1){{
-    
-        ////////// BONUS 8: Artist Rendering (advanced)
-        // Requirements:
-        //   Look at Section 10.3, “Artistic Shading” in Shirley/Marschner (4th ed.).
-        //        Implement line drawing in shader code
-        //        Implement cool-to-warm shader code
-
-        results[ri] = vec4(0.5, 0.5, 0.5, 1.0);
-        ri+=1;
-    }}
-    
-    // Reserved for some customized rendering, routing name is "custom"
-    if ((renderingFlag >> 6 & 0x1) == 1){{
-        results[ri] = vec4(0.5, 0.5, 0.5, 1.0);
-        ri+=1;
+        
+        float f_shadow = 1.0;
+        if ({_shadowsOn} && {_light}[i].shadowOn)
+            f_shadow = shadowFactor({_light}[i]);
+        
+        iSum += f_shadow * f_radial * f_angular * (i_diffuse + i_specular);
     }}
-    
-    // Reserved for texture mapping, get point color from texture image and texture coordinates
+    // avoid the result is out of bounds
+    iSum = min(iSum, vec4(1.0));
+    litColor = min(litColor + iSum * v4Color, vec4(1.0));
+"""
+            results.append("litColor")
+        if key & (0x1 << 1):
+            body += """
+    // Rendering with vertex color, routing name is "vertex"
+    vec4 vertexColor = vec4(vColor, 1.0);
+"""
+            results.append("vertexColor")
+        if key & (0x1 << 2):
+            body += """
+    // Rendering with fixed color, routing name is "pure"
+    vec4 pureColor = vec4(0, 0, 0, 1.0);
+"""
+            results.append("pureColor")
+        if key & (0x1 << 3):
+            body += """
+    // Normal rendering, routing name is "normal"
+
+    ////////// Set Normal Rendering
+    // Requirements:
+    //   As a visual debugging mode, you’ll implement a rendering mode that visualizes the vertex normals 
+    //   with color information. In Fragment Shader, use the vertex normal as the vertex color 
+    //   (i.e. the rgb values come from the xyz components of the normal). The value for each dimension in 
+    //   vertex normal will be in the range -1 to 1. You will need to offset and rescale them to the 
+    //   range 0 to 1.
+    vec4 normalColor = vec4(compNormal * 0.5 + 0.5, 1.0);
+"""
+            results.append("normalColor")
+        if key & (0x1 << 5):
+            body += """
+    // Artist rendering, routing name is "artist"
+
+    ////////// BONUS 8: Artist Rendering (advanced)
+    // Requirements:
+    //   Look at Section 10.3, “Artistic Shading” in Shirley/Marschner (4th ed.).
+    //        Implement line drawing in shader code
+    //        Implement cool-to-warm shader code
+    vec4 artistColor = vec4(0.5, 0.5, 0.5, 1.0);
+"""
+            results.append("artistColor")
+        if key & (0x1 << 6):
+            body += """
+    // Customized rendering, routing name is "custom"
+    vec4 customColor = vec4(0.5, 0.5, 0.5, 1.0);
+"""
+            results.append("customColor")
+        if key & (0x1 << 8) and not key & 0x1:
+            body += f"""
+    // Texture mapping, get point color from texture image and texture coordinates
     // Routing name is "texture"
-    if (useTexture && !useLighting){{
-        results[ri] = texture({_txtrImg}, vTexture);
-        ri+=1;
-    }}
-    
-    // Mix all result in results array
-    vec4 outputResult=vec4(0.0);
-    for(int i=0; i<ri; i++){{
-        outputResult += results[i]/ri;
-    }}
-    FragColor = outputResult;
+    vec4 textureColor = sampleTexture();
+"""
+            results.append("textureColor")
+
+        if results:
+            output = " + ".join(results) if len(results) == 1 else f"({' + '.join(results)}) / {len(results)}.0"
+        else:
+            output = "vec4(0.0)"
+        fss += f"""
+void main()
+{{
+    vec3 compNormal = vNormal;
+{body}
+    FragColor = {output};
 }}
         """
         # with open("sfile.shader", "w") as f:
@@ -406,10 +705,14 @@ void main()
         if not isinstance(fss, str):
             raise TypeError("Fragment shader source code must be a string")
         self.fragmentShaderSource = fss
+        # a custom fragment shader is used for every routing
+        self.permutationsOn = False
 
     def getAttribLocation(self, name):
+        if name in self.attribLocations:
+            return self.attribLocations[name]
         programName = self.getAttribName(name)
-        attribLoc = gl.glGetAttribLocation(self.program, programName)
+        attribLoc = gl.glGetAttribLocation(self.variant.program, programName)
         if attribLoc == -1 and self.debug > 1:
             print(f"Warning: Attrib {name} cannot found. Might have been optimized off")
         return attribLoc
@@ -419,15 +722,49 @@ void main()
             variableName = self.getAttribName(name)
         else:
             variableName = name
-        uniformLoc = gl.glGetUniformLocation(self.program, variableName)
+        if self.uniformLocations is None:
+            uniformLoc = self.queryUniformLocation(variableName)
+        else:
+            # every active uniform is in the cache, a missing name means it isn't active
+            uniformLoc = self.uniformLocations.get(variableName, -1)
         if uniformLoc == -1 and self.debug > 1:
             print(f"Warning: Uniform {name} cannot found. Might have been optimized off")
         return uniformLoc
 
+    def queryUniformLocation(self, variableName, program=None):
+        self.uniformLocationQueries += 1
+        return gl.glGetUniformLocation(self.variant.program if program is None else program, variableName)
+
+    def cacheUniformLocations(self, program) -> dict:
+        """
+        Enumerate all active uniforms of a linked program and return their locations.
+        Struct members are reported one by one (e.g. "light[3].color"), arrays of basic types only report their
+        first element, so every element of those is resolved here as well.
+        """
+        uniformLocations = {}
+        uniformNum = gl.glGetProgramiv(program, gl.GL_ACTIVE_UNIFORMS)
+        for i in range(uniformNum):
+            uniformName, size, _ = gl.glGetActiveUniform(program, i)
+            if isinstance(uniformName, bytes):
+                uniformName = uniformName.decode()
+            if uniformName.endswith("[0]"):
+                arrayName = uniformName[:-3]
+                for j in range(size):
+                    uniformLocations[f"{arrayName}[{j}]"] = self.queryUniformLocation(f"{arrayName}[{j}]", program)
+                # the bare array name is an alias of its first element
+                uniformLocations[arrayName] = uniformLocations[uniformName]
+            else:
+                uniformLocations[uniformName] = self.queryUniformLocation(uniformName, program)
+        return uniformLocations
+
     def getAttribName(self, attribIndexName):
         return self.attribs[attribIndexName]
 
     def compile(self, vs_src=None, fs_src=None) -> None:
+        """
+        Compile the shaders and link the default variant. Other variants are linked by useVariant when first used.
+        Giving fs_src turns the variants off, that fragment shader draws every routing
+        """
         if vs_src:
             self.set_vss(vs_src)
         else:
@@ -441,21 +778,74 @@ void main()
         if not (vs_src and fs_src):
             raise Exception("shader source code missing")
 
-        vs = self.load_shader(vs_src, gl.GL_VERTEX_SHADER)
-        if not vs:
-            return
+        # the vertex shader is the same in every variant
+        self.vs = self.load_shader(vs_src, gl.GL_VERTEX_SHADER)
+        self.variant = self.linkVariant(self.defaultKey, self.program, fs_src)
+        self.variants[self.defaultKey] = self.variant
+        self.uniformLocations = self.variant.uniformLocations
+        self.ready = True
+        if not self.depthOnly:
+            self.initLightBlock()
+            # samplers of their own types, they must not share a unit with the sampler2D of Texture. The units
+            # below them are given out by GLState.bindTextureToAnyUnit
+            self.shadowTextureUnit = gl.glGetIntegerv(gl.GL_MAX_TEXTURE_IMAGE_UNITS) - 1
+            self.setInt("shadowMaps", self.shadowTextureUnit)
+            self.textureArrayUnit = self.shadowTextureUnit - 1
+            self.setInt("textureArray", self.textureArrayUnit)
+            GLState.reserveTextureUnits(self.textureArrayUnit)
+        else:
+            # the depth-only variant has no lights to upload
+            self.lightsDirty = False
+
+    def linkVariant(self, key, program, fs_src) -> ShaderVariant:
         fs = self.load_shader(fs_src, gl.GL_FRAGMENT_SHADER)
-        if not fs:
-            return
-        gl.glAttachShader(self.program, vs)
-        gl.glAttachShader(self.program, fs)
-        gl.glLinkProgram(self.program)
-        error = gl.glGetProgramiv(self.program, gl.GL_LINK_STATUS)
+        gl.glAttachShader(program, self.vs)
+        gl.glAttachShader(program, fs)
+        for name, location in self.attribLocations.items():
+            gl.glBindAttribLocation(program, location, self.getAttribName(name))
+        gl.glLinkProgram(program)
+        error = gl.glGetProgramiv(program, gl.GL_LINK_STATUS)
+        # the program keeps what it needs, the fragment shader is only used by this variant
+        gl.glDetachShader(program, fs)
+        gl.glDeleteShader(fs)
         if error != gl.GL_TRUE:
-            info = gl.glGetShaderInfoLog(self.program)
+            info = gl.glGetProgramInfoLog(program)
             raise Exception(info)
 
-        self.ready = True
+        variant = ShaderVariant()
+        variant.key = key
+        variant.program = program
+        variant.uniformLocations = self.cacheUniformLocations(program)
+        blockIndex = gl.glGetUniformBlockIndex(program, self.attribs["lightBlock"])
+        if blockIndex != gl.GL_INVALID_INDEX:
+            gl.glUniformBlockBinding(program, blockIndex, self.lightBlockBinding)
+        return variant
+
+    def initLightBlock(self):
+        """
+        Create the uniform buffer behind the light block and attach it to the block's binding point
+        """
+        blockSize = self.lightData.nbytes
+        maxBlockSize = gl.glGetIntegerv(gl.GL_MAX_UNIFORM_BLOCK_SIZE)
+        if blockSize > maxBlockSize:
+            raise Exception(f"{self.attribs['maxLightsNum']} lights need a {blockSize} bytes uniform block, "
+                            f"but this driver only supports {maxBlockSize} bytes")
+
+        self.lightUbo = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self.lightUbo)
+        gl.glBufferData(gl.GL_UNIFORM_BUFFER, blockSize, self.lightData, gl.GL_DYNAMIC_DRAW)
+        gl.glBindBufferBase(gl.GL_UNIFORM_BUFFER, self.lightBlockBinding, self.lightUbo)
+        self.lightsDirty = False
+
+    def flushLights(self):
+        """
+        Upload lightData if it changed. This is a single glBufferSubData no matter how many lights changed
+        """
+        if not self.lightsDirty:
+            return
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self.lightUbo)
+        gl.glBufferSubData(gl.GL_UNIFORM_BUFFER, 0, self.lightData.nbytes, self.lightData)
+        self.lightsDirty = False
 
     def setFragmentShaderRouting(self, routing="lighting"):
         """
@@ -468,29 +858,29 @@ void main()
         "artist": artist rendering
         "custom": some customized rendering
         "texture": this must use previous routing, if set to true, then mix color with texture
+
+        Components with a normal map select their variant with useVariant instead
         """
-        renderingFlag = 0
-        if isinstance(routing, str):
-            routing = routing.lower()
-            if ("lighting" in routing) or ("illumination" in routing):
-                renderingFlag = renderingFlag | 0x1
-            if "vertex" in routing:
-                renderingFlag = renderingFlag | (0x1 << 1)
-            if "pure" in routing:
-                renderingFlag = renderingFlag | (0x1 << 2)
-            if "normal" in routing:
-                renderingFlag = renderingFlag | (0x1 << 3)
-            if "bump" in routing:
-                renderingFlag = renderingFlag | (0x1 << 4)
-            if "artist" in routing:
-                renderingFlag = renderingFlag | (0x1 << 5)
-            if "custom" in routing:
-                renderingFlag = renderingFlag | (0x1 << 6)
-            if "texture" in routing:
-                renderingFlag = renderingFlag | (0x1 << 8)
+        self.useVariant(variantKey(routing))
 
+    def useVariant(self, key):
+        """
+        Make the variant of key current, linking it on first use
+
+        :param key: see variantKey and Component.shaderKey
+        """
+        if not self.ready:
+            raise Exception("GLProgram must compile before use it")
+        if not self.permutationsOn:
+            key = self.defaultKey
+        if key != self.variant.key:
+            variant = self.variants.get(key)
+            if variant is None:
+                variant = self.linkVariant(key, gl.glCreateProgram(), self.genFragShaderSource(key))
+                self.variants[key] = variant
+            self.variant = variant
+            self.uniformLocations = variant.uniformLocations
         self.use()
-        self.setInt("renderingFlag", renderingFlag, lookThroughAttribs=False)
 
     def use(self):
         """
@@ -498,79 +888,154 @@ void main()
         """
         if not self.ready:
             raise Exception("GLProgram must compile before use it")
-        gl.glUseProgram(self.program)
+        GLState.useProgram(self.variant.program)
+        # light changes of this frame are uploaded before the first draw call needs them
+        if self.lightsDirty:
+            self.flushLights()
+        if self.variant.syncedSerial != self.uniformSerial:
+            self.syncUniforms()
+
+    def syncUniforms(self):
+        """
+        Give the current variant the uniform values set since it was current the last time
+        """
+        variant = self.variant
+        # newest first, uniformValues is ordered by serial
+        for variableName in reversed(self.uniformValues):
+            serial, callName, value, setter, args = self.uniformValues[variableName]
+            if serial <= variant.syncedSerial:
+                break
+            GLState.uniform(callName, variant.uniformLocations.get(variableName, -1), value, setter, *args)
+        variant.syncedSerial = self.uniformSerial
+
+    def setUniform(self, name, lookThroughAttribs, callName, value, setter, *args):
+        """
+        Set a uniform on the current variant, and remember it for the others
+
+        :param value: a hashable/comparable representation of the uniform value, see GLState.uniform
+        """
+        self.use()
+        variableName = self.getAttribName(name) if lookThroughAttribs else name
+        last = self.uniformValues.get(variableName)
+        if last is None or last[2] != value:
+            self.uniformSerial += 1
+            # moved to the end, so the values stay in serial order
+            self.uniformValues.pop(variableName, None)
+            self.uniformValues[variableName] = (self.uniformSerial, callName, value, setter, args)
+            self.variant.syncedSerial = self.uniformSerial
+        GLState.uniform(callName, self.getUniformLocation(name, lookThroughAttribs), value, setter, *args)
+
+    def stats(self) -> dict:
+        return {
+            "variants": len(self.variants),
+            "variantKeys": sorted(self.variants),
+            "uniforms": len(self.uniformValues),
+        }
 
     def setLight(self, lightIndex: int, light: Light):
+        """
+        Copy light into slot lightIndex of the light block. The upload happens later, see flushLights
+        """
         if not isinstance(light, Light):
             raise TypeError("light type must be Light")
 
-        _light = self.attribs["light"]
-        self.setBool(f"{_light}[{lightIndex}].on", light.enabled, False)
-        self.setVec3(f"{_light}[{lightIndex}].position", light.position, False)
-        self.setVec4(f"{_light}[{lightIndex}].color", light.color, False)
-        self.setBool(f"{_light}[{lightIndex}].infiniteOn", light.infiniteOn, False)
-        self.setVec3(f"{_light}[{lightIndex}].infiniteDirection", light.position, False)
-        self.setBool(f"{_light}[{lightIndex}].spotOn", light.spotOn, False)
-        self.setVec3(f"{_light}[{lightIndex}].spotDirection", light.spotDirection, False)
-        self.setVec3(f"{_light}[{lightIndex}].spotRadialFactor", light.spotRadialFactor, False)
-        self.setFloat(f"{_light}[{lightIndex}].spotAngleLimit", light.spotAngleLimit, False)
-        self.setFloat(f"{_light}[{lightIndex}].spotExpAttenuation", light.spotExpAttenuation, False)
+        packLight(self.lightData[lightIndex], light)
+        self.lightsDirty = True
+
+    def setInstanceMaterial(self, materialIndex: int, material: Material):
+        """
+        Set one slot of the materials array, which is used by instanced draws
+        """
+        if not isinstance(material, Material):
+            raise TypeError("material type must be Material")
+
+        self.setVec4(f"materials[{materialIndex}].diffuse", material.diffuse)
+        self.setVec4(f"materials[{materialIndex}].specular", material.specular)
+        self.setVec4(f"materials[{materialIndex}].ambient", material.ambient)
+        self.setFloat(f"materials[{materialIndex}].highlight", material.highLight)
 
     def clearAllLights(self):
-        maxLightsNum = int(self.attribs["maxLightsNum"])
-        light = Light()
-        for i in range(maxLightsNum):
-            self.setLight(i, light)
+        self.lightData[:] = np.zeros(1, dtype=lightBlockDtype)
+        self.lightsDirty = True
 
     # some help methods to set uniform in program
+    # values are kept for the other variants and handed to GLState, which skips the GL call when the uniform
+    # already holds the same value
     def setMat4(self, name, mat, lookThroughAttribs=True):
         self.use()
         if mat.shape != (4, 4):
             raise Exception("Projection Matrix must have 4x4 shape")
-        gl.glUniformMatrix4fv(self.getUniformLocation(name, lookThroughAttribs), 1, gl.GL_FALSE, mat.flatten("C"))
+        if lookThroughAttribs and name in ("viewMat", "projectionMat"):
+            setattr(self, name, np.array(mat, dtype=np.float64))
+            self.viewProjectionMat = None
+        data = np.ascontiguousarray(mat, dtype=np.float32).flatten("C")
+        self.setUniform(name, lookThroughAttribs, "glUniformMatrix4fv", data.tobytes(), gl.glUniformMatrix4fv, 1,
+                        gl.GL_FALSE, data)
+
+    def setModelMat(self, modelMat, normalMat=None):
+        """
+        Set the model matrix of the next draws, with its normal matrix and projection * view * model.
+        Matrices are column-major, like transformationMat
+
+        :param normalMat: 3x3 normal matrix of modelMat, computed here if not given, see Component.normalMat
+        """
+        if self.viewProjectionMat is None:
+            viewMat = np.identity(4) if self.viewMat is None else self.viewMat
+            projectionMat = np.identity(4) if self.projectionMat is None else self.projectionMat
+            self.viewProjectionMat = viewMat @ projectionMat
+        self.setMat4("modelMat", modelMat)
+        self.setMat3("normalMat", GLUtility.normalMatrix(modelMat) if normalMat is None else normalMat)
+        self.setMat4("modelViewProjectionMat", modelMat @ self.viewProjectionMat)
 
     def setMat3(self, name, mat, lookThroughAttribs=True):
         self.use()
         if mat.shape != (3, 3):
             raise Exception("Projection Matrix must have 3x3 shape")
-        gl.glUniformMatrix3fv(self.getUniformLocation(name, lookThroughAttribs), 1, gl.GL_FALSE, mat.flatten("C"))
+        data = np.ascontiguousarray(mat, dtype=np.float32).flatten("C")
+        self.setUniform(name, lookThroughAttribs, "glUniformMatrix3fv", data.tobytes(), gl.glUniformMatrix3fv, 1,
+                        gl.GL_FALSE, data)
 
     def setMat2(self, name, mat, lookThroughAttribs=True):
         self.use()
         if mat.shape != (2, 2):
             raise Exception("Projection Matrix must have 2x2 shape")
-        gl.glUniformMatrix2fv(self.getUniformLocation(name, lookThroughAttribs), 1, gl.GL_FALSE, mat.flatten("C"))
+        data = np.ascontiguousarray(mat, dtype=np.float32).flatten("C")
+        self.setUniform(name, lookThroughAttribs, "glUniformMatrix2fv", data.tobytes(), gl.glUniformMatrix2fv, 1,
+                        gl.GL_FALSE, data)
 
     def setVec4(self, name, vec, lookThroughAttribs=True):
         self.use()
         if vec.size != 4:
             raise Exception("Vector must have size 4")
-        gl.glUniform4fv(self.getUniformLocation(name, lookThroughAttribs), 1, vec)
+        data = np.ascontiguousarray(vec, dtype=np.float32)
+        self.setUniform(name, lookThroughAttribs, "glUniform4fv", data.tobytes(), gl.glUniform4fv, 1, data)
 
     def setVec3(self, name, vec, lookThroughAttribs=True):
         self.use()
         if vec.size != 3:
             raise Exception("Vector must have size 3")
-        gl.glUniform3fv(self.getUniformLocation(name, lookThroughAttribs), 1, vec)
+        data = np.ascontiguousarray(vec, dtype=np.float32)
+        self.setUniform(name, lookThroughAttribs, "glUniform3fv", data.tobytes(), gl.glUniform3fv, 1, data)
 
     def setVec2(self, name, vec, lookThroughAttribs=True):
         self.use()
         if vec.size != 2:
             raise Exception("Vector must have size 2")
-        gl.glUniform2fv(self.getUniformLocation(name, lookThroughAttribs), 1, vec)
+        data = np.ascontiguousarray(vec, dtype=np.float32)
+        self.setUniform(name, lookThroughAttribs, "glUniform2fv", data.tobytes(), gl.glUniform2fv, 1, data)
 
     def setBool(self, name, value, lookThroughAttribs=True):
         self.use()
         if value not in (0, 1):
             raise Exception("bool only accept True/False/0/1")
-        gl.glUniform1i(self.getUniformLocation(name, lookThroughAttribs), int(value))
+        self.setUniform(name, lookThroughAttribs, "glUniform1i", int(value), gl.glUniform1i, int(value))
 
     def setInt(self, name, value, lookThroughAttribs=True):
         self.use()
         if value != int(value):
             raise Exception("set int only accept  integer")
-        gl.glUniform1i(self.getUniformLocation(name, lookThroughAttribs), int(value))
+        self.setUniform(name, lookThroughAttribs, "glUniform1i", int(value), gl.glUniform1i, int(value))
 
     def setFloat(self, name, value, lookThroughAttribs=True):
         self.use()
-        gl.glUniform1f(self.getUniformLocation(name, lookThroughAttribs), float(value))
+        self.setUniform(name, lookThroughAttribs, "glUniform1f", float(value), gl.glUniform1f, float(value))
@@ -0,0 +1,188 @@
+"""
+Shadow the OpenGL state we change most often and skip calls that would not change it.
+Tracked state: current program, bound VAO, active texture unit, texture bound to every unit and uniform values of
+every program. All these calls must go through this class, otherwise the shadow state gets out of sync; call
+reset() whenever the GL context is recreated.
+
+Texture units are not owned by textures: bindTextureToAnyUnit hands one out when a texture is bound for a draw,
+keeping textures on the unit they already occupy, so any number of textures can be drawn without aliasing.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import numpy as np
+
+try:
+    import OpenGL
+
+    try:
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+    except ImportError:
+        from ctypes import util
+
+        orig_util_find_library = util.find_library
+
+
+        def new_util_find_library(name):
+            res = orig_util_find_library(name)
+            if res:
+                return res
+            return '/System/Library/Frameworks/' + name + '.framework/' + name
+
+
+        util.find_library = new_util_find_library
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+except ImportError:
+    raise ImportError("Required dependency PyOpenGL not present")
+
+
+class GLState:
+    program = None
+    vertexArray = None
+    activeTextureUnit = None
+    boundTextures = {}  # (texture unit, target) -> texture name, every target of a unit has its own binding
+    uniformValues = {}  # (program, location) -> last value set
+
+    # texture unit allocation, see bindTextureToAnyUnit
+    textureUnitCount = 14  # units handed out are 0 .. textureUnitCount - 1, the units above have fixed uses
+    textureUnitUses = {}  # texture unit -> value of textureUseCounter when it was last used
+    textureUseCounter = 0
+    batchTextureUnits = set()  # units holding a texture of the current draw, they are not given away
+
+    # statistics, call name -> [issued, elided]
+    frameCalls = {}
+    lastFrameCalls = {}
+
+    @classmethod
+    def reset(cls):
+        """
+        Forget everything, the next call of each kind is always issued
+        """
+        cls.program = None
+        cls.vertexArray = None
+        cls.activeTextureUnit = None
+        cls.boundTextures = {}
+        cls.uniformValues = {}
+        cls.textureUnitUses = {}
+        cls.batchTextureUnits = set()
+
+    @classmethod
+    def count(cls, callName, issued):
+        counter = cls.frameCalls.setdefault(callName, [0, 0])
+        counter[0 if issued else 1] += 1
+        return issued
+
+    @classmethod
+    def beginFrame(cls):
+        cls.lastFrameCalls = cls.frameCalls
+        cls.frameCalls = {}
+
+    @classmethod
+    def stats(cls) -> dict:
+        """
+        Issued and elided call counts of the last complete frame
+        """
+        issued = sum(c[0] for c in cls.lastFrameCalls.values())
+        elided = sum(c[1] for c in cls.lastFrameCalls.values())
+        return {"issued": issued, "elided": elided,
+                "calls": {k: tuple(v) for k, v in sorted(cls.lastFrameCalls.items())}}
+
+    @classmethod
+    def useProgram(cls, program):
+        if cls.count("glUseProgram", cls.program != program):
+            gl.glUseProgram(program)
+            cls.program = program
+
+    @classmethod
+    def bindVertexArray(cls, vertexArray):
+        if cls.count("glBindVertexArray", cls.vertexArray != vertexArray):
+            gl.glBindVertexArray(vertexArray)
+            cls.vertexArray = vertexArray
+
+    @classmethod
+    def forgetVertexArray(cls, vertexArray):
+        # a deleted VAO is unbound by GL
+        if cls.vertexArray == vertexArray:
+            cls.vertexArray = 0
+
+    @classmethod
+    def activeTexture(cls, unit):
+        if cls.count("glActiveTexture", cls.activeTextureUnit != unit):
+            gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+            cls.activeTextureUnit = unit
+
+    @classmethod
+    def bindTexture(cls, unit, textureName, target=gl.GL_TEXTURE_2D):
+        if cls.count("glBindTexture", cls.boundTextures.get((unit, target)) != textureName):
+            cls.activeTexture(unit)
+            gl.glBindTexture(target, textureName)
+            cls.boundTextures[unit, target] = textureName
+
+    @classmethod
+    def reserveTextureUnits(cls, unitCount):
+        """
+        Only hand out units below unitCount, the units from unitCount on are bound by their users directly
+        """
+        cls.textureUnitCount = unitCount
+        cls.textureUnitUses = {unit: use for unit, use in cls.textureUnitUses.items() if unit < unitCount}
+
+    @classmethod
+    def beginTextureBatch(cls):
+        """
+        Start a new draw, or a batch of draws sharing textures. Units used since the last call may be given away
+        """
+        cls.batchTextureUnits = set()
+
+    @classmethod
+    def bindTextureToAnyUnit(cls, textureName, target=gl.GL_TEXTURE_2D, pinned=True) -> int:
+        """
+        Bind a texture to a unit for the current draw and return the unit. A texture still bound by an earlier draw
+        keeps its unit, otherwise the least recently used unit that the current draw doesn't use is taken
+
+        :param textureName: texture to bind, 0 gives a unit with nothing bound, which samples black
+        :param pinned: keep the unit for the rest of the draw. Uploads outside of draws don't need to
+        :rtype: int
+        """
+        units = range(cls.textureUnitCount)
+        unit = next((u for u in units if cls.boundTextures.get((u, target)) == textureName), None)
+        if unit is None:
+            free = [u for u in units if u not in cls.batchTextureUnits]
+            if not free:
+                raise Exception(f"A draw needs more than {cls.textureUnitCount} textures")
+            unit = min(free, key=lambda u: cls.textureUnitUses.get(u, -1))
+            cls.bindTexture(unit, textureName, target)
+        else:
+            cls.count("glBindTexture", False)
+        cls.textureUseCounter += 1
+        cls.textureUnitUses[unit] = cls.textureUseCounter
+        if pinned:
+            cls.batchTextureUnits.add(unit)
+        return unit
+
+    @classmethod
+    def forgetTexture(cls, textureName):
+        # a deleted texture is unbound from every unit by GL
+        for binding, name in list(cls.boundTextures.items()):
+            if name == textureName:
+                cls.boundTextures[binding] = 0
+
+    @classmethod
+    def uniform(cls, callName, location, value, setter, *args):
+        """
+        Call setter(location, *args) unless the current program already has value at location
+
+        :param callName: name of the GL call, only used for statistics
+        :param value: a hashable/comparable representation of the uniform value
+        """
+        if location == -1:
+            return
+        key = (cls.program, location)
+        if cls.count(callName, cls.uniformValues.get(key) != value):
+            setter(location, *args)
+            cls.uniformValues[key] = value
+
+    @staticmethod
+    def arrayValue(array) -> bytes:
+        return np.ascontiguousarray(array, dtype=np.float32).tobytes()
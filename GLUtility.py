@@ -107,6 +107,20 @@ class GLUtility:
         result[3, 2] = -1
         return result.transpose() if columnMajor else result
 
+    @staticmethod
+    def orthographic(left, right, bottom, top, znear, zfar, columnMajor=True):
+        """
+        get orthographic projection matrix, the box is given in view space like glOrtho
+        """
+        result = np.identity(4)
+        result[0, 0] = 2 / (right - left)
+        result[1, 1] = 2 / (top - bottom)
+        result[2, 2] = - 2 / (zfar - znear)
+        result[0, 3] = - (right + left) / (right - left)
+        result[1, 3] = - (top + bottom) / (top - bottom)
+        result[2, 3] = - (zfar + znear) / (zfar - znear)
+        return result.transpose() if columnMajor else result
+
     @staticmethod
     def translate(x, y, z, columnMajor=True):
         """
@@ -152,3 +166,19 @@ class GLUtility:
         result[3, 3] = 1
 
         return result.transpose() if columnMajor else result
+
+    @staticmethod
+    def normalMatrix(transformationMats):
+        """
+        3x3 matrices transforming normals, the inverse transpose of the linear part of column-major transformation
+        matrices. Batched: (..., 4, 4) in, (..., 3, 3) column-major out
+
+        Built from the cofactors, so singular matrices (zero scaling) still give a finite result
+        """
+        linear = np.asarray(transformationMats, dtype=np.float64)[..., 0:3, 0:3]
+        rows = [linear[..., i, :] for i in range(3)]
+        cofactors = np.stack([np.cross(rows[1], rows[2]), np.cross(rows[2], rows[0]), np.cross(rows[0], rows[1])],
+                             axis=-2)
+        determinants = np.sum(rows[0] * cofactors[..., 0, :], axis=-1)
+        determinants = np.where(determinants == 0, 1, determinants)
+        return cofactors / determinants[..., None, None]
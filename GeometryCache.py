@@ -0,0 +1,211 @@
+"""
+Define a process-wide registry of GPU meshes, so identical Displayable objects share one VAO/VBO/EBO
+Meshes are content-addressed: the key is the Displayable type, the GLProgram it is bound to and a digest of its
+generated vertex and index arrays. All generate parameters (radius, slices, stacks, color, texture units, ...)
+end up in those arrays, so equal parameters always hit the same entry.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import hashlib
+
+import numpy as np
+
+from GLBuffer import VAO, VBO, EBO
+from GLState import GLState
+
+try:
+    import OpenGL
+
+    try:
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+    except ImportError:
+        from ctypes import util
+
+        orig_util_find_library = util.find_library
+
+
+        def new_util_find_library(name):
+            res = orig_util_find_library(name)
+            if res:
+                return res
+            return '/System/Library/Frameworks/' + name + '.framework/' + name
+
+
+        util.find_library = new_util_find_library
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+except ImportError:
+    raise ImportError("Required dependency PyOpenGL not present")
+
+
+class SharedMesh:
+    """
+    One set of GL buffers plus the CPU arrays they were uploaded from
+    """
+    key = None
+    vao = None
+    vbo = None
+    ebo = None
+    vertices = None
+    indices = None
+    refCount = 0
+    uploaded = False
+
+    # per-instance data for instanced draws, see drawInstanced
+    instanceVbo = None
+    instanceAttribsSet = False
+
+    def __init__(self, key, vertices, indices):
+        self.key = key
+        self.vertices = vertices
+        self.indices = indices
+        self.refCount = 0
+        self.uploaded = False
+        self.vao = VAO()
+        self.vbo = VBO()
+        self.ebo = EBO()
+
+    @property
+    def nbytes(self) -> int:
+        # VBO stores float32 and EBO stores int32, see GLBuffer
+        return 4 * (self.vertices.size + self.indices.size)
+
+    def initialize(self, shaderProg):
+        """
+        Upload the arrays and set up attribute pointers, only the first call does any GL work
+        """
+        if self.uploaded:
+            return
+        self.vao.bind()
+        self.vbo.setBuffer(self.vertices, 11)
+        self.ebo.setBuffer(self.indices)
+
+        self.vbo.setAttribPointer(shaderProg.getAttribLocation("vertexPos"),
+                                  stride=11, offset=0, attribSize=3)
+        self.vbo.setAttribPointer(shaderProg.getAttribLocation("vertexNormal"),
+                                  stride=11, offset=3, attribSize=3)
+        self.vbo.setAttribPointer(shaderProg.getAttribLocation("vertexColor"),
+                                  stride=11, offset=6, attribSize=3)
+        self.vbo.setAttribPointer(shaderProg.getAttribLocation("vertexTexture"),
+                                  stride=11, offset=9, attribSize=2)
+        self.vao.unbind()
+        self.uploaded = True
+
+    def draw(self):
+        # the VAO stays bound, so consecutive draws of the same mesh skip the rebind, see GLState
+        self.vao.bind()
+        self.ebo.draw()
+
+    def drawInstanced(self, shaderProg, instanceData: np.ndarray):
+        """
+        Draw this mesh once per row of instanceData with a single glDrawElementsInstanced call
+
+        :param instanceData: (N, 27) array, a flattened 4x4 model matrix, its flattened 3x3 normal matrix, an index
+            into the materials array and a layer of the bound texture array
+        :type instanceData: numpy.ndarray
+        """
+        if self.instanceVbo is None:
+            self.instanceVbo = VBO()
+        self.vao.bind()
+        self.instanceVbo.setBuffer(instanceData, 27, gl.GL_DYNAMIC_DRAW)
+        if not self.instanceAttribsSet:
+            # a mat4 attribute takes four consecutive locations, one per column, a mat3 three
+            modelLoc = shaderProg.getAttribLocation("instanceModel")
+            if modelLoc >= 0:
+                for i in range(4):
+                    self.instanceVbo.setInstancedAttribPointer(modelLoc + i, stride=27, offset=4 * i, attribSize=4)
+            normalLoc = shaderProg.getAttribLocation("instanceNormal")
+            if normalLoc >= 0:
+                for i in range(3):
+                    self.instanceVbo.setInstancedAttribPointer(normalLoc + i, stride=27, offset=16 + 3 * i,
+                                                               attribSize=3)
+            self.instanceVbo.setInstancedAttribPointer(shaderProg.getAttribLocation("instanceMaterialIndex"),
+                                                       stride=27, offset=25, attribSize=1)
+            self.instanceVbo.setInstancedAttribPointer(shaderProg.getAttribLocation("instanceTextureLayer"),
+                                                       stride=27, offset=26, attribSize=1)
+            self.instanceAttribsSet = True
+        self.ebo.drawInstanced(instanceData.shape[0])
+
+    def delete(self):
+        GLState.forgetVertexArray(self.vao.vao)
+        gl.glDeleteVertexArrays(1, [self.vao.vao])
+        gl.glDeleteBuffers(2, [self.vbo.vbo, self.ebo.ebo])
+        if self.instanceVbo is not None:
+            gl.glDeleteBuffers(1, [self.instanceVbo.vbo])
+            self.instanceVbo = None
+            self.instanceAttribsSet = False
+        self.uploaded = False
+
+
+class GeometryCache:
+    """
+    Reference counted SharedMesh registry. Use acquire/release in pairs, GL buffers are freed when the last
+    user releases its mesh.
+    """
+    meshes = {}
+
+    # statistics
+    hits = 0
+    misses = 0
+    bytesSaved = 0
+
+    @staticmethod
+    def meshKey(displayable) -> tuple:
+        digest = hashlib.sha1()
+        digest.update(np.ascontiguousarray(displayable.vertices, dtype=np.float32).tobytes())
+        digest.update(np.ascontiguousarray(displayable.indices, dtype=np.int32).tobytes())
+        return type(displayable).__name__, displayable.shaderProg.program, digest.hexdigest()
+
+    @classmethod
+    def acquire(cls, displayable) -> SharedMesh:
+        """
+        Get the shared mesh for a generated Displayable, creating it on first use
+
+        :param displayable: a Displayable whose vertices and indices are already generated
+        :rtype: SharedMesh
+        """
+        key = cls.meshKey(displayable)
+        mesh = cls.meshes.get(key)
+        if mesh is None:
+            mesh = SharedMesh(key, displayable.vertices, displayable.indices)
+            cls.meshes[key] = mesh
+            cls.misses += 1
+        else:
+            cls.hits += 1
+            cls.bytesSaved += mesh.nbytes
+        mesh.refCount += 1
+        return mesh
+
+    @classmethod
+    def release(cls, mesh: SharedMesh):
+        mesh.refCount -= 1
+        if mesh.refCount <= 0 and cls.meshes.get(mesh.key) is mesh:
+            del cls.meshes[mesh.key]
+            mesh.delete()
+
+    @classmethod
+    def clear(cls):
+        """
+        Forget every mesh without deleting it, for a new OpenGL context. The old context owns their buffers, and
+        its program names, which the cache keys hold, may be handed out again by the new one
+        """
+        cls.meshes = {}
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "meshes": len(cls.meshes),
+            "references": sum(m.refCount for m in cls.meshes.values()),
+            "hits": cls.hits,
+            "misses": cls.misses,
+            "bytesSaved": cls.bytesSaved,
+            "bytesUploaded": sum(m.nbytes for m in cls.meshes.values()),
+        }
+
+    @classmethod
+    def resetStats(cls):
+        cls.hits = 0
+        cls.misses = 0
+        cls.bytesSaved = 0
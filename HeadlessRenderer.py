@@ -0,0 +1,432 @@
+"""
+Render the scenes without a window. An EGL or OSMesa context is created without any display and the scenes are
+drawn into a framebuffer object with the same GLProgram, Component tree and Scene classes Sketch uses, so this
+runs on render nodes and CI machines with no display or GPU. Command line usage:
+
+    python HeadlessRenderer.py --scene 3 --width 1280 --height 720 --theta 90 --phi 30 --output scene3.png
+
+EGL uses the surfaceless platform by default, pass --backend osmesa (or set PYOPENGL_PLATFORM=osmesa) for a pure
+software context. With --tracer the image is ray traced on the CPU by RayTracer instead, with shadows, in tiles over
+--processes worker processes (see TileRenderer). --scaling times the traced image with 1 to --processes workers.
+--samples turns on progressive rendering with adaptive sampling (see ProgressiveRenderer). --texture-report prints
+the video memory taken by the textures of every scene, block compressed and not (see TextureCache).
+Import this module before any other module of the program, PyOpenGL binds to its platform the first time it is
+imported.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import argparse
+import ctypes
+import math
+import os
+import random
+import sys
+
+
+def parseBackend(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--backend", choices=("egl", "osmesa"), default=os.environ.get("PYOPENGL_PLATFORM", "egl"))
+    return parser.parse_known_args(argv)[0].backend
+
+
+BACKEND = parseBackend(sys.argv[1:])
+os.environ["PYOPENGL_PLATFORM"] = BACKEND
+if BACKEND == "egl":
+    # Mesa's default EGL platform wants a display server
+    os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+
+import numpy as np
+from PIL import Image
+
+try:
+    import OpenGL
+    import OpenGL.GL as gl
+except ImportError:
+    raise ImportError("Required dependency PyOpenGL not present")
+
+import ColorType
+from Component import Component
+from Frustum import Frustum
+from GeometryCache import GeometryCache
+from GLBuffer import FBO
+from GLProgram import GLProgram
+from GLState import GLState
+from GLUtility import GLUtility
+from InstancedRenderer import InstancedRenderer
+from Point import Point
+from TextureCache import TextureCache
+from ProgressiveRenderer import ProgressiveRenderer
+from RayTracer import RayTracer
+from ShadowMaps import ShadowMaps
+from TileRenderer import TileRenderer
+from SceneFour import SceneFour
+from SceneOne import SceneOne
+from SceneThree import SceneThree
+from SceneTwo import SceneTwo
+
+
+class EGLContext:
+    """
+    OpenGL 3.3 core context on the default EGL display, with a 1x1 pbuffer surface. Draw into an FBO
+    """
+    display = None
+    surface = None
+    context = None
+
+    def __init__(self):
+        from OpenGL import EGL
+
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        major, minor = EGL.EGLint(), EGL.EGLint()
+        if not EGL.eglInitialize(self.display, ctypes.pointer(major), ctypes.pointer(minor)):
+            raise Exception("Cannot initialize EGL display")
+
+        configAttribs = [EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                         EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8,
+                         EGL.EGL_DEPTH_SIZE, 24,
+                         EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+                         EGL.EGL_NONE]
+        config = EGL.EGLConfig()
+        configNum = EGL.EGLint()
+        if not EGL.eglChooseConfig(self.display, (EGL.EGLint * len(configAttribs))(*configAttribs),
+                                   ctypes.pointer(config), 1, ctypes.pointer(configNum)) or configNum.value == 0:
+            raise Exception("No EGL config supports OpenGL rendering")
+
+        surfaceAttribs = [EGL.EGL_WIDTH, 1, EGL.EGL_HEIGHT, 1, EGL.EGL_NONE]
+        self.surface = EGL.eglCreatePbufferSurface(self.display, config,
+                                                   (EGL.EGLint * len(surfaceAttribs))(*surfaceAttribs))
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        contextAttribs = [EGL.EGL_CONTEXT_MAJOR_VERSION, 3, EGL.EGL_CONTEXT_MINOR_VERSION, 3,
+                          EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+                          EGL.EGL_NONE]
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT,
+                                            (EGL.EGLint * len(contextAttribs))(*contextAttribs))
+        if not self.context:
+            raise Exception("Cannot create an OpenGL 3.3 core context with EGL")
+        self.makeCurrent()
+
+    def makeCurrent(self):
+        from OpenGL import EGL
+        if not EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context):
+            raise Exception("Cannot make the EGL context current")
+
+    def destroy(self):
+        from OpenGL import EGL
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglDestroySurface(self.display, self.surface)
+        EGL.eglTerminate(self.display)
+
+
+class OSMesaContext:
+    """
+    OpenGL 3.3 core software context from OSMesa, bound to a 1x1 client buffer. Draw into an FBO
+    """
+    context = None
+    buffer = None
+
+    def __init__(self):
+        from OpenGL import osmesa
+
+        attribs = [osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+                   osmesa.OSMESA_DEPTH_BITS, 24,
+                   osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+                   osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 3, osmesa.OSMESA_CONTEXT_MINOR_VERSION, 3,
+                   0]
+        self.context = osmesa.OSMesaCreateContextAttribs(attribs, None)
+        if not self.context:
+            raise Exception("Cannot create an OpenGL 3.3 core context with OSMesa")
+        self.buffer = (ctypes.c_ubyte * 4)()
+        self.makeCurrent()
+
+    def makeCurrent(self):
+        from OpenGL import osmesa
+        if not osmesa.OSMesaMakeCurrent(self.context, self.buffer, gl.GL_UNSIGNED_BYTE, 1, 1):
+            raise Exception("Cannot make the OSMesa context current")
+
+    def destroy(self):
+        from OpenGL import osmesa
+        osmesa.OSMesaDestroyContext(self.context)
+
+
+class HeadlessRenderer:
+    """
+    Offscreen counterpart of Sketch: same camera model, lighting switches and draw path, no wx and no window
+    """
+    width = 0
+    height = 0
+    context = None
+    fbo: FBO = None
+
+    shaderProg: GLProgram = None
+    glutility: GLUtility = None
+    instancedRenderer: InstancedRenderer = None
+    topLevelComponent: Component = None
+    scene = None
+
+    backgroundColor = None
+    lookAtPt = None
+    upVector = None
+    cameraDis = None
+    cameraTheta = None  # theta on horizontal sphere cut, in radians
+    cameraPhi = None  # elevation, in radians
+
+    viewMat = None
+    perspMat = None
+
+    ambientOn: bool = True
+    diffuseOn: bool = True
+    specularOn: bool = True
+    cullingOn: bool = True
+    shadowsOn: bool = True
+    shadowMaps: ShadowMaps = None
+
+    sceneList = [SceneOne, SceneTwo, SceneThree, SceneFour]
+
+    def __init__(self, width, height, backend=BACKEND):
+        """
+        :param width: image width in pixels
+        :param height: image height in pixels
+        :param backend: "egl" or "osmesa", must match the platform PyOpenGL was loaded with
+        """
+        if backend != BACKEND:
+            raise ValueError(f"PyOpenGL was loaded for {BACKEND}, cannot create a {backend} context")
+        self.width = width
+        self.height = height
+        self.context = EGLContext() if backend == "egl" else OSMesaContext()
+        self.fbo = FBO(width, height)
+
+        # a new context starts with default state and no textures
+        GLState.reset()
+        TextureCache.clear()
+        GeometryCache.clear()
+        self.shaderProg = GLProgram()
+        self.shaderProg.compile()
+        self.glutility = GLUtility()
+        self.instancedRenderer = InstancedRenderer()
+        self.shadowMaps = ShadowMaps(self.shaderProg)
+        self.topLevelComponent = Component(Point((0, 0, 0)))
+        self.backgroundColor = ColorType.getGrayColor(0.05)
+        self.setCamera()
+
+        gl.glClearDepth(1.0)
+        gl.glViewport(0, 0, width, height)
+        gl.glEnable(gl.GL_DEPTH_TEST)
+
+        self.perspMat = self.glutility.perspective(45, width, height, 0.01, 100)
+        self.shaderProg.setMat4("projectionMat", self.perspMat)
+        self.shaderProg.setModelMat(np.identity(4))
+        self.updateLight()
+
+    def setCamera(self, distance=6, theta=math.pi / 2, phi=math.pi / 6, lookAt=(0, 0, 0)):
+        """
+        Orbit camera, same parameters as Sketch's mouse controlled camera
+
+        :param distance: distance to the look at point
+        :param theta: angle on the horizontal plane, in radians
+        :param phi: elevation angle, in radians
+        :param lookAt: the point the camera looks at
+        """
+        self.cameraDis = distance
+        self.cameraTheta = theta
+        self.cameraPhi = phi
+        self.lookAtPt = list(lookAt)
+        self.upVector = [0, 1, 0]
+
+    def getCameraPos(self):
+        ct = math.cos(self.cameraTheta)
+        st = math.sin(self.cameraTheta)
+        cp = math.cos(self.cameraPhi)
+        sp = math.sin(self.cameraPhi)
+        return [self.lookAtPt[0] + self.cameraDis * ct * cp,
+                self.lookAtPt[1] + self.cameraDis * sp,
+                self.lookAtPt[2] + self.cameraDis * st * cp]
+
+    def updateLight(self):
+        self.shaderProg.setBool('specularOn', self.specularOn)
+        self.shaderProg.setBool('diffuseOn', self.diffuseOn)
+        self.shaderProg.setBool('ambientOn', self.ambientOn)
+
+    def setScene(self, index):
+        """
+        :param index: index into sceneList, 0 for SceneOne
+        """
+        self.scene = self.sceneList[index](self.shaderProg)
+        self.topLevelComponent.clear()
+        self.topLevelComponent.addChild(self.scene)
+        self.topLevelComponent.initialize()
+        # images are rendered with their final textures, not with the placeholders
+        TextureCache.finishLoading()
+
+    def draw(self):
+        """
+        Draw the current scene into the framebuffer, without reading it back
+        """
+        self.fbo.bind()
+        GLState.beginFrame()
+        TextureCache.uploadReady()
+        gl.glClearColor(*self.backgroundColor, 1.0)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+
+        self.viewMat = self.glutility.view(self.getCameraPos(), self.lookAtPt, self.upVector)
+        self.shaderProg.setMat4("viewMat", self.viewMat)
+        self.shaderProg.setVec3("viewPosition", np.array(self.getCameraPos()))
+
+        self.topLevelComponent.update(np.identity(4))
+        self.shadowMaps.shadowsOn = self.shadowsOn
+        self.shadowMaps.update(self.topLevelComponent, self.scene.lightCubes if self.scene else ())
+        frustum = Frustum(self.perspMat, self.viewMat) if self.cullingOn else None
+        self.instancedRenderer.draw(self.topLevelComponent, self.shaderProg, frustum)
+
+    def render(self) -> np.ndarray:
+        """
+        Draw the current scene and read it back
+
+        :return: (height, width, 3) uint8 RGB image
+        """
+        self.draw()
+        return self.fbo.readPixels()[..., 0:3]
+
+    def makeTracer(self) -> RayTracer:
+        """
+        RayTracer of the current scene, from the same camera and with the same lighting switches
+        """
+        return RayTracer.fromView(self, self.width, self.height)
+
+    def trace(self, processes=1, progress=None) -> np.ndarray:
+        """
+        Ray trace the current scene on the CPU
+
+        :param processes: worker processes tracing the tiles of the image
+        :param progress: function(done, total) called after every tile
+        :return: (height, width, 3) uint8 RGB image
+        """
+        return TileRenderer(processes, progress=progress).render(self.makeTracer())
+
+    def traceProgressive(self, maxSamples=64, threshold=0.005, progress=None) -> np.ndarray:
+        """
+        Ray trace the current scene with adaptive sampling, see ProgressiveRenderer
+
+        :param progress: function(passes, activePixels) called after every pass
+        :return: (height, width, 3) uint8 RGB image
+        """
+        return ProgressiveRenderer(self.makeTracer(), maxSamples, threshold).render(progress)
+
+    def save(self, path, traced=False, processes=1, progress=None):
+        image = self.trace(processes, progress) if traced else self.render()
+        Image.fromarray(np.ascontiguousarray(image)).save(path)
+
+    def destroy(self):
+        """
+        Delete the scene and the OpenGL objects of this renderer while its context is still current, then the
+        context, so another HeadlessRenderer can be created afterwards
+        """
+        self.topLevelComponent.clear()
+        self.scene = None
+        self.instancedRenderer.textureArrays.delete()
+        self.shadowMaps.delete()
+        self.shaderProg.delete()
+        self.fbo.delete()
+        self.context.destroy()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a scene to PNG without a window")
+    parser.add_argument("--backend", choices=("egl", "osmesa"), default=BACKEND,
+                        help="offscreen OpenGL context, default egl")
+    parser.add_argument("--scene", type=int, default=1, choices=range(1, 5), help="1 to 4, SceneOne..SceneFour")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--distance", type=float, default=6, help="camera distance to the look at point")
+    parser.add_argument("--theta", type=float, default=90, help="camera angle on the horizontal plane, in degrees")
+    parser.add_argument("--phi", type=float, default=30, help="camera elevation, in degrees")
+    parser.add_argument("--look-at", type=float, nargs=3, default=(0, 0, 0), metavar=("X", "Y", "Z"))
+    parser.add_argument("--seed", type=int, default=0, help="random seed used to build the scene")
+    parser.add_argument("--tracer", action="store_true", help="ray trace on the CPU instead of rasterizing")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="ray tracing processes")
+    parser.add_argument("--samples", type=int, default=1,
+                        help="with --tracer, maximal samples per pixel of progressive adaptive sampling, 1 to disable")
+    parser.add_argument("--threshold", type=float, default=0.005,
+                        help="standard error of a pixel's luminance at which adaptive sampling stops")
+    parser.add_argument("--scaling", action="store_true",
+                        help="time the ray traced image with 1 to --processes processes instead of saving it")
+    parser.add_argument("--no-shadows", action="store_true", help="rasterize without shadow maps")
+    parser.add_argument("--no-compress", action="store_true",
+                        help="upload the textures uncompressed even if the context supports their block format")
+    parser.add_argument("--texture-report", action="store_true",
+                        help="print the texture memory of every scene instead of saving an image")
+    parser.add_argument("--output", default=None, help="PNG file, default sceneN.png")
+    args = parser.parse_args(argv)
+    output = os.path.abspath(args.output or f"scene{args.scene}.png")
+    # scenes load their assets relative to the program directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    renderer = HeadlessRenderer(args.width, args.height, args.backend)
+    renderer.shadowsOn = not args.no_shadows
+    TextureCache.compressionOn = not args.no_compress
+    if args.texture_report:
+        printTextureReport(renderer, args.seed)
+        renderer.destroy()
+        return
+    random.seed(args.seed)
+    renderer.setScene(args.scene - 1)
+    renderer.setCamera(args.distance, math.radians(args.theta), math.radians(args.phi), args.look_at)
+    if args.scaling:
+        printScaling(renderer.makeTracer(), args.processes)
+        renderer.destroy()
+        return
+    if args.tracer and args.samples > 1:
+        image = renderer.traceProgressive(args.samples, args.threshold, printPasses)
+        Image.fromarray(image).save(output)
+    else:
+        renderer.save(output, args.tracer, args.processes, printProgress)
+    renderer.destroy()
+    print("Saved", output)
+
+
+def printProgress(done, total):
+    print(f"\rtraced {done}/{total} tiles", end="\n" if done == total else "", file=sys.stderr, flush=True)
+
+
+def printPasses(passes, activePixels):
+    print(f"pass {passes}: {activePixels} pixels still sampled", file=sys.stderr, flush=True)
+
+
+def printScaling(tracer: RayTracer, maxProcesses):
+    """
+    Trace the same image with 1 to maxProcesses processes. Efficiency is the speedup over one process divided by
+    the number of processes, 1 is linear scaling
+    """
+    print(f"{'processes':>10}{'time (s)':>10}{'speedup':>10}{'efficiency':>12}{'Mrays/s':>10}")
+    single = None
+    for processes in range(1, maxProcesses + 1):
+        renderer = TileRenderer(processes)
+        renderer.render(tracer)
+        elapsed = renderer.renderTime
+        single = single or elapsed
+        rays = (renderer.primaryRays + renderer.shadowRays) / elapsed / 1e6
+        print(f"{processes:>10}{elapsed:>10.2f}{single / elapsed:>10.2f}{single / elapsed / processes:>12.2f}"
+              f"{rays:>10.2f}")
+
+
+def printTextureReport(renderer: HeadlessRenderer, seed):
+    """
+    Build and draw every scene and print the video memory its textures take as uploaded, and uncompressed. The
+    texture arrays of the frame are counted with the textures
+    """
+    print(f"{'scene':>6}{'textures':>10}{'compressed':>12}{'arrays (MB)':>13}{'uploaded (MB)':>15}"
+          f"{'uncompressed (MB)':>19}{'saved':>8}")
+    for index in range(len(renderer.sceneList)):
+        random.seed(seed)
+        renderer.setScene(index)
+        renderer.draw()
+        report = TextureCache.vramReport(renderer.topLevelComponent, renderer.instancedRenderer.textureArrays)
+        uncompressed = report["uncompressedBytes"]
+        saved = report["savedBytes"] / uncompressed if uncompressed else 0
+        print(f"{index + 1:>6}{report['textures']:>10}{report['compressed']:>12}{report['arrayBytes'] / 2 ** 20:>13.1f}"
+              f"{report['uploadedBytes'] / 2 ** 20:>15.1f}{uncompressed / 2 ** 20:>19.1f}{saved:>8.0%}")
+
+
+if __name__ == "__main__":
+    main()
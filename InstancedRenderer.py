@@ -0,0 +1,180 @@
+"""
+Draw a Component tree with hardware instancing. Components which share a mesh (see GeometryCache), a shader
+variant and the same texture images are collected into one batch and drawn with a single
+glDrawElementsInstanced call. Model matrices and material indices go to the mesh's instance VBO, materials of a
+batch go to the materials uniform array of GLProgram.
+
+With texture arrays on, components which only differ by a texture of the same size are batched too: their textures
+are layers of one texture array (see TextureArrays) and every instance gets the index of its layer.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import numpy as np
+
+from Component import Component
+from Displayable import Displayable
+from Frustum import Frustum
+from GLProgram import GLProgram
+from RenderQueue import RenderQueue
+from TextureArrays import TextureArrays
+
+
+class InstancedRenderer:
+    """
+    Batches are rebuilt every frame, so routing switches (light turn_on/turn_off) and moving components need no
+    extra bookkeeping. Components without a shared mesh, or alone in their batch, take the normal draw path.
+    """
+    minInstances = 2  # smaller batches are drawn one by one
+    textureArraysOn = True  # batch components with different textures through texture arrays
+
+    # statistics of the last draw call
+    drawCalls = 0
+    instancesDrawn = 0
+    batches = 0
+
+    renderQueue: RenderQueue = None  # sorts batches and single draws by state
+    textureArrays: TextureArrays = None
+
+    def __init__(self, textureArraysOn=True):
+        self.renderQueue = RenderQueue()
+        self.textureArraysOn = textureArraysOn
+        self.textureArrays = TextureArrays()
+
+    @staticmethod
+    def batchKey(component: Component):
+        # textures loaded from the same file hold the same image, any of them can be bound for the whole batch
+        return (component.displayObj.mesh,
+                component.shaderKey,
+                RenderQueue.textureKey(component.textureOn, component.texture),
+                RenderQueue.textureKey(component.normalMapOn, component.normalMap))
+
+    def mergeTextureBatches(self, batches: dict) -> dict:
+        """
+        Merge batches which only differ by a texture of the same size and format into one batch drawn from a
+        texture array.
+        The texture part of a merged batch's key is ("array", TextureArrays.arrayKey of the textures)
+        """
+        groups = {}
+        for key, components in batches.items():
+            texture = components[0].texture if key[2] is not None else None
+            if texture is None or texture.image is None:
+                continue
+            arrayKey = (key[0], key[1], ("array", TextureArrays.arrayKey(texture)), key[3])
+            groups.setdefault(arrayKey, []).append(key)
+
+        textures = []
+        merged = {}
+        for arrayKey, keys in groups.items():
+            if len(keys) < 2:
+                continue
+            merged[arrayKey] = keys
+            textures.extend(batches[key][0].texture for key in keys)
+        if not merged:
+            return batches
+        self.textureArrays.update(textures)
+
+        for arrayKey, keys in merged.items():
+            components = []
+            for key in keys:
+                # left out of the array when there are more textures than layers
+                if self.textureArrays.layerOf(batches[key][0].texture) is not None:
+                    components.extend(batches.pop(key))
+            batches[arrayKey] = components
+        return batches
+
+    def collect(self, component: Component, drawables: list):
+        if isinstance(component.displayObj, Displayable):
+            drawables.append(component)
+        for c in component.children:
+            self.collect(c, drawables)
+
+    def draw(self, topLevelComponent: Component, shaderProg: GLProgram, frustum: Frustum = None):
+        """
+        :param frustum: if given, components outside of it are not drawn
+        """
+        drawables = []
+        self.collect(topLevelComponent, drawables)
+        if frustum is not None:
+            drawables = frustum.cull(drawables)
+
+        batches = {}
+        singles = []
+        for c in drawables:
+            if c.displayObj.mesh is None:
+                singles.append(c)
+            else:
+                batches.setdefault(self.batchKey(c), []).append(c)
+        if self.textureArraysOn:
+            batches = self.mergeTextureBatches(batches)
+
+        self.drawCalls = 0
+        self.instancesDrawn = 0
+        self.batches = 0
+        instanced = []
+        for key, components in batches.items():
+            if len(components) < self.minInstances:
+                singles.extend(components)
+            else:
+                instanced.append((RenderQueue.stateKey(components[0]), (key, components)))
+        for _, (key, components) in self.renderQueue.sort(instanced):
+            self.drawBatch(key[0], components, shaderProg, isinstance(key[2], tuple))
+
+        for _, c in self.renderQueue.sort([(RenderQueue.stateKey(c), c) for c in singles]):
+            shaderProg.setModelMat(c.transformationMat, c.normalMat)
+            c.setMaterialUniforms(shaderProg)
+            c.bindDrawState(shaderProg)
+            c.displayObj.draw()
+            self.drawCalls += 1
+            self.instancesDrawn += 1
+
+    def drawBatch(self, mesh, components, shaderProg: GLProgram, textureArrayOn=False):
+        """
+        :param textureArrayOn: the components' textures are layers of one texture array, bind that instead
+        """
+        maxMaterialNum = int(shaderProg.attribs["maxMaterialNum"])
+        components[0].bindDrawState(shaderProg)
+        shaderProg.setBool("instancingOn", True)
+        layers = [0] * len(components)
+        if textureArrayOn:
+            array, _ = self.textureArrays.layerOf(components[0].texture)
+            array.bind(shaderProg.textureArrayUnit)
+            shaderProg.setBool("textureArrayOn", True)
+            layers = [self.textureArrays.layerOf(c.texture)[1] for c in components]
+
+        # split the batch whenever it would need more distinct materials than the materials array holds
+        start = 0
+        while start < len(components):
+            materials = []
+            instanceData = []
+            end = start
+            while end < len(components):
+                material = components[end].material
+                if material not in materials:
+                    if len(materials) == maxMaterialNum:
+                        break
+                    materials.append(material)
+                instanceData.append(np.concatenate((components[end].transformationMat.flatten("C"),
+                                                    components[end].normalMat.flatten("C"),
+                                                    [materials.index(material), layers[end]])))
+                end += 1
+
+            for i, material in enumerate(materials):
+                shaderProg.setInstanceMaterial(i, material)
+            mesh.drawInstanced(shaderProg, np.array(instanceData, dtype=np.float32))
+            self.drawCalls += 1
+            self.instancesDrawn += end - start
+            self.batches += 1
+            start = end
+
+        shaderProg.setBool("instancingOn", False)
+        if textureArrayOn:
+            shaderProg.setBool("textureArrayOn", False)
+
+    def stats(self) -> dict:
+        return {
+            "drawCalls": self.drawCalls,
+            "instancesDrawn": self.instancesDrawn,
+            "instancedBatches": self.batches,
+            "textureArrays": self.textureArrays.stats(),
+        }
@@ -0,0 +1,167 @@
+"""
+Progressive rendering with adaptive sampling on top of RayTracer. Samples are accumulated per pixel in float32
+buffers, each pass traces one more sample for every pixel still active. A pixel stops once it has its minimum number
+of samples and the standard error of its luminance is below threshold, so flat regions like the table cloth of
+SceneThree settle after a few samples while silhouettes, texture detail and highlights keep receiving them. Pixels
+whose first hit is on a shiny material get a higher minimum, growing with Material.highLight: the sharper the
+highlight, the easier the first samples miss it.
+
+image() is a preview at any point, Sketch shows it as a texture while tracing (T key). Offline:
+
+    python HeadlessRenderer.py --scene 3 --tracer --samples 64 --threshold 0.005 --output scene3_aa.png
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import time
+
+import numpy as np
+
+from RayTracer import RayTracer
+
+
+class ProgressiveRenderer:
+    """
+    Sample positions inside a pixel follow the R2 low discrepancy sequence, shifted by a random amount per pixel so
+    neighbouring pixels don't share a pattern
+    """
+    tracer: RayTracer = None
+    width = 0
+    height = 0
+    sums = None  # float32 (height * width, 3), sum of the samples of each pixel
+    squareSums = None  # float32 (height * width,), sum of the squared sample luminances
+    counts = None  # int32 (height * width,), samples traced
+    minSamples = None  # int32 (height * width,), samples needed before a pixel may stop, set by its first sample
+    active = None  # bool (height * width,), pixels still refined
+    shifts = None  # (height * width, 2) offset of the sample sequence of each pixel
+    pending = None  # pixels of the current pass not traced yet
+
+    baseSamples = 4
+    highlightSamples = 12  # extra samples of pixels on the shiniest materials
+    highlightScale = 64  # Material.highLight from which a material gets all highlightSamples
+    maxSamples = 64
+    threshold = 0.005  # standard error of a pixel's luminance at which it stops
+
+    luminanceWeights = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+    sequence = np.array([0.7548776662466927, 0.5698402909980532])  # R2, 1 / g and 1 / g^2 of the plastic number
+
+    # statistics
+    passes = 0
+    traceTime = 0.0
+
+    def __init__(self, tracer: RayTracer, maxSamples=64, threshold=0.005, seed=0):
+        self.tracer = tracer
+        self.maxSamples = maxSamples
+        self.threshold = threshold
+        self.width = tracer.width
+        self.height = tracer.height
+        self.shifts = np.random.default_rng(seed).random((self.width * self.height, 2))
+        self.reset()
+
+    def reset(self):
+        """
+        Drop every sample, call this after the camera or the scene changed
+        """
+        n = self.width * self.height
+        self.sums = np.zeros((n, 3), dtype=np.float32)
+        self.squareSums = np.zeros(n, dtype=np.float32)
+        self.counts = np.zeros(n, dtype=np.int32)
+        self.minSamples = np.full(n, self.baseSamples, dtype=np.int32)
+        self.active = np.ones(n, dtype=bool)
+        self.pending = np.zeros(0, dtype=np.int64)
+        self.passes = 0
+        self.traceTime = 0.0
+
+    def step(self, maxRays=None) -> bool:
+        """
+        Trace the next samples of the current pass, starting a new pass if it is finished
+
+        :param maxRays: samples to trace in this call, the rest of the pass if None
+        :return: False when every pixel has converged and nothing was traced
+        """
+        if len(self.pending) == 0:
+            self.pending = np.flatnonzero(self.active)
+            if len(self.pending) == 0:
+                return False
+            self.passes += 1
+        count = len(self.pending) if maxRays is None else min(maxRays, len(self.pending))
+        pixels = self.pending[0:count]
+        self.pending = self.pending[count:]
+        start = time.perf_counter()
+        self.sample(pixels)
+        self.traceTime += time.perf_counter() - start
+        return True
+
+    def sample(self, pixels):
+        """
+        Trace one more sample for each of the pixels, they must all be different
+        """
+        n = self.counts[pixels]
+        offsets = (self.shifts[pixels] + n[:, None] * self.sequence) % 1
+        ys, xs = np.divmod(pixels, self.width)
+        origins, dirs = self.tracer.pixelRays(xs + offsets[:, 0], ys + offsets[:, 1])
+        hitObjects = np.empty(len(pixels), dtype=np.int64)
+        colors = self.tracer.trace(origins, dirs, hitObjects).astype(np.float32)
+
+        luminances = colors @ self.luminanceWeights
+        self.sums[pixels] += colors
+        self.squareSums[pixels] += luminances * luminances
+        self.counts[pixels] += 1
+        first = n == 0
+        self.minSamples[pixels[first]] = self.samplesNeeded(hitObjects[first])
+
+        n = self.counts[pixels].astype(np.float32)
+        means = self.sums[pixels] @ self.luminanceWeights / n
+        variances = np.maximum(self.squareSums[pixels] / n - means * means, 0) * n / np.maximum(n - 1, 1)
+        converged = (n >= self.minSamples[pixels]) & (variances / n <= self.threshold * self.threshold)
+        self.active[pixels[converged | (n >= self.maxSamples)]] = False
+
+    def samplesNeeded(self, hitObjects) -> np.ndarray:
+        """
+        Minimum samples of pixels from the object their first sample hit, -1 for the background
+        """
+        tracer = self.tracer
+        result = np.full(len(hitObjects), self.baseSamples, dtype=np.int32)
+        if not tracer.specularOn:
+            return result
+        shiny = np.flatnonzero(hitObjects >= 0)
+        objects = hitObjects[shiny]
+        lit = (tracer.flags[objects] & 0x1) != 0
+        highlight = np.minimum(tracer.highlight[objects] / self.highlightScale, 1)
+        shininess = tracer.specular[objects].max(axis=1) * highlight
+        result[shiny] += np.rint(self.highlightSamples * np.clip(shininess, 0, 1) * lit).astype(np.int32)
+        return np.minimum(result, self.maxSamples)
+
+    def render(self, progress=None) -> np.ndarray:
+        """
+        Run passes until every pixel converged
+
+        :param progress: function(passes, activePixels) called after every pass
+        :return: the final image, see image
+        """
+        while self.step():
+            if progress is not None:
+                progress(self.passes, int(np.count_nonzero(self.active)))
+        return self.image()
+
+    def image(self) -> np.ndarray:
+        """
+        :return: (height, width, 3) uint8 RGB image of the samples so far, top row first, unsampled pixels black
+        """
+        means = self.sums / np.maximum(self.counts, 1)[:, None]
+        return np.rint(np.clip(means, 0, 1) * 255).astype(np.uint8).reshape(self.height, self.width, 3)
+
+    def sampleMap(self) -> np.ndarray:
+        """
+        :return: (height, width) uint8 image of the samples per pixel, white for maxSamples
+        """
+        return np.rint(self.counts / self.maxSamples * 255).astype(np.uint8).reshape(self.height, self.width)
+
+    def stats(self) -> dict:
+        return {
+            "passes": self.passes,
+            "samples": int(self.counts.sum()),
+            "samplesPerPixel": float(self.counts.mean()),
+            "activePixels": int(np.count_nonzero(self.active)),
+            "traceTime": self.traceTime,
+        }
@@ -0,0 +1,702 @@
+"""
+Offline CPU ray tracer for the Component trees the OpenGL path draws. Every Displayable is intersected in object
+space, as triangles or, for the shapes with an analytic form (sphere, ellipsoid, cylinder, cube, torus), exactly.
+Primary and shadow rays are traced in packets with vectorized NumPy, and hit points are shaded with the same
+routing, material and light formulas as the fragment shader of GLProgram. On top of the shader, a light only reaches
+a point when the shadow ray towards it is not blocked, so candle light no longer shines through the cakes.
+
+Objects are found through a BVH over the world bounds of the components, triangle meshes have their own BVH in object
+space. When only transformations change, update refits the object BVH instead of building everything again.
+
+Nothing here needs a GPU. The scenes still create their OpenGL objects when they are built, see HeadlessRenderer
+for building them in a software context:
+
+    python HeadlessRenderer.py --scene 3 --tracer --width 400 --height 300 --output scene3_traced.png
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import time
+
+import numpy as np
+
+import ColorType
+from Component import Component
+from BVH import BVH
+from Displayable import Displayable
+from GLProgram import lightBlockDtype, packLight, renderingFlags
+from GLUtility import GLUtility
+
+
+def dot(a, b):
+    return np.sum(a * b, axis=-1)
+
+
+def normalize(v):
+    length = np.sqrt(dot(v, v))[..., None]
+    return v / np.where(length > 0, length, 1)
+
+
+def cross(a, b):
+    return np.stack([a[..., 1] * b[..., 2] - a[..., 2] * b[..., 1],
+                     a[..., 2] * b[..., 0] - a[..., 0] * b[..., 2],
+                     a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]], axis=-1)
+
+
+def sampleTexture(image, uv):
+    """
+    Bilinear lookup with repeat wrapping, like the GL_LINEAR and GL_REPEAT parameters of Texture
+
+    :param image: uint8 (height, width, 3), bottom row first
+    :param uv: (N, 2) texture coordinates
+    :return: (N, 3) colors in [0, 1]
+    """
+    height, width = image.shape[0:2]
+    x = uv[:, 0] * width - 0.5
+    y = uv[:, 1] * height - 0.5
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = (x - x0)[:, None]
+    fy = (y - y0)[:, None]
+    x0 = x0.astype(np.int64) % width
+    y0 = y0.astype(np.int64) % height
+    x1 = (x0 + 1) % width
+    y1 = (y0 + 1) % height
+    return ((image[y0, x0] * (1 - fx) + image[y0, x1] * fx) * (1 - fy) +
+            (image[y1, x0] * (1 - fx) + image[y1, x1] * fx) * fy) / 255
+
+
+class TriangleMesh:
+    """
+    Triangles of a Displayable in object space, with the per-vertex attributes the vertex shader passes on and a
+    BVH over them. Components drawing the same arrays share one TriangleMesh
+    """
+    v0 = None  # (T, 3) first vertex of every triangle
+    e1 = None  # (T, 3) second vertex - first vertex
+    e2 = None  # (T, 3) third vertex - first vertex
+    normals = None  # (T, 3, 3) normalized vertex normals
+    colors = None  # (T, 3, 3) vertex colors
+    uvs = None  # (T, 3, 2) texture coordinates
+    bvh: BVH = None
+    boundsMin = None  # (3,) object space bounds
+    boundsMax = None  # (3,)
+
+    def __init__(self, displayObj: Displayable):
+        vertices = np.asarray(displayObj.vertices, dtype=np.float64).reshape(-1, 11)
+        triangles = np.asarray(displayObj.indices, dtype=np.int64).reshape(-1, 3)
+        corners = vertices[triangles, 0:3]
+        self.v0 = corners[:, 0]
+        self.e1 = corners[:, 1] - corners[:, 0]
+        self.e2 = corners[:, 2] - corners[:, 0]
+        self.normals = normalize(vertices[triangles, 3:6])
+        self.colors = vertices[triangles, 6:9]
+        self.uvs = vertices[triangles, 9:11]
+        self.bvh = BVH(corners.min(axis=1), corners.max(axis=1), leafSize=8)
+        self.boundsMin = self.bvh.nodeMins[0]
+        self.boundsMax = self.bvh.nodeMaxs[0]
+
+    def intersect(self, origins, dirs, tMin, tMax):
+        """
+        Closest triangle hit of every ray, Moller-Trumbore on the leaves the BVH reaches
+
+        :param origins: (N, 3)
+        :param dirs: (N, 3) directions, not necessarily normalized
+        :param tMin: hits closer than this are ignored
+        :param tMax: (N,) hits at or beyond this are ignored
+        :return: t (N,), inf for misses, triangle index (N,), barycentric u and v (N,)
+        """
+        n = len(origins)
+        t = np.array(tMax, dtype=np.float64)
+        prims = np.full(n, -1, dtype=np.int64)
+        u = np.zeros(n)
+        v = np.zeros(n)
+
+        def visitLeaf(rows, triangles):
+            o = origins[rows, None, :]
+            d = dirs[rows, None, :]
+            e1 = self.e1[triangles]
+            e2 = self.e2[triangles]
+            p = cross(d, e2)
+            det = dot(e1, p)
+            parallel = np.abs(det) < 1e-12
+            invDet = 1 / np.where(parallel, 1, det)
+            s = o - self.v0[triangles]
+            bu = dot(s, p) * invDet
+            q = cross(s, e1)
+            bv = dot(d, q) * invDet
+            bt = dot(e2, q) * invDet
+            valid = ~parallel & (bu >= 0) & (bv >= 0) & (bu + bv <= 1) & (bt > tMin) & (bt < t[rows, None])
+            bt = np.where(valid, bt, np.inf)
+
+            closest = np.argmin(bt, axis=1)
+            columns = np.arange(len(rows))
+            bt = bt[columns, closest]
+            hit = np.isfinite(bt)
+            rows = rows[hit]
+            t[rows] = bt[hit]
+            prims[rows] = triangles[closest[hit]]
+            u[rows] = bu[columns, closest][hit]
+            v[rows] = bv[columns, closest][hit]
+
+        self.bvh.traverse(origins, dirs, t, visitLeaf)
+        t[prims < 0] = np.inf
+        return t, prims, u, v
+
+    def surface(self, points, prims, u, v):
+        """
+        Interpolated vertex attributes at hit points, as the rasterizer interpolates them
+
+        :return: normal (N, 3), not normalized, color (N, 3), texture coordinates (N, 2)
+        """
+        w = np.stack([1 - u - v, u, v], axis=1)[:, :, None]
+        return (np.sum(self.normals[prims] * w, axis=1),
+                np.sum(self.colors[prims] * w, axis=1),
+                np.sum(self.uvs[prims] * w, axis=1))
+
+
+class AnalyticShape:
+    """
+    A Displayable's exact surface in object space, see Displayable.intersectRays
+    """
+    displayObj: Displayable = None
+    color = None  # (3,) vertex color of the Displayable
+    boundsMin = None  # (3,) object space bounds
+    boundsMax = None  # (3,)
+
+    def __init__(self, displayObj: Displayable):
+        self.displayObj = displayObj
+        self.color = np.array(list(displayObj.color), dtype=np.float64)
+        radius = displayObj.surfaceRadius()
+        self.boundsMin = np.full(3, -radius, dtype=np.float64)
+        self.boundsMax = np.full(3, radius, dtype=np.float64)
+
+    def intersect(self, origins, dirs, tMin, tMax):
+        t, parts = self.displayObj.intersectRays(origins, dirs, tMin, tMax)
+        n = len(t)
+        return t, np.where(np.isfinite(t), parts, -1), np.zeros(n), np.zeros(n)
+
+    def surface(self, points, prims, u, v):
+        normals, uv = self.displayObj.surfaceAt(points, prims)
+        return normalize(normals), np.tile(self.color, (len(points), 1)), uv
+
+
+class TraceObject:
+    """
+    One drawn Component: a shape placed by the component's world matrix, and the state the draw call would bind.
+    Rays are brought into object space with the inverse world matrix; directions are not normalized there, so ray
+    parameters stay world distances
+    """
+    component: Component = None
+    shape = None  # TriangleMesh or AnalyticShape, anything with intersect, surface and object space bounds
+    inverseMat = None  # (4, 4) column-major inverse of the world transformation
+    normalMat = None  # (3, 3) rotation part of the inverse transpose, normals keep their length
+    worldMin = None  # (3,) world space bounds
+    worldMax = None  # (3,)
+    flags = 0  # renderingFlag of the component's routing
+    texture = None  # uint8 (height, width, 3), Texture.image, None when no texture is bound
+    normalMap = None  # uint8 (height, width, 3), None when normal mapping is off
+    images = None  # dict, texture file -> image, shared by the objects of a RayTracer
+
+    def __init__(self, component: Component, shape, images=None):
+        self.component = component
+        self.shape = shape
+        self.images = images if images is not None else {}
+        self.update()
+
+    def update(self):
+        """
+        Read the component's transformation, routing and textures again
+        """
+        c = self.component
+        mat = np.asarray(c.transformationMat, dtype=np.float64)
+        linear = mat[0:3, 0:3]
+        self.inverseMat = np.linalg.inv(mat)
+        # Component only accepts uniform scaling, undo it so interpolated normals are transformed like the shader's
+        self.normalMat = self.inverseMat[0:3, 0:3].T * float(np.linalg.norm(linear, axis=1).max())
+        center = (self.shape.boundsMin + self.shape.boundsMax) / 2 @ linear + mat[3, 0:3]
+        halfExtent = (self.shape.boundsMax - self.shape.boundsMin) / 2 @ np.abs(linear)
+        self.worldMin = center - halfExtent
+        self.worldMax = center + halfExtent
+
+        self.flags = renderingFlags(c.renderingRouting)
+        self.texture = self.normalMap = None
+        if c.textureOn:
+            self.texture = self.textureImage(c.texture)
+        if c.normalMapOn:
+            self.normalMap = self.textureImage(c.normalMap)
+
+    def textureImage(self, texture):
+        # textures from the same file hold the same image, keep only one
+        if texture is None:
+            return None
+        if texture.image is None or texture.source is None:
+            return texture.image
+        return self.images.setdefault(texture.source, texture.image)
+
+    def __getstate__(self):
+        # copies sent to other processes only trace, the component is not needed there
+        state = self.__dict__.copy()
+        state["component"] = None
+        state["images"] = None
+        return state
+
+    def toObject(self, points):
+        return points @ self.inverseMat[0:3, 0:3] + self.inverseMat[3, 0:3]
+
+    def intersect(self, origins, dirs, tMin, tMax):
+        return self.shape.intersect(self.toObject(origins), dirs @ self.inverseMat[0:3, 0:3], tMin, tMax)
+
+    def surface(self, points, prims, u, v):
+        """
+        :return: world space normal (N, 3), color (N, 3), texture coordinates (N, 2)
+        """
+        normals, colors, uv = self.shape.surface(self.toObject(points), prims, u, v)
+        return normals @ self.normalMat, colors, uv
+
+
+class RayTracer:
+    """
+    Build with the top level component and the lights, then call render. The tree is read when build is called,
+    call update after anything changed. Lights are not casting shadows from their own fixtures: the light cubes,
+    flashlights and candles the scenes put around them are skipped by the shadow rays of their light.
+    """
+    topLevelComponent: Component = None
+    objects = None  # list<TraceObject>
+    bvh: BVH = None  # over the world bounds of objects
+    shapes = None  # dict, Displayable arrays -> shared TriangleMesh or AnalyticShape
+    images = None  # dict, texture file -> image shared by the objects
+    lightData = None  # numpy array of lightBlockDtype, as the fragment shader receives the lights
+    lightFixtures = None  # list<list<Component>>, components not blocking the light of the same index
+    fixtureObjects = None  # list<numpy.ndarray>, indices into objects of every light's fixtures
+
+    # per object arrays, indexed by object
+    flags = None  # int (K,)
+    ambient = None  # (K, 3)
+    diffuse = None  # (K, 3)
+    specular = None  # (K, 3)
+    highlight = None  # (K,)
+
+    width = 0
+    height = 0
+    cameraPos = None  # numpy.ndarray(3)
+    viewBasis = None  # (3, 3), rows are the camera's x, up and backwards axes
+    fov = 45  # vertical field of view in degrees, same as the perspective matrix of Sketch
+    backgroundColor = None  # numpy.ndarray(3)
+
+    ambientOn: bool = True
+    diffuseOn: bool = True
+    specularOn: bool = True
+    shadowsOn: bool = True
+    analyticOn: bool = True  # intersect the exact shapes instead of their tessellation, see hasAnalyticSurface
+
+    packetSize = 4096  # rays traced together
+    epsilon = 1e-4  # minimal distance of a hit, keeps shadow rays from hitting the surface they start on
+
+    # statistics of the last render call
+    primaryRays = 0
+    shadowRays = 0
+    renderTime = 0.0
+    # statistics of the last build or update call
+    rebuilt = False  # False when the object BVH was only refitted
+    buildTime = 0.0
+
+    def __init__(self, topLevelComponent: Component, lights=(), lightFixtures=None, width=400, height=300,
+                 analytic=True):
+        """
+        :param lights: list<Light>, disabled lights are kept but do not shine
+        :param lightFixtures: list of the component (or None) around each light, see class docstring
+        :param analytic: see analyticOn
+        """
+        self.topLevelComponent = topLevelComponent
+        self.analyticOn = analytic
+        self.shapes = {}
+        self.images = {}
+        self.lightData = np.zeros(len(lights), dtype=lightBlockDtype)
+        for i, light in enumerate(lights):
+            packLight(self.lightData[i], light)
+        self.lightFixtures = list(lightFixtures) if lightFixtures is not None else [None] * len(lights)
+        self.width = width
+        self.height = height
+        self.backgroundColor = np.array(list(ColorType.getGrayColor(0.05)), dtype=np.float64)
+        self.setCamera((0, 0, 6), (0, 0, 0))
+        self.build()
+
+    def __getstate__(self):
+        """
+        Pickled copies can render but not update, the Component tree holding OpenGL objects is left out.
+        See TileRenderer
+        """
+        state = self.__dict__.copy()
+        state["topLevelComponent"] = None
+        state["lightFixtures"] = None
+        state["shapes"] = {}
+        state["images"] = {}
+        return state
+
+    @classmethod
+    def fromScene(cls, topLevelComponent: Component, scene, width=400, height=300, analytic=True):
+        """
+        :param scene: Scene in the tree, its lights and lightCubes are used
+        """
+        fixtures = list(scene.lightCubes) + [None] * (len(scene.lights) - len(scene.lightCubes))
+        return cls(topLevelComponent, scene.lights, fixtures[0:len(scene.lights)], width, height, analytic)
+
+    @classmethod
+    def fromView(cls, view, width, height, analytic=True):
+        """
+        Tracer of what a Sketch or HeadlessRenderer shows, with the same camera, lighting switches and background
+
+        :param view: Sketch or HeadlessRenderer
+        """
+        view.topLevelComponent.update(np.identity(4))
+        tracer = cls.fromScene(view.topLevelComponent, view.scene, width, height, analytic)
+        tracer.setCamera(view.getCameraPos(), view.lookAtPt, view.upVector)
+        tracer.ambientOn = view.ambientOn
+        tracer.diffuseOn = view.diffuseOn
+        tracer.specularOn = view.specularOn
+        tracer.backgroundColor = np.array(list(view.backgroundColor), dtype=np.float64)
+        return tracer
+
+    def setCamera(self, cameraPos, lookAtPt, upVector=(0, 1, 0), fov=45):
+        """
+        Same camera as GLUtility.view and GLUtility.perspective
+        """
+        self.cameraPos = np.array(cameraPos, dtype=np.float64)
+        viewMat = GLUtility().view(cameraPos, lookAtPt, upVector)
+        # column-major, the row-major view matrix is its transpose
+        self.viewBasis = np.asarray(viewMat).T[0:3, 0:3].copy()
+        self.fov = fov
+
+    def build(self):
+        """
+        Collect the drawn components of the tree, build their shapes and the object BVH
+        """
+        start = time.perf_counter()
+        components = []
+        self.collect(self.topLevelComponent, components)
+        self.objects = [TraceObject(c, self.shapeOf(c.displayObj), self.images) for c in components]
+        self.bvh = BVH(*self.objectBounds(), leafSize=1)
+        self.readMaterials()
+
+        objectIndex = {id(c): i for i, c in enumerate(components)}
+        self.fixtureObjects = []
+        for fixture in self.lightFixtures:
+            subtree = []
+            if fixture is not None:
+                self.collect(fixture, subtree)
+            self.fixtureObjects.append(np.array([objectIndex[id(c)] for c in subtree if id(c) in objectIndex],
+                                                dtype=np.int64))
+        self.rebuilt = True
+        self.buildTime = time.perf_counter() - start
+
+    def update(self, lights=None):
+        """
+        Follow changes of the tree. Moved components only refit the object BVH, added or removed ones rebuild it
+
+        :param lights: list<Light>, new state of the lights, in the same order as given to the constructor
+        """
+        if lights is not None:
+            for i, light in enumerate(lights):
+                packLight(self.lightData[i], light)
+        components = []
+        self.collect(self.topLevelComponent, components)
+        if [id(c) for c in components] != [id(o.component) for o in self.objects] or \
+                any(o.shape is not self.shapeOf(o.component.displayObj) for o in self.objects):
+            self.build()
+            return
+        start = time.perf_counter()
+        for o in self.objects:
+            o.update()
+        self.bvh.refit(*self.objectBounds())
+        self.readMaterials()
+        self.rebuilt = False
+        self.buildTime = time.perf_counter() - start
+
+    def shapeOf(self, displayObj: Displayable):
+        """
+        Shared shape of a Displayable. Triangle meshes are keyed by their arrays, which GeometryCache shares
+        between identical Displayables
+        """
+        if self.analyticOn and displayObj.hasAnalyticSurface():
+            key = ("analytic", id(displayObj))
+            if key not in self.shapes:
+                self.shapes[key] = AnalyticShape(displayObj)
+        else:
+            key = ("mesh", id(displayObj.vertices), id(displayObj.indices))
+            if key not in self.shapes:
+                self.shapes[key] = TriangleMesh(displayObj)
+        return self.shapes[key]
+
+    def objectBounds(self):
+        k = len(self.objects)
+        return (np.array([o.worldMin for o in self.objects], dtype=np.float64).reshape(k, 3),
+                np.array([o.worldMax for o in self.objects], dtype=np.float64).reshape(k, 3))
+
+    def readMaterials(self):
+        components = [o.component for o in self.objects]
+        k = len(components)
+        self.flags = np.array([o.flags for o in self.objects], dtype=np.int64)
+        self.ambient = np.array([c.material.ambient[0:3] for c in components], dtype=np.float64).reshape(k, 3)
+        self.diffuse = np.array([c.material.diffuse[0:3] for c in components], dtype=np.float64).reshape(k, 3)
+        self.specular = np.array([c.material.specular[0:3] for c in components], dtype=np.float64).reshape(k, 3)
+        self.highlight = np.array([c.material.highLight for c in components], dtype=np.float64)
+
+    def collect(self, component: Component, components: list):
+        if isinstance(component.displayObj, Displayable) and component.displayObj.vertices is not None:
+            components.append(component)
+        for c in component.children:
+            self.collect(c, components)
+
+    def intersect(self, origins, dirs, tMax, exclude=None, anyHit=False):
+        """
+        Trace a packet of rays through the object BVH
+
+        :param dirs: (N, 3) normalized directions
+        :param tMax: (N,) maximal distance of the hits
+        :param exclude: indices of objects to skip
+        :param anyHit: stop testing a ray once it hits something, for shadow rays
+        :return: t (N,), object index (N,), -1 for misses, triangle index, barycentric u and v
+        """
+        n = len(origins)
+        t = np.array(tMax, dtype=np.float64)
+        objects = np.full(n, -1, dtype=np.int64)
+        prims = np.full(n, -1, dtype=np.int64)
+        u = np.zeros(n)
+        v = np.zeros(n)
+        skip = set() if exclude is None else set(int(i) for i in exclude)
+        finished = np.zeros(n, dtype=bool) if anyHit else None
+
+        def visitLeaf(rows, leafObjects):
+            for i in leafObjects:
+                if i in skip:
+                    continue
+                ht, hp, hu, hv = self.objects[i].intersect(origins[rows], dirs[rows], self.epsilon, t[rows])
+                closer = ht < t[rows]
+                hitRows = rows[closer]
+                t[hitRows] = ht[closer]
+                objects[hitRows] = i
+                prims[hitRows] = hp[closer]
+                u[hitRows] = hu[closer]
+                v[hitRows] = hv[closer]
+                if anyHit:
+                    finished[hitRows] = True
+                    rows = rows[~closer]
+
+        self.bvh.traverse(origins, dirs, t, visitLeaf, finished)
+        return t, objects, prims, u, v
+
+    def occluded(self, origins, dirs, tMax, exclude=None) -> np.ndarray:
+        """
+        :return: bool (N,), True for shadow rays blocked before tMax
+        """
+        self.shadowRays += len(origins)
+        return self.intersect(origins, dirs, tMax, exclude, anyHit=True)[1] >= 0
+
+    def shade(self, origins, dirs, hits) -> np.ndarray:
+        """
+        Colors of a packet of traced rays, following the routing of the fragment shader
+
+        :param hits: result of intersect
+        :return: (N, 3) colors
+        """
+        t, objects, prims, u, v = hits
+        colors = np.tile(self.backgroundColor, (len(origins), 1))
+        rows = np.nonzero(objects >= 0)[0]
+        if len(rows) == 0:
+            return colors
+
+        hitObjects = objects[rows]
+        positions = origins[rows] + t[rows, None] * dirs[rows]
+        k = len(rows)
+        normals = np.empty((k, 3))
+        vertexColors = np.empty((k, 3))
+        # unbound textures sample as black
+        textureColors = np.zeros((k, 3))
+        for i in np.unique(hitObjects):
+            o = self.objects[i]
+            sel = hitObjects == i
+            normal, color, uv = o.surface(positions[sel], prims[rows[sel]], u[rows[sel]], v[rows[sel]])
+            if o.normalMap is not None:
+                normal = self.applyNormalMap(normal, sampleTexture(o.normalMap, uv))
+            normals[sel] = normal
+            vertexColors[sel] = color
+            if o.texture is not None:
+                textureColors[sel] = sampleTexture(o.texture, uv)
+
+        flags = self.flags[hitObjects]
+        useLighting = (flags & 0x1) != 0
+        useTexture = (flags >> 8 & 0x1) != 0
+        results = np.zeros((k, 3))
+        resultNum = np.zeros(k)
+
+        lit = np.nonzero(useLighting)[0]
+        if len(lit):
+            baseColors = np.where(useTexture[lit, None], textureColors[lit], vertexColors[lit])
+            litObjects = hitObjects[lit]
+            iSum = self.illuminate(positions[lit], normalize(normals[lit]), litObjects)
+            ambientTerm = self.ambient[litObjects] * baseColors if self.ambientOn else baseColors
+            results[lit] += np.minimum(ambientTerm + np.minimum(iSum, 1) * baseColors, 1)
+            resultNum[lit] += 1
+
+        vertexRoute = (flags >> 1 & 0x1) != 0
+        results[vertexRoute] += vertexColors[vertexRoute]
+        resultNum += vertexRoute
+        # "pure" adds black
+        resultNum += (flags >> 2 & 0x1) != 0
+        normalRoute = (flags >> 3 & 0x1) != 0
+        results[normalRoute] += normals[normalRoute] * 0.5 + 0.5
+        resultNum += normalRoute
+        grayRoute = ((flags >> 5 & 0x1) + (flags >> 6 & 0x1)).astype(np.float64)
+        results += 0.5 * grayRoute[:, None]
+        resultNum += grayRoute
+        textureRoute = useTexture & ~useLighting
+        results[textureRoute] += textureColors[textureRoute]
+        resultNum += textureRoute
+
+        colors[rows] = results / np.maximum(resultNum, 1)[:, None]
+        return colors
+
+    @staticmethod
+    def applyNormalMap(normals, mapColors):
+        normalMap = normalize(mapColors * 2 - 1)
+        tangent = np.array([1.0, 0.0, 0.0])
+        bitangent = normalize(cross(normalMap, tangent))
+        # mat3(tangent, bitangent, normalMap) * normal, the matrix columns weighted by the normal
+        return normalize(tangent * normals[:, 0:1] + bitangent * normals[:, 1:2] + normalMap * normals[:, 2:3])
+
+    def illuminate(self, positions, normals, hitObjects):
+        """
+        Sum of the diffuse and specular terms of every enabled light at lit hit points
+
+        :param normals: (N, 3) normalized
+        :return: (N, 3), not clamped yet
+        """
+        n = len(positions)
+        iSum = np.zeros((n, 3))
+        if not self.diffuseOn and not self.specularOn:
+            return iSum
+        diffuse = self.diffuse[hitObjects]
+        specular = self.specular[hitObjects]
+        highlight = self.highlight[hitObjects]
+        views = normalize(self.cameraPos - positions)
+
+        for i, light in enumerate(self.lightData):
+            if not light["on"]:
+                continue
+            lightPos = light["position"].astype(np.float64)
+            lightColor = light["color"][0:3].astype(np.float64)
+            toLight = lightPos - positions
+            distances = np.sqrt(dot(toLight, toLight))
+            if light["infiniteOn"]:
+                lightDirs = np.tile(normalize(light["infiniteDirection"].astype(np.float64)), (n, 1))
+                shadowDistances = np.full(n, np.inf)
+            else:
+                lightDirs = normalize(toLight)
+                shadowDistances = distances
+
+            nDotL = dot(normals, lightDirs)
+            front = nDotL > 0
+            contribution = np.zeros((n, 3))
+            if self.diffuseOn:
+                contribution += np.where(front[:, None], diffuse * nDotL[:, None] * lightColor, 0)
+            if self.specularOn:
+                reflected = 2 * nDotL[:, None] * normals - lightDirs
+                rDotV = np.maximum(dot(reflected, views), 0)
+                shiny = front & (rDotV > 0)
+                specFact = np.where(shiny, np.power(np.where(shiny, rDotV, 1), highlight), 0)
+                contribution += specular * specFact[:, None] * lightColor
+
+            if light["spotOn"]:
+                if not light["infiniteOn"]:
+                    a, b, c = light["spotRadialFactor"].astype(np.float64)
+                    contribution /= (a + b * distances + c * distances * distances)[:, None]
+                cosAngle = dot(normalize(toLight), normalize(light["spotDirection"].astype(np.float64)))
+                inside = cosAngle > light["spotAngleLimit"]
+                angular = np.where(inside, np.power(np.where(inside, cosAngle, 1), light["spotExpAttenuation"]), 0)
+                contribution *= angular[:, None]
+
+            reached = np.nonzero(np.any(contribution > 0, axis=1))[0]
+            if self.shadowsOn and len(reached):
+                blocked = self.occluded(positions[reached], lightDirs[reached], shadowDistances[reached],
+                                        self.fixtureObjects[i])
+                contribution[reached[blocked]] = 0
+            iSum += contribution
+        return iSum
+
+    def cameraRays(self, x0, y0, x1, y1, offsets=None):
+        """
+        Camera rays through the pixels of a tile, rows from the top of the image
+
+        :param offsets: (h * w, 2) positions inside the pixels, pixel centers (0.5, 0.5) if not given
+        :return: origins (N, 3), normalized directions (N, 3)
+        """
+        ys, xs = np.mgrid[y0:y1, x0:x1]
+        xs = xs.reshape(-1).astype(np.float64)
+        ys = ys.reshape(-1).astype(np.float64)
+        if offsets is None:
+            offsets = np.full((len(xs), 2), 0.5)
+        return self.pixelRays(xs + offsets[:, 0], ys + offsets[:, 1])
+
+    def pixelRays(self, xs, ys):
+        """
+        Camera rays through image positions, in pixels from the top left corner
+
+        :return: origins (N, 3), normalized directions (N, 3)
+        """
+        # inverse of the scaling of GLUtility.perspective
+        h = np.tan(self.fov / 180 * np.pi * 0.5)
+        w = h * self.width / self.height
+        viewDirs = np.stack([(2 * xs / self.width - 1) * w,
+                             (1 - 2 * ys / self.height) * h,
+                             -np.ones_like(xs)], axis=1)
+        dirs = normalize(viewDirs @ self.viewBasis)
+        return np.tile(self.cameraPos, (len(dirs), 1)), dirs
+
+    def trace(self, origins, dirs, hitObjects=None) -> np.ndarray:
+        """
+        :param hitObjects: int (N,), if given, filled with the index of the object each ray hit, -1 for misses
+        :return: (N, 3) colors of a batch of rays, traced packetSize rays at a time
+        """
+        colors = np.empty((len(origins), 3))
+        for start in range(0, len(origins), self.packetSize):
+            packet = slice(start, start + self.packetSize)
+            o = origins[packet]
+            d = dirs[packet]
+            hits = self.intersect(o, d, np.full(len(o), np.inf))
+            colors[packet] = self.shade(o, d, hits)
+            if hitObjects is not None:
+                hitObjects[packet] = hits[1]
+        self.primaryRays += len(origins)
+        return colors
+
+    def renderTile(self, x0, y0, x1, y1) -> np.ndarray:
+        """
+        :return: float (y1 - y0, x1 - x0, 3) colors in [0, 1]
+        """
+        origins, dirs = self.cameraRays(x0, y0, x1, y1)
+        return self.trace(origins, dirs).reshape(y1 - y0, x1 - x0, 3)
+
+    def render(self) -> np.ndarray:
+        """
+        :return: (height, width, 3) uint8 RGB image, top row first like FBO.readPixels
+        """
+        self.primaryRays = self.shadowRays = 0
+        start = time.perf_counter()
+        image = self.renderTile(0, 0, self.width, self.height)
+        self.renderTime = time.perf_counter() - start
+        # the same float to unsigned normalized conversion as the color buffer
+        return np.rint(np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+    def stats(self) -> dict:
+        return {
+            "objects": len(self.objects),
+            "analytic": sum(isinstance(o.shape, AnalyticShape) for o in self.objects),
+            "triangles": sum(len(o.shape.v0) for o in self.objects if isinstance(o.shape, TriangleMesh)),
+            "meshes": sum(isinstance(shape, TriangleMesh) for shape in self.shapes.values()),
+            "bvhNodes": len(self.bvh.children),
+            "rebuilt": self.rebuilt,
+            "buildTime": self.buildTime,
+            "primaryRays": self.primaryRays,
+            "shadowRays": self.shadowRays,
+            "renderTime": self.renderTime,
+        }
@@ -0,0 +1,117 @@
+"""
+Draw a Component tree through a sorted render queue. Draw items are gathered from the tree first and sorted by
+program state (shader variant), textures, mesh and material, so consecutive draws share as much state as possible
+and GLState can skip the redundant calls. Nothing is blended in this program, so the drawing order doesn't change
+the image.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+from Component import Component
+from Displayable import Displayable
+from Frustum import Frustum
+from GLProgram import GLProgram
+
+
+class RenderQueue:
+    """
+    The queue is rebuilt every frame. stats() reports how many times each piece of state changes between
+    consecutive draw items, in tree order and in the sorted order actually drawn.
+    """
+    sortingOn = True
+
+    # the state of a draw item, most expensive to change first
+    stateNames = ("shader", "texture", "normalMap", "mesh", "material")
+
+    # statistics of the last draw call
+    drawCalls = 0
+    unsortedChanges = None  # dict, state name -> number of changes in tree order
+    sortedChanges = None  # dict, state name -> number of changes in drawing order
+
+    def __init__(self, sortingOn=True):
+        self.sortingOn = sortingOn
+        self.unsortedChanges = {}
+        self.sortedChanges = {}
+
+    @staticmethod
+    def textureKey(on, texture):
+        if not on or texture is None:
+            return None
+        # textures loaded from the same file hold the same image, any of them can be bound
+        return texture.source if texture.source is not None else texture.textureName
+
+    @staticmethod
+    def materialKey(material):
+        return (material.ambient.tobytes(), material.diffuse.tobytes(), material.specular.tobytes(),
+                material.highLight)
+
+    @classmethod
+    def stateKey(cls, component: Component) -> tuple:
+        """
+        State a component needs to be drawn, in the order of stateNames
+        """
+        mesh = component.displayObj.mesh
+        return (component.shaderKey,
+                cls.textureKey(component.textureOn, component.texture),
+                cls.textureKey(component.normalMapOn, component.normalMap),
+                id(component.displayObj) if mesh is None else id(mesh),
+                cls.materialKey(component.material))
+
+    def collect(self, component: Component, items: list):
+        if isinstance(component.displayObj, Displayable):
+            items.append((self.stateKey(component), component))
+        for c in component.children:
+            self.collect(c, items)
+
+    def sort(self, items: list) -> list:
+        """
+        Sort draw items by state. State values are replaced by their first-seen rank, so values of different types
+        (None, file names, texture names) never get compared
+        """
+        ranks = [{} for _ in self.stateNames]
+
+        def rankKey(item):
+            return tuple(r.setdefault(value, len(r)) for r, value in zip(ranks, item[0]))
+
+        return sorted(items, key=rankKey)
+
+    def countChanges(self, items: list) -> dict:
+        changes = dict.fromkeys(self.stateNames, 0)
+        previous = None
+        for key, _ in items:
+            for name, value, last in zip(self.stateNames, key, previous or (object(),) * len(key)):
+                if value != last:
+                    changes[name] += 1
+            previous = key
+        return changes
+
+    def draw(self, topLevelComponent: Component, shaderProg: GLProgram, frustum: Frustum = None):
+        """
+        :param frustum: if given, components outside of it are not drawn
+        """
+        items = []
+        self.collect(topLevelComponent, items)
+        if frustum is not None:
+            visible = set(map(id, frustum.cull([c for _, c in items])))
+            items = [item for item in items if id(item[1]) in visible]
+        self.unsortedChanges = self.countChanges(items)
+        if self.sortingOn:
+            items = self.sort(items)
+        self.sortedChanges = self.countChanges(items)
+
+        self.drawCalls = 0
+        for _, c in items:
+            shaderProg.setModelMat(c.transformationMat, c.normalMat)
+            c.setMaterialUniforms(shaderProg)
+            c.bindDrawState(shaderProg)
+            c.displayObj.draw()
+            self.drawCalls += 1
+
+    def stats(self) -> dict:
+        return {
+            "drawCalls": self.drawCalls,
+            "stateChangesUnsorted": sum(self.unsortedChanges.values()),
+            "stateChangesSorted": sum(self.sortedChanges.values()),
+            "unsorted": self.unsortedChanges,
+            "sorted": self.sortedChanges,
+        }
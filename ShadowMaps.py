@@ -0,0 +1,292 @@
+"""
+Shadow mapping for the real-time path. Before the frame is drawn, the depth of the Component tree is rendered from
+every shadow casting light with the depth-only variant of GLProgram: a perspective map for spot lights, six cube faces
+for point lights and an orthographic map for infinite lights. All maps are layers of one depth texture array, the
+fragment shader picks the layer, compares depths with 3x3 PCF and scales the light's diffuse and specular terms.
+
+A layer is only rendered again when its light changed, or when a component moved that is in the layer's view or was
+in it the last time it was rendered. In SceneOne only the maps of the flying lights are rendered each frame.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+try:
+    import OpenGL
+
+    try:
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+    except ImportError:
+        from ctypes import util
+
+        orig_util_find_library = util.find_library
+
+
+        def new_util_find_library(name):
+            res = orig_util_find_library(name)
+            if res:
+                return res
+            return '/System/Library/Frameworks/' + name + '.framework/' + name
+
+
+        util.find_library = new_util_find_library
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+except ImportError:
+    raise ImportError("Required dependency PyOpenGL not present")
+
+import math
+
+import numpy as np
+
+from Component import Component
+from Displayable import Displayable
+from Frustum import Frustum
+from GLProgram import GLProgram
+from GLState import GLState
+from GLUtility import GLUtility
+
+# looking directions and up vectors of the cube faces, in the order the fragment shader picks them: +x, -x, +y, ...
+cubeFaces = (((1, 0, 0), (0, -1, 0)), ((-1, 0, 0), (0, -1, 0)),
+             ((0, 1, 0), (0, 0, 1)), ((0, -1, 0), (0, 0, -1)),
+             ((0, 0, 1), (0, -1, 0)), ((0, 0, -1), (0, -1, 0)))
+
+
+class ShadowMaps:
+    """
+    The first maxShadowLights lights that are on cast shadows, in light block order. Spot lights with a cone wider
+    than maxSpotAngle are mapped like point lights, one perspective map can't cover them
+    """
+    shaderProg: GLProgram = None
+    depthProg: GLProgram = None
+    glutility: GLUtility = None
+    fbo = None
+    depthTexture = None  # GL_TEXTURE_2D_ARRAY of depth layers, mapSize x mapSize
+
+    shadowsOn: bool = True
+    mapSize = 1024
+    maxShadowLights = 4
+    maxSpotAngle = 120  # degrees
+    near = 0.02
+    polygonOffset = (2.0, 4.0)  # slope scaled and constant depth bias of the depth pass, against shadow acne
+
+    layerNum = 0  # layers allocated in depthTexture
+    layerMats = None  # (layerNum, 4, 4) column-major view @ projection of every layer
+    layerKeys = None  # list, state of the light a layer was rendered for
+    layerCasters = None  # list<set>, ids of the components drawn into each layer
+    matrices = None  # dict, component id -> (component, transformation bytes) at the last update
+
+    # statistics of the last update call
+    shadowLights = 0
+    renderedLayers = 0
+    drawCalls = 0
+
+    def __init__(self, shaderProg: GLProgram, mapSize=1024, maxShadowLights=4):
+        """
+        :param shaderProg: the program drawing the scene, its light block says which lights cast shadows
+        :param mapSize: width and height of every map
+        :param maxShadowLights: at most as many as shaderProg was compiled for
+        """
+        self.shaderProg = shaderProg
+        self.mapSize = mapSize
+        self.maxShadowLights = min(maxShadowLights, int(shaderProg.attribs["maxShadowLayers"]) // 6)
+        self.glutility = GLUtility()
+        self.depthProg = GLProgram(depthOnly=True)
+        # draws with the VAOs GeometryCache set up for shaderProg, see GLProgram.attribLocations
+        self.depthProg.compile()
+        self.fbo = gl.glGenFramebuffers(1)
+        self.matrices = {}
+        self.allocate(0)
+
+    def allocate(self, layerNum):
+        """
+        (Re)create the depth texture array with layerNum layers, every layer has to be rendered again
+        """
+        if self.depthTexture is not None:
+            gl.glDeleteTextures(1, [self.depthTexture])
+            GLState.forgetTexture(self.depthTexture)
+        self.layerNum = layerNum
+        self.layerMats = np.tile(np.identity(4), (layerNum, 1, 1))
+        self.layerKeys = [None] * layerNum
+        self.layerCasters = [set() for _ in range(layerNum)]
+
+        self.depthTexture = gl.glGenTextures(1)
+        GLState.bindTexture(self.shaderProg.shadowTextureUnit, self.depthTexture, gl.GL_TEXTURE_2D_ARRAY)
+        gl.glTexImage3D(gl.GL_TEXTURE_2D_ARRAY, 0, gl.GL_DEPTH_COMPONENT24, self.mapSize, self.mapSize,
+                        max(layerNum, 1), 0, gl.GL_DEPTH_COMPONENT, gl.GL_FLOAT, None)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+        # outside of a map counts as lit
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_BORDER)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_BORDER)
+        gl.glTexParameterfv(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_BORDER_COLOR, np.ones(4, dtype=np.float32))
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_COMPARE_MODE, gl.GL_COMPARE_REF_TO_TEXTURE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_COMPARE_FUNC, gl.GL_LEQUAL)
+
+    @staticmethod
+    def collect(component: Component, components: list):
+        if isinstance(component.displayObj, Displayable):
+            components.append(component)
+        for c in component.children:
+            ShadowMaps.collect(c, components)
+
+    def update(self, topLevelComponent: Component, lightFixtures=()):
+        """
+        Render the shadow maps that changed and bind them for the next draws. Call it once per frame, after the
+        transformations were updated
+
+        :param lightFixtures: component (or None) around the light of every slot, they cast no shadow for it
+        """
+        self.renderedLayers = self.drawCalls = 0
+        self.shaderProg.setBool("shadowsOn", self.shadowsOn)
+        lights = self.shaderProg.lightData
+        if not self.shadowsOn:
+            return
+
+        # a light is mapped to one layer, or six for cube maps
+        plan = []
+        layerNum = 0
+        for i in np.flatnonzero(lights["on"])[0:self.maxShadowLights]:
+            cube = not lights[i]["infiniteOn"] and \
+                (not lights[i]["spotOn"] or lights[i]["spotAngleLimit"] < math.cos(math.radians(self.maxSpotAngle / 2)))
+            plan.append((int(i), layerNum, bool(cube)))
+            layerNum += 6 if cube else 1
+        if layerNum > self.layerNum:
+            self.allocate(layerNum)
+        self.shadowLights = len(plan)
+
+        shadowState = np.zeros(len(lights), dtype=[("shadowOn", np.int32), ("shadowLayer", np.int32),
+                                                   ("shadowCube", np.int32)])
+        for i, first, cube in plan:
+            shadowState[i] = (1, first, cube)
+        for name in shadowState.dtype.names:
+            if not np.array_equal(lights[name], shadowState[name]):
+                lights[name] = shadowState[name]
+                self.shaderProg.lightsDirty = True
+
+        components = []
+        self.collect(topLevelComponent, components)
+        moved = self.movedComponents(components)
+        bounded = [c for c in components if c.displayObj.boundingRadius is not None]
+        if bounded:
+            centers, radii, _ = Frustum.worldBounds(bounded)
+            low = np.min(centers - radii[:, None], axis=0)
+            high = np.max(centers + radii[:, None], axis=0)
+        else:
+            low = high = np.zeros(3)
+        # rounded, so objects moving inside the scene don't change the maps of every light
+        sceneCenter = np.round((low + high) / 2, 1)
+        sceneRadius = math.ceil(np.linalg.norm(high - low) / 2 * 2 + 0.5) / 2
+
+        previousFbo = gl.glGetIntegerv(gl.GL_DRAW_FRAMEBUFFER_BINDING)
+        previousViewport = gl.glGetIntegerv(gl.GL_VIEWPORT)
+        for i, first, cube in plan:
+            fixture = []
+            if i < len(lightFixtures) and lightFixtures[i] is not None:
+                self.collect(lightFixtures[i], fixture)
+            fixtureIds = set(map(id, fixture))
+            casters = [c for c in components if id(c) not in fixtureIds]
+            for face, (viewMat, projectionMat, key) in enumerate(self.lightViews(lights[i], cube, sceneCenter,
+                                                                                 sceneRadius)):
+                layer = first + face
+                visible = Frustum(projectionMat, viewMat).cull(casters)
+                visibleIds = set(map(id, visible))
+                if key == self.layerKeys[layer] and not (moved & (visibleIds | self.layerCasters[layer])):
+                    continue
+                self.renderLayer(layer, viewMat, projectionMat, visible)
+                self.layerMats[layer] = viewMat @ projectionMat
+                self.layerKeys[layer] = key
+                self.layerCasters[layer] = visibleIds
+        if self.renderedLayers:
+            gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, previousFbo)
+            gl.glViewport(*previousViewport)
+
+        GLState.bindTexture(self.shaderProg.shadowTextureUnit, self.depthTexture, gl.GL_TEXTURE_2D_ARRAY)
+        for layer in range(layerNum):
+            self.shaderProg.setMat4(f"shadowMats[{layer}]", self.layerMats[layer])
+
+    def movedComponents(self, components) -> set:
+        """
+        :return: ids of the components whose transformation changed since the last call, or which were added or
+            removed
+        """
+        matrices = {id(c): (c, np.asarray(c.transformationMat).tobytes()) for c in components}
+        moved = {key for key, (_, mat) in matrices.items() if self.matrices.get(key, (None, None))[1] != mat}
+        moved |= self.matrices.keys() - matrices.keys()
+        # the components are kept referenced, so their ids can't be reused by new ones
+        self.matrices = matrices
+        return moved
+
+    def lightViews(self, light, cube, sceneCenter, sceneRadius):
+        """
+        View and projection matrices of the layers of one light, with a key of everything they depend on
+
+        :return: list of (viewMat, projectionMat, key), six for cube maps
+        """
+        position = light["position"].astype(np.float64)
+        if light["infiniteOn"]:
+            # the shader lights along the normalized direction towards the light
+            direction = light["infiniteDirection"].astype(np.float64)
+            direction /= max(np.linalg.norm(direction), 1e-12)
+            eye = sceneCenter + direction * (sceneRadius + 1)
+            viewMat = self.glutility.view(eye, sceneCenter, self.upFor(direction))
+            projectionMat = self.glutility.orthographic(-sceneRadius, sceneRadius, -sceneRadius, sceneRadius,
+                                                        0.5, 2 * sceneRadius + 1.5)
+            return [(viewMat, projectionMat, ("infinite", direction.tobytes(), sceneCenter.tobytes(), sceneRadius))]
+
+        far = max(math.ceil(np.linalg.norm(position - sceneCenter) + sceneRadius), 1)
+        if cube:
+            views = []
+            for forward, up in cubeFaces:
+                viewMat = self.glutility.view(position, position + np.array(forward), up)
+                projectionMat = self.glutility.perspective(90, 1, 1, self.near, far)
+                views.append((viewMat, projectionMat, ("cube", position.tobytes(), far, forward)))
+            return views
+
+        # the shader lights the cone around the opposite of spotDirection, see genFragShaderSource
+        direction = -light["spotDirection"].astype(np.float64)
+        direction /= max(np.linalg.norm(direction), 1e-12)
+        angleLimit = float(light["spotAngleLimit"])
+        fov = min(2 * math.degrees(math.acos(max(-1.0, min(1.0, angleLimit)))) + 2, 179)
+        viewMat = self.glutility.view(position, position + direction, self.upFor(direction))
+        projectionMat = self.glutility.perspective(fov, 1, 1, self.near, far)
+        return [(viewMat, projectionMat, ("spot", position.tobytes(), direction.tobytes(), fov, far))]
+
+    @staticmethod
+    def upFor(direction):
+        return (1, 0, 0) if abs(direction[1]) > 0.99 else (0, 1, 0)
+
+    def renderLayer(self, layer, viewMat, projectionMat, components):
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.fbo)
+        gl.glFramebufferTextureLayer(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, self.depthTexture, 0, layer)
+        gl.glDrawBuffer(gl.GL_NONE)
+        gl.glReadBuffer(gl.GL_NONE)
+        gl.glViewport(0, 0, self.mapSize, self.mapSize)
+        gl.glClear(gl.GL_DEPTH_BUFFER_BIT)
+        gl.glEnable(gl.GL_POLYGON_OFFSET_FILL)
+        gl.glPolygonOffset(*self.polygonOffset)
+
+        self.depthProg.setMat4("viewMat", viewMat)
+        self.depthProg.setMat4("projectionMat", projectionMat)
+        for c in components:
+            self.depthProg.setModelMat(c.transformationMat, c.normalMat)
+            c.displayObj.draw()
+            self.drawCalls += 1
+        gl.glDisable(gl.GL_POLYGON_OFFSET_FILL)
+        self.renderedLayers += 1
+
+    def stats(self) -> dict:
+        return {
+            "shadowLights": self.shadowLights,
+            "layers": self.layerNum,
+            "renderedLayers": self.renderedLayers,
+            "drawCalls": self.drawCalls,
+        }
+
+    def delete(self):
+        gl.glDeleteFramebuffers(1, [self.fbo])
+        gl.glDeleteTextures(1, [self.depthTexture])
+        GLState.forgetTexture(self.depthTexture)
+        self.depthProg.delete()
+        # the components of the last update are kept alive by it otherwise
+        self.matrices = {}
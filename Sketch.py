@@ -8,6 +8,7 @@ First version Created on 09/28/2018
 '''
 import os
 import math
+import time
 from typing import List
 
 import numpy as np
@@ -19,9 +20,19 @@ from SceneThree import SceneThree
 from SceneType import Scene
 from ModelAxes import ModelAxes
 from Point import Point
+from ProgressiveRenderer import ProgressiveRenderer
+from RayTracer import RayTracer
 from CanvasBase import CanvasBase
 from GLProgram import GLProgram
 from GLBuffer import VAO, VBO, EBO, Texture
+from GeometryCache import GeometryCache
+from TextureCache import TextureCache
+from GLState import GLState
+from InstancedRenderer import InstancedRenderer
+from RenderQueue import RenderQueue
+from ShadowMaps import ShadowMaps
+from Frustum import Frustum
+from TransformGraph import TransformGraph
 import GLUtility
 from SceneOne import SceneOne
 from SceneTwo import SceneTwo
@@ -115,6 +126,26 @@ class Sketch(CanvasBase):
 
     pauseScene = False
 
+    # draw repeated meshes with glDrawElementsInstanced
+    instancingOn: bool = True
+    instancedRenderer: InstancedRenderer = None
+    # draw non-instanced components through a render queue sorted by state
+    renderQueue: RenderQueue = None
+    # skip components outside of the view frustum
+    cullingOn: bool = True
+    frustum: Frustum = None
+    # depth maps of the lights, shading the rasterized scene with shadows
+    shadowMaps: ShadowMaps = None
+
+    # array-backed transformation of the component tree, None uses the per-component update
+    transformGraph: TransformGraph = None
+
+    # ray traced preview of the current view, shown in place of the rasterized scene while not None
+    progressiveRenderer: ProgressiveRenderer = None
+    previewTexture: Texture = None
+    previewScale = 0.5  # traced resolution relative to the canvas
+    previewBudget = 0.05  # seconds of tracing per frame, keeps the canvas responsive
+
     # models
     basisAxes = None
     scene: Scene = None
@@ -147,6 +178,8 @@ class Sketch(CanvasBase):
         self.resetView()
 
         self.glutility = GLUtility.GLUtility()
+        self.instancedRenderer = InstancedRenderer()
+        self.renderQueue = RenderQueue()
 
     def resetView(self):
         self.lookAtPt = [0, 0, 0]
@@ -164,10 +197,21 @@ class Sketch(CanvasBase):
     def changeScene(self, index):
         self.sceneIndex = index % len(self.sceneList)
         self.switchScene(self.sceneList[self.sceneIndex](self.shaderProg))
+        if self.debug > 0:
+            print("Geometry cache:", GeometryCache.stats())
+            print("Texture cache:", TextureCache.stats())
+            print("Shader variants:", self.shaderProg.stats())
+        if self.progressiveRenderer is not None:
+            self.startPreview()
 
     def InitGL(self):
+        # a new context starts with default state and no textures
+        GLState.reset()
+        TextureCache.clear()
+        GeometryCache.clear()
         self.shaderProg = GLProgram()
         self.shaderProg.compile()
+        self.shadowMaps = ShadowMaps(self.shaderProg)
 
 
         # instantiate models, then can only be done with a compiled GL program
@@ -187,7 +231,7 @@ class Sketch(CanvasBase):
         self.perspMat = self.glutility.perspective(45, self.size.width, self.size.height, 0.01, 100)
         self.shaderProg.setMat4("projectionMat", self.perspMat)
         self.shaderProg.setMat4("viewMat", self.glutility.view(self.getCameraPos(), self.lookAtPt, self.upVector))
-        self.shaderProg.setMat4("modelMat", np.identity(4))
+        self.shaderProg.setModelMat(np.identity(4))
 
         self.shaderProg.setVec3("viewPosition", np.array(self.getCameraPos()))
 
@@ -228,9 +272,27 @@ class Sketch(CanvasBase):
         self.OnDraw()
 
     def OnDraw(self):
+        uniformQueries = self.shaderProg.uniformLocationQueries
+        GLState.beginFrame()
+        TextureCache.uploadReady()
+        self.frameCount += 1
+        if self.debug > 1 and self.frameCount % self.fps == 0:
+            print("GL calls in last frame:", GLState.stats())
+            if not self.instancingOn:
+                print("Render queue:", self.renderQueue.stats())
+            if self.frustum is not None:
+                print("Frustum culling:", self.frustum.stats())
+            print("Shadow maps:", self.shadowMaps.stats())
+            textureArrays = self.instancedRenderer.textureArrays if self.instancingOn else None
+            print("Texture memory:", TextureCache.vramReport(self.topLevelComponent, textureArrays))
         gl.glClearColor(*self.backgroundColor, 1.0)
         gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
 
+        if self.progressiveRenderer is not None:
+            self.drawPreview()
+            self.SwapBuffers()
+            return
+
         self.viewMat = self.glutility.view(self.getCameraPos(), self.lookAtPt, self.upVector)
         self.shaderProg.setMat4("viewMat", self.viewMat)
         self.shaderProg.setVec3("viewPosition", np.array(self.getCameraPos()))
@@ -238,15 +300,50 @@ class Sketch(CanvasBase):
         if not self.pauseScene and isinstance(self.scene, Animation):
             self.scene.animationUpdate()
         self.topLevelComponent.update(np.identity(4))
-        self.topLevelComponent.draw(self.shaderProg)
+        self.shadowMaps.update(self.topLevelComponent, self.scene.lightCubes)
+        self.frustum = Frustum(self.perspMat, self.viewMat) if self.cullingOn else None
+        if self.instancingOn:
+            self.instancedRenderer.draw(self.topLevelComponent, self.shaderProg, self.frustum)
+        else:
+            self.renderQueue.draw(self.topLevelComponent, self.shaderProg, self.frustum)
 
         # draw the axes on the canvas bottom right corner
         resultPt = self.unprojectCanvas(0.9 * self.size[0], 0.1 * self.size[1], 0.3)
         self.basisAxes.setCurrentPosition(resultPt)
+        self.basisAxes.update()
         self.basisAxes.draw(self.shaderProg)
 
+        if self.debug > 1 and self.shaderProg.uniformLocationQueries != uniformQueries:
+            print("Warning: glGetUniformLocation called",
+                  self.shaderProg.uniformLocationQueries - uniformQueries, "times in this frame")
+
         self.SwapBuffers()
 
+    def startPreview(self):
+        """
+        Start a progressive ray traced preview of the current view
+        """
+        width = max(1, int(self.size[0] * self.previewScale))
+        height = max(1, int(self.size[1] * self.previewScale))
+        # the tracer reads the images of the textures, it can't start from placeholders
+        TextureCache.finishLoading()
+        self.progressiveRenderer = ProgressiveRenderer(RayTracer.fromView(self, width, height))
+        if self.previewTexture is None:
+            self.previewTexture = Texture()
+
+    def drawPreview(self):
+        """
+        Trace for previewBudget seconds, then show the samples accumulated so far
+        """
+        if not np.allclose(self.progressiveRenderer.tracer.cameraPos, self.getCameraPos()):
+            # the camera moved, the samples are of another view
+            self.startPreview()
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.previewBudget and self.progressiveRenderer.step(4096):
+            pass
+        self.previewTexture.updateTextureImage(self.progressiveRenderer.image())
+        self.previewTexture.blit(self.size[0], self.size[1])
+
     def OnDestroy(self, event):
         """
         Window destroy event binding
@@ -383,6 +480,8 @@ class Sketch(CanvasBase):
         self.shaderProg.setBool('ambientOn', self.ambientOn)
         if update:
             self.update()
+        if self.progressiveRenderer is not None:
+            self.startPreview()
 
     def Interrupt_Keyboard(self, keycode):
         """
@@ -414,6 +513,44 @@ class Sketch(CanvasBase):
         elif chr(keycode) in "pP":
             # toggle pause of the animation
             self.pauseScene = not self.pauseScene
+        elif chr(keycode) in "iI":
+            # toggle instanced drawing of repeated meshes
+            self.instancingOn = not self.instancingOn
+            if self.debug > 0:
+                print("Instancing:", self.instancingOn, self.instancedRenderer.stats())
+        elif chr(keycode) in "qQ":
+            # toggle state sorting of the render queue
+            self.renderQueue.sortingOn = not self.renderQueue.sortingOn
+            self.instancedRenderer.renderQueue.sortingOn = self.renderQueue.sortingOn
+            if self.debug > 0:
+                print("State sorting:", self.renderQueue.sortingOn, self.renderQueue.stats())
+        elif chr(keycode) in "cC":
+            # toggle view-frustum culling
+            self.cullingOn = not self.cullingOn
+            if self.debug > 0:
+                print("Frustum culling:", self.cullingOn)
+        elif chr(keycode) in "gG":
+            # toggle the array-backed transformation update
+            if self.transformGraph is None:
+                self.transformGraph = TransformGraph(self.topLevelComponent)
+            else:
+                self.transformGraph.detach()
+                self.transformGraph = None
+            if self.debug > 0:
+                print("Transform graph:", self.transformGraph is not None)
+        elif chr(keycode) in "hH":
+            # toggle the shadow maps
+            self.shadowMaps.shadowsOn = not self.shadowMaps.shadowsOn
+            if self.debug > 0:
+                print("Shadows:", self.shadowMaps.shadowsOn)
+        elif chr(keycode) in "tT":
+            # toggle the progressive ray traced preview
+            if self.progressiveRenderer is None:
+                self.startPreview()
+            else:
+                self.progressiveRenderer = None
+            if self.debug > 0:
+                print("Ray traced preview:", self.progressiveRenderer is not None)
         elif chr(keycode) in "sS":
             # toggle the specular lighting
             self.specularOn = not self.specularOn
@@ -437,6 +574,8 @@ class Sketch(CanvasBase):
                 light_helper(light, self.scene.lightCubes[id_to_change])
                 self.shaderProg.setLight(id_to_change, light)
                 self.update()
+                if self.progressiveRenderer is not None:
+                    self.startPreview()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,176 @@
+"""
+Define texture arrays, the bindless-style path of InstancedRenderer. Textures of the same size are copied into the
+layers of one GL_TEXTURE_2D_ARRAY, so components differing only by their texture, like the billiard balls of
+SceneFour, are drawn by one instanced call which picks a layer per instance, with a single texture bound.
+
+The arrays are copies: the textures stay as they are for everything else, and the arrays are rebuilt when a new
+texture shows up. Block compressed textures are copied from their compressed levels into arrays of their own format,
+so they take as little video memory in an array as they do alone, and are sampled the same. The other textures are
+copied from Texture.image.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import numpy as np
+
+from GLBuffer import Texture
+from GLState import GLState
+
+try:
+    import OpenGL
+
+    try:
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+    except ImportError:
+        from ctypes import util
+
+        orig_util_find_library = util.find_library
+
+
+        def new_util_find_library(name):
+            res = orig_util_find_library(name)
+            if res:
+                return res
+            return '/System/Library/Frameworks/' + name + '.framework/' + name
+
+
+        util.find_library = new_util_find_library
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+except ImportError:
+    raise ImportError("Required dependency PyOpenGL not present")
+
+
+class TextureArray:
+    """
+    One GL_TEXTURE_2D_ARRAY holding images of the same size
+    """
+    textureName = 0
+    size = None  # (height, width) of every layer
+    compressedFormat = None  # internal format of the layers if they are block compressed
+    layers = None  # dict, Texture -> layer
+    nbytes = 0  # video memory of the array, mipmaps included
+    uncompressedBytes = 0  # the same for an uncompressed array
+
+    def __init__(self, size, textures, compressedFormat=None):
+        """
+        :param textures: list of Texture whose images are size large, one layer each in this order
+        :param compressedFormat: internal format shared by the textures, which are then copied from their
+            compressedLevels
+        """
+        self.size = size
+        self.compressedFormat = compressedFormat
+        self.layers = {texture: layer for layer, texture in enumerate(textures)}
+        height, width = size
+        mipmaps = any(texture.mipmaps for texture in textures)
+        self.uncompressedBytes = height * width * 4 * len(textures)
+        if mipmaps:
+            self.uncompressedBytes = self.uncompressedBytes * 4 // 3
+
+        self.textureName = gl.glGenTextures(1)
+        GLState.bindTextureToAnyUnit(self.textureName, gl.GL_TEXTURE_2D_ARRAY, pinned=False)
+        if compressedFormat is not None:
+            # every level holds the blocks of all the layers one after the other
+            levelCount = min(len(texture.compressedLevels) for texture in textures)
+            self.nbytes = 0
+            for level in range(levelCount):
+                levelWidth, levelHeight, _ = textures[0].compressedLevels[level]
+                blocks = np.concatenate([texture.compressedLevels[level][2] for texture in textures])
+                gl.glCompressedTexImage3D(gl.GL_TEXTURE_2D_ARRAY, level, compressedFormat, levelWidth, levelHeight,
+                                          len(textures), 0, blocks)
+                self.nbytes += blocks.nbytes
+        else:
+            gl.glTexImage3D(gl.GL_TEXTURE_2D_ARRAY, 0, gl.GL_RGB, width, height, len(textures), 0, gl.GL_RGB,
+                            gl.GL_UNSIGNED_BYTE, None)
+            for texture, layer in self.layers.items():
+                gl.glTexSubImage3D(gl.GL_TEXTURE_2D_ARRAY, 0, 0, 0, layer, width, height, 1, gl.GL_RGB,
+                                   gl.GL_UNSIGNED_BYTE, texture.image.flatten("C"))
+            if mipmaps:
+                gl.glGenerateMipmap(gl.GL_TEXTURE_2D_ARRAY)
+            self.nbytes = self.uncompressedBytes
+        # same sampling as Texture.setTextureParameters
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_WRAP_S, gl.GL_REPEAT)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_WRAP_T, gl.GL_REPEAT)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D_ARRAY, gl.GL_TEXTURE_MAG_FILTER, gl.GL_LINEAR)
+
+    def bind(self, unit):
+        GLState.bindTexture(unit, self.textureName, gl.GL_TEXTURE_2D_ARRAY)
+
+    def delete(self):
+        GLState.forgetTexture(self.textureName)
+        gl.glDeleteTextures(1, [self.textureName])
+        self.textureName = 0
+
+
+class TextureArrays:
+    """
+    The texture arrays of one OpenGL context, one per image size. update() is called every frame with the textures
+    the frame draws from arrays, and only rebuilds an array when one of them is not in it yet
+    """
+    arrays = None  # dict, arrayKey -> TextureArray
+    maxLayers = 0  # GL_MAX_ARRAY_TEXTURE_LAYERS, textures beyond it are left out of the arrays
+
+    # statistics
+    rebuilds = 0
+
+    def __init__(self):
+        self.arrays = {}
+        self.maxLayers = 0
+        self.rebuilds = 0
+
+    @staticmethod
+    def arrayKey(texture: Texture) -> tuple:
+        """
+        Textures with the same key share an array: same size, and same block format or uncompressed
+        """
+        height, width = texture.image.shape[0:2]
+        return height, width, texture.compressedFormat
+
+    def update(self, textures):
+        """
+        Make sure every texture has a layer, rebuilding the arrays of the keys which miss some. A rebuilt array
+        only holds the textures given this time, textures not used anymore leave the arrays this way
+
+        :param textures: iterable of Texture
+        """
+        if not self.maxLayers:
+            self.maxLayers = int(gl.glGetIntegerv(gl.GL_MAX_ARRAY_TEXTURE_LAYERS))
+        byKey = {}
+        for texture in textures:
+            byKey.setdefault(self.arrayKey(texture), {})[texture] = None
+        for key, needed in byKey.items():
+            needed = list(needed)[:self.maxLayers]
+            array = self.arrays.get(key)
+            if array is not None and all(texture in array.layers for texture in needed):
+                continue
+            if array is not None:
+                array.delete()
+            height, width, compressedFormat = key
+            self.arrays[key] = TextureArray((height, width), needed, compressedFormat)
+            self.rebuilds += 1
+
+    def layerOf(self, texture: Texture):
+        """
+        :return: (TextureArray, layer) holding the texture, or None if it is in no array
+        """
+        array = self.arrays.get(self.arrayKey(texture))
+        if array is None or texture not in array.layers:
+            return None
+        return array, array.layers[texture]
+
+    def delete(self):
+        for array in self.arrays.values():
+            array.delete()
+        self.arrays = {}
+
+    def stats(self) -> dict:
+        return {
+            "arrays": len(self.arrays),
+            "layers": sum(len(a.layers) for a in self.arrays.values()),
+            "compressed": sum(a.compressedFormat is not None for a in self.arrays.values()),
+            "bytes": sum(a.nbytes for a in self.arrays.values()),
+            "uncompressedBytes": sum(a.uncompressedBytes for a in self.arrays.values()),
+            "rebuilds": self.rebuilds,
+        }
@@ -0,0 +1,312 @@
+"""
+Define a process-wide registry of image textures, so every Component using the same file shares one Texture and one
+GL texture object. Files are decoded and uploaded once: SceneThree's donuts share a single copy of their texture, and
+toggling the flashlight of SceneTwo binds the texture it already has.
+
+Files baked into the asset pack (see AssetPack) are uploaded right away from the memory-mapped pack, without
+decoding, block compressed when the context supports the format. Other files are decoded by a pool of threads while
+the scene is being built. acquire returns at once with a Texture showing a one texel placeholder, uploadReady, called
+on the OpenGL thread every frame, uploads the images decoded so far. finishLoading waits for all of them, for
+renderers which need the final images.
+
+Textures nobody uses anymore stay resident, so switching back to a scene or turning a light on again doesn't touch
+the disk. They are deleted least recently used first whenever the textures in video memory exceed budget.
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import numpy as np
+
+from AssetPack import AssetPack, decodeImage
+from GLBuffer import Texture
+from GLState import GLState
+
+try:
+    import OpenGL
+
+    try:
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+    except ImportError:
+        from ctypes import util
+
+        orig_util_find_library = util.find_library
+
+
+        def new_util_find_library(name):
+            res = orig_util_find_library(name)
+            if res:
+                return res
+            return '/System/Library/Frameworks/' + name + '.framework/' + name
+
+
+        util.find_library = new_util_find_library
+        import OpenGL.GL as gl
+        import OpenGL.GLU as glu
+except ImportError:
+    raise ImportError("Required dependency PyOpenGL not present")
+
+from OpenGL.GL.EXT.texture_compression_s3tc import GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+
+
+class TextureCache:
+    """
+    Reference counted Texture registry, keyed by absolute file path and texture flags. Use acquire/release in pairs.
+    Sizes are estimated as 4 bytes per texel, drivers pad RGB textures to RGBA, plus a third for the mipmaps
+    """
+    textures = {}  # key -> Texture, in use or not
+    unused = OrderedDict()  # key -> Texture with no reference left, least recently released first
+    budget = 256 * 1024 * 1024  # bytes of video memory textures may take before unused ones are evicted
+    residentBytes = 0
+
+    # asynchronous loading
+    decodeThreads = os.cpu_count() or 1
+    executor = None  # ThreadPoolExecutor decoding the files, created on first use
+    loading = {}  # key -> Future of decodeImage, for textures still showing their placeholder
+    placeholderColor = (128, 128, 128)  # texel shown by textures while they load
+    placeholderNormal = (128, 128, 255)  # the same for normal maps, a normal along the surface normal
+    placeholders = {}  # placeholder texel -> Texture
+    packPath = os.path.join("assets", "assets.pack")  # asset pack read by acquire if it exists
+    assetPack: AssetPack = None  # opened on the first miss, False if there is no pack
+    compressionOn = True  # upload the block compressed levels of the pack when the context supports their format
+    compressedFormats = None  # dict, AssetPack block format -> GL internal format, the ones this context supports
+
+    # statistics
+    hits = 0
+    misses = 0
+    packed = 0  # misses uploaded from the asset pack
+    evictions = 0
+
+    @staticmethod
+    def textureKey(path, mipmaps=True) -> tuple:
+        return os.path.abspath(path), mipmaps
+
+    @staticmethod
+    def uncompressedBytes(texture: Texture) -> int:
+        if texture.image is None:
+            # still loading, only the shared placeholder is in video memory
+            return 0
+        height, width = texture.image.shape[0:2]
+        size = width * height * 4
+        return size * 4 // 3 if texture.mipmaps else size
+
+    @classmethod
+    def textureBytes(cls, texture: Texture) -> int:
+        if texture.compressedFormat is not None:
+            return texture.compressedBytes
+        return cls.uncompressedBytes(texture)
+
+    @classmethod
+    def placeholder(cls, texel) -> Texture:
+        texture = cls.placeholders.get(texel)
+        if texture is None:
+            texture = Texture()
+            texture.setTextureImage(np.array([[texel]], dtype=np.uint8), mipmaps=False, bottomRowFirst=True)
+            cls.placeholders[texel] = texture
+        return texture
+
+    @classmethod
+    def acquire(cls, path, mipmaps=True, placeholder=None) -> Texture:
+        """
+        Get the shared texture of an image file. On first use the file is uploaded from the asset pack if it is in
+        there, otherwise it starts decoding in the background and the texture shows a placeholder texel until
+        uploadReady uploads it
+
+        :param path: image file, any format PIL reads. Alpha is dropped
+        :param mipmaps: generate the mipmaps of the texture, textures with and without are cached apart
+        :param placeholder: RGB texel shown while loading, placeholderColor by default
+        :rtype: Texture
+        """
+        key = cls.textureKey(path, mipmaps)
+        texture = cls.textures.get(key)
+        if texture is None:
+            texture = Texture()
+            texture.cacheKey = key
+            cls.textures[key] = texture
+            cls.misses += 1
+            levels = cls.packedLevels(path)
+            if levels is not None:
+                compressed = cls.packedCompressedLevels(path)
+                if compressed is not None:
+                    blockFormat, compressedLevels = compressed
+                    texture.setCompressedLevels(compressedLevels, cls.supportedFormats()[blockFormat], levels[0],
+                                                path, mipmaps)
+                else:
+                    texture.setTextureLevels(levels, path, mipmaps)
+                cls.residentBytes += cls.textureBytes(texture)
+                cls.packed += 1
+                cls.evict()
+            else:
+                if cls.executor is None:
+                    cls.executor = ThreadPoolExecutor(cls.decodeThreads, thread_name_prefix="TextureCache")
+                texture.source = path
+                texture.mipmaps = mipmaps
+                texture.textureName = cls.placeholder(placeholder or cls.placeholderColor).textureName
+                cls.loading[key] = cls.executor.submit(decodeImage, path)
+        else:
+            cls.unused.pop(key, None)
+            cls.hits += 1
+        texture.refCount += 1
+        return texture
+
+    @classmethod
+    def packedLevels(cls, path):
+        """
+        :return: the mip chain of a file from the asset pack, None if it is not in the pack
+        """
+        if cls.assetPack is None:
+            cls.assetPack = AssetPack(cls.packPath) if os.path.isfile(cls.packPath) else False
+        return cls.assetPack.levels(path) if cls.assetPack else None
+
+    @classmethod
+    def packedCompressedLevels(cls, path):
+        """
+        :return: (block format, levels) of a file from the asset pack, None if it is not in the pack, compression is
+            off or the context doesn't support the format
+        """
+        if not cls.compressionOn or not cls.assetPack:
+            return None
+        compressed = cls.assetPack.compressedLevels(path)
+        if compressed is None or compressed[0] not in cls.supportedFormats():
+            return None
+        return compressed
+
+    @classmethod
+    def supportedFormats(cls) -> dict:
+        if cls.compressedFormats is None:
+            count = gl.glGetIntegerv(gl.GL_NUM_EXTENSIONS)
+            extensions = {gl.glGetStringi(gl.GL_EXTENSIONS, i).decode() for i in range(count)}
+            # RGTC is core since OpenGL 3.0, S3TC is an extension
+            cls.compressedFormats = {"bc5": gl.GL_COMPRESSED_RG_RGTC2}
+            if "GL_EXT_texture_compression_s3tc" in extensions:
+                cls.compressedFormats["bc1"] = GL_COMPRESSED_RGB_S3TC_DXT1_EXT
+        return cls.compressedFormats
+
+    @classmethod
+    def uploadReady(cls):
+        """
+        Upload the textures decoded since the last call. Call it on the OpenGL thread, before drawing a frame.
+        A file which failed to decode raises here once, its texture keeps the placeholder
+        """
+        for key, future in list(cls.loading.items()):
+            if not future.done():
+                continue
+            del cls.loading[key]
+            texture = cls.textures[key]
+            texture.setTextureImage(future.result(), texture.source, texture.mipmaps, bottomRowFirst=True)
+            cls.residentBytes += cls.textureBytes(texture)
+        cls.evict()
+
+    @classmethod
+    def finishLoading(cls):
+        """
+        Wait for every texture being decoded and upload them all
+        """
+        wait(list(cls.loading.values()))
+        cls.uploadReady()
+
+    @classmethod
+    def release(cls, texture: Texture):
+        """
+        Drop one reference to a texture from acquire. Other textures and None are ignored
+        """
+        if texture is None or texture.cacheKey is None or cls.textures.get(texture.cacheKey) is not texture:
+            return
+        texture.refCount -= 1
+        if texture.refCount <= 0:
+            cls.unused[texture.cacheKey] = texture
+            cls.evict()
+
+    @classmethod
+    def evict(cls):
+        """
+        Delete unused textures, least recently used first, until the resident ones fit in budget
+        """
+        while cls.residentBytes > cls.budget and cls.unused:
+            key, texture = cls.unused.popitem(last=False)
+            del cls.textures[key]
+            future = cls.loading.pop(key, None)
+            if future is not None:
+                # the placeholder is shared, there is nothing of this texture to delete yet
+                future.cancel()
+            else:
+                cls.residentBytes -= cls.textureBytes(texture)
+                GLState.forgetTexture(texture.textureName)
+                gl.glDeleteTextures(1, [texture.textureName])
+            texture.textureName = 0
+            cls.evictions += 1
+
+    @classmethod
+    def setBudget(cls, budget):
+        """
+        :param budget: bytes of video memory for textures, unused textures beyond it are deleted right away
+        """
+        cls.budget = budget
+        cls.evict()
+
+    @classmethod
+    def clear(cls):
+        """
+        Forget every texture without deleting it, for a new OpenGL context. The old context owns them.
+        Files still decoding finish in the background and are dropped
+        """
+        cls.textures = {}
+        cls.unused = OrderedDict()
+        cls.loading = {}
+        cls.placeholders = {}
+        cls.compressedFormats = None
+        cls.residentBytes = 0
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "textures": len(cls.textures),
+            "unused": len(cls.unused),
+            "loading": len(cls.loading),
+            "references": sum(t.refCount for t in cls.textures.values()),
+            "residentBytes": cls.residentBytes,
+            "budget": cls.budget,
+            "hits": cls.hits,
+            "misses": cls.misses,
+            "packed": cls.packed,
+            "evictions": cls.evictions,
+        }
+
+    @classmethod
+    def vramReport(cls, topLevelComponent, textureArrays=None) -> dict:
+        """
+        Video memory taken by the textures of a Component tree as they are uploaded, and what it would take with
+        all of them uncompressed
+
+        :param textureArrays: TextureArrays the tree is drawn from, their copies of the textures are counted too
+        """
+        textures = {}
+        components = [topLevelComponent]
+        while components:
+            component = components.pop()
+            components.extend(component.children)
+            for texture in (component.texture, component.normalMap):
+                if texture is not None and texture.image is not None:
+                    textures[id(texture)] = texture
+        arrays = textureArrays.stats() if textureArrays is not None else {"bytes": 0, "uncompressedBytes": 0}
+        uploaded = sum(cls.textureBytes(t) for t in textures.values()) + arrays["bytes"]
+        uncompressed = sum(cls.uncompressedBytes(t) for t in textures.values()) + arrays["uncompressedBytes"]
+        return {
+            "textures": len(textures),
+            "compressed": sum(t.compressedFormat is not None for t in textures.values()),
+            "arrayBytes": arrays["bytes"],
+            "uploadedBytes": uploaded,
+            "uncompressedBytes": uncompressed,
+            "savedBytes": uncompressed - uploaded,
+        }
+
+    @classmethod
+    def resetStats(cls):
+        cls.hits = 0
+        cls.misses = 0
+        cls.packed = 0
+        cls.evictions = 0
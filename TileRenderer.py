@@ -0,0 +1,199 @@
+"""
+Render a RayTracer image in tiles spread over a pool of processes. The tracer is handed to the workers once, when
+the pool starts: its NumPy arrays (BVH nodes, triangles, textures) are moved into a shared memory block and every
+worker maps them from there, so nothing big is pickled, neither per worker nor per tile. Workers write their tiles
+straight into a shared float image, tasks only carry the tile corners.
+
+    python HeadlessRenderer.py --scene 4 --tracer --processes 8 --width 1920 --height 1080
+
+:author: micou(Zezhou Sun)
+:version: 2021.1.1
+"""
+import io
+import multiprocessing
+import os
+import pickle
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+
+class SharedArrays:
+    """
+    Pickle of an object graph whose large NumPy arrays live in one shared memory block. Pickling a SharedArrays only
+    sends the block's name, load rebuilds the graph with read-only arrays mapped from the block.
+    The creating process owns the block, call release there once no worker needs it anymore
+    """
+    memory: SharedMemory = None
+    data = None  # bytes, pickle of the graph with the arrays left out
+    layout = None  # list of (offset, shape, dtype) of the arrays in the block
+    minBytes = 4096  # smaller arrays are pickled as usual
+    alignment = 64
+
+    def __init__(self, obj, minBytes=4096):
+        self.minBytes = minBytes
+        arrays = []
+        slots = {}
+
+        def persistentId(o):
+            if type(o) is not np.ndarray or o.dtype.hasobject or o.nbytes < self.minBytes:
+                return None
+            # arrays referenced several times are stored once
+            if id(o) not in slots:
+                slots[id(o)] = len(arrays)
+                arrays.append(o)
+            return slots[id(o)]
+
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistentId
+        pickler.dump(obj)
+        self.data = buffer.getvalue()
+
+        self.layout = []
+        size = 0
+        for a in arrays:
+            self.layout.append((size, a.shape, a.dtype.str))
+            size += -(-a.nbytes // self.alignment) * self.alignment
+        self.memory = SharedMemory(create=True, size=max(size, 1))
+        for a, (offset, shape, dtype) in zip(arrays, self.layout):
+            np.ndarray(shape, dtype, buffer=self.memory.buf, offset=offset)[...] = a
+
+    def __getstate__(self):
+        return {"name": self.memory.name, "data": self.data, "layout": self.layout}
+
+    def __setstate__(self, state):
+        self.memory = SharedMemory(state["name"])
+        self.data = state["data"]
+        self.layout = state["layout"]
+
+    def load(self):
+        def persistentLoad(slot):
+            offset, shape, dtype = self.layout[slot]
+            a = np.ndarray(shape, dtype, buffer=self.memory.buf, offset=offset)
+            a.flags.writeable = False
+            return a
+
+        unpickler = pickle.Unpickler(io.BytesIO(self.data))
+        unpickler.persistent_load = persistentLoad
+        return unpickler.load()
+
+    def size(self) -> int:
+        return self.memory.size
+
+    def release(self):
+        self.memory.close()
+        self.memory.unlink()
+
+
+# state of a worker process, set once by initWorker
+workerTracer = None
+workerImage = None
+workerMemory = None
+
+
+def initWorker(shared: SharedArrays, imageName, imageShape):
+    global workerTracer, workerImage, workerMemory
+    workerTracer = shared.load()
+    # keep the segments mapped for the lifetime of the worker
+    workerMemory = (shared, SharedMemory(imageName))
+    workerImage = np.ndarray(imageShape, np.float32, buffer=workerMemory[1].buf)
+
+
+def traceTile(tile):
+    """
+    Trace one tile into the shared image
+
+    :return: the tile, and the primary and shadow rays traced for it
+    """
+    x0, y0, x1, y1 = tile
+    primaryRays, shadowRays = workerTracer.primaryRays, workerTracer.shadowRays
+    workerImage[y0:y1, x0:x1] = workerTracer.renderTile(x0, y0, x1, y1)
+    return tile, workerTracer.primaryRays - primaryRays, workerTracer.shadowRays - shadowRays
+
+
+class TileRenderer:
+    """
+    Tiles are handed out one at a time, so workers that got cheap tiles (background) pick up more of them.
+    progress, if set, is called after every finished tile with the number of finished and total tiles
+    """
+    processes = 1  # 1 traces in this process, without a pool
+    tileSize = 64  # 64 * 64 pixels, one packet of the tracer
+    progress = None  # function(done, total)
+
+    # statistics of the last render call
+    tiles = 0
+    primaryRays = 0
+    shadowRays = 0
+    sharedBytes = 0  # size of the shared memory block of the scene
+    setupTime = 0.0  # sharing the scene and starting the workers
+    renderTime = 0.0
+
+    def __init__(self, processes=None, tileSize=64, progress=None):
+        """
+        :param processes: number of worker processes, all cores if None
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.tileSize = tileSize
+        self.progress = progress
+
+    def tileList(self, width, height) -> list:
+        size = self.tileSize
+        return [(x, y, min(x + size, width), min(y + size, height))
+                for y in range(0, height, size) for x in range(0, width, size)]
+
+    def render(self, tracer) -> np.ndarray:
+        """
+        :param tracer: RayTracer, built and with its camera set
+        :return: (height, width, 3) uint8 RGB image, the same as tracer.render()
+        """
+        tiles = self.tileList(tracer.width, tracer.height)
+        self.tiles = len(tiles)
+        self.primaryRays = self.shadowRays = self.sharedBytes = 0
+        start = time.perf_counter()
+        if self.processes <= 1:
+            image = np.empty((tracer.height, tracer.width, 3), dtype=np.float32)
+            tracer.primaryRays = tracer.shadowRays = 0
+            self.setupTime = 0.0
+            for done, (x0, y0, x1, y1) in enumerate(tiles, 1):
+                image[y0:y1, x0:x1] = tracer.renderTile(x0, y0, x1, y1)
+                if self.progress is not None:
+                    self.progress(done, len(tiles))
+            self.primaryRays, self.shadowRays = tracer.primaryRays, tracer.shadowRays
+            self.renderTime = time.perf_counter() - start
+            return np.rint(np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+        shape = (tracer.height, tracer.width, 3)
+        shared = SharedArrays(tracer)
+        imageMemory = SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+        self.sharedBytes = shared.size()
+        try:
+            with multiprocessing.Pool(self.processes, initWorker, (shared, imageMemory.name, shape)) as pool:
+                self.setupTime = time.perf_counter() - start
+                for done, (_, primaryRays, shadowRays) in enumerate(pool.imap_unordered(traceTile, tiles), 1):
+                    self.primaryRays += primaryRays
+                    self.shadowRays += shadowRays
+                    if self.progress is not None:
+                        self.progress(done, len(tiles))
+            image = np.ndarray(shape, np.float32, buffer=imageMemory.buf)
+            # the same float to unsigned normalized conversion as RayTracer.render
+            result = np.rint(np.clip(image, 0, 1) * 255).astype(np.uint8)
+            del image
+        finally:
+            imageMemory.close()
+            imageMemory.unlink()
+            shared.release()
+        self.renderTime = time.perf_counter() - start
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "processes": self.processes,
+            "tiles": self.tiles,
+            "primaryRays": self.primaryRays,
+            "shadowRays": self.shadowRays,
+            "sharedBytes": self.sharedBytes,
+            "setupTime": self.setupTime,
+            "renderTime": self.renderTime,
+        }